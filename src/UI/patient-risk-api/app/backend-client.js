@@ -0,0 +1,97 @@
+/*
+* A JSON client for one of the data APIs. Requests share a pool of keep-alive connections, ask
+* for gzip, and give up after the backend's timeout. Responses that come with an ETag are kept and
+* revalidated with If-None-Match, so an unchanged payload is not sent again.
+*/
+var http = require('http');
+var https = require('https');
+var url = require('url');
+var zlib = require('zlib');
+var querystring = require('querystring');
+
+function BackendClient(options){
+    var base = url.parse(options.url);
+    this.name = options.name;
+    this.timeout = options.timeout;
+    this.protocol = base.protocol === 'https:' ? https : http;
+    this.hostname = base.hostname;
+    this.port = base.port;
+    this.basePath = (base.pathname || '/').replace(/\/$/, '');
+    this.agent = new this.protocol.Agent({keepAlive: true, maxSockets: options.maxSockets});
+    this.etags = {};
+}
+
+/*
+* Calls back with (error, body, headers), the body parsed as JSON. The error has code
+* 'ETIMEDOUT' when the backend did not answer within its timeout.
+*/
+BackendClient.prototype.getJSON = function(path, query, headers, callback){
+    var self = this;
+    var requestPath = self.basePath + path + (query ? '?' + querystring.stringify(query) : '');
+    var cached = self.etags[requestPath];
+    var requestHeaders = {'Accept': 'application/json', 'Accept-Encoding': 'gzip'};
+    Object.keys(headers || {}).forEach(function(name){
+        requestHeaders[name] = headers[name];
+    });
+    if(cached){
+        requestHeaders['If-None-Match'] = cached.etag;
+    }
+
+    var finished = false;
+    function finish(error, body, responseHeaders){
+        if(finished){
+            return;
+        }
+        finished = true;
+        clearTimeout(timer);
+        callback(error, body, responseHeaders);
+    }
+
+    var request = self.protocol.get({
+        hostname: self.hostname,
+        port: self.port,
+        path: requestPath,
+        headers: requestHeaders,
+        agent: self.agent
+    }, function(response){
+        if(response.statusCode === 304 && cached){
+            response.resume();
+            return finish(null, cached.body, response.headers);
+        }
+        var stream = response;
+        if(response.headers['content-encoding'] === 'gzip'){
+            stream = response.pipe(zlib.createGunzip());
+        }
+        var chunks = [];
+        stream.on('data', function(chunk){
+            chunks.push(chunk);
+        });
+        stream.on('error', finish);
+        stream.on('end', function(){
+            var text = Buffer.concat(chunks).toString('utf8');
+            if(response.statusCode !== 200){
+                return finish(new Error(self.name + ' answered ' + response.statusCode + ': ' + text.slice(0, 200)));
+            }
+            var body;
+            try{
+                body = JSON.parse(text);
+            } catch(error){
+                return finish(new Error(self.name + ' did not answer JSON: ' + error.message));
+            }
+            if(response.headers.etag){
+                self.etags[requestPath] = {etag: response.headers.etag, body: body};
+            }
+            finish(null, body, response.headers);
+        });
+    });
+    request.on('error', finish);
+
+    var timer = setTimeout(function(){
+        var error = new Error(self.name + ' did not answer within ' + self.timeout + 'ms');
+        error.code = 'ETIMEDOUT';
+        finish(error);
+        request.abort();
+    }, self.timeout);
+};
+
+module.exports = BackendClient;
@@ -0,0 +1,109 @@
+/*
+* Everything the patient-risk UI shows for a list of discharges, gathered in one request: the
+* records and risk scores from record-getter, the reference population of every age bucket and
+* the readmission rates from reference-data. All of them are requested at the same time, so the
+* view takes as long as the slowest backend rather than the sum of them. A backend that fails or
+* does not answer within its timeout leaves its part null and is listed in 'errors'.
+* Every age bucket is requested, since the ages are only known once the records arrive, but only
+* the buckets of the admissions are returned; the buckets are small once reference-data's ETag is
+* cached. The readmission rates are only requested when options.readmissionData is not false.
+*/
+var BackendClient = require('./backend-client');
+
+function PatientView(config){
+    this.recordGetter = new BackendClient(config.recordGetter);
+    this.referenceData = new BackendClient(config.referenceData);
+    this.ageBuckets = config.referenceAgeBuckets;
+}
+
+/*
+* Index of the reference age bucket of an age, the bucket with the highest lower bound at or
+* below it.
+*/
+PatientView.prototype.bucketOf = function(age){
+    var bucket = 0;
+    for(var i = 0; i < this.ageBuckets.length; i++){
+        if(age >= this.ageBuckets[i]){
+            bucket = i;
+        }
+    }
+    return bucket;
+};
+
+/*
+* Calls back with the view of the admissions.
+*/
+PatientView.prototype.get = function(admissionIDs, options, traceId, callback){
+    var self = this;
+    var headers = traceId ? {'X-Trace-Id': traceId} : {};
+    var started = Date.now();
+    var parts = {};
+    var errors = {};
+    var timings = {};
+
+    var calls = [
+        {part: 'records', client: self.recordGetter, path: '/v1/get-records',
+         query: {admissionIDs: JSON.stringify(admissionIDs)}}
+    ];
+    if(options.readmissionData !== false){
+        calls.push({part: 'readmissionData', client: self.referenceData, path: '/v1/get-readmission-data'});
+    }
+    self.ageBuckets.forEach(function(minAge, i){
+        calls.push({part: 'referenceData.' + i, client: self.referenceData, path: '/v1/get-reference-data',
+                    query: {ages: minAge}});
+    });
+
+    var pending = calls.length;
+    calls.forEach(function(call){
+        call.client.getJSON(call.path, call.query, headers, function(error, body, responseHeaders){
+            timings[call.part] = Date.now() - started;
+            if(error){
+                errors[call.part] = error.message;
+            } else{
+                parts[call.part] = {body: body, headers: responseHeaders};
+            }
+            pending -= 1;
+            if(pending === 0){
+                callback(self.assemble(admissionIDs, parts, errors, timings));
+            }
+        });
+    });
+};
+
+PatientView.prototype.assemble = function(admissionIDs, parts, errors, timings){
+    var self = this;
+    var patients = null;
+    var unscored = null;
+    if(parts.records){
+        patients = parts.records.body.documents.map(function(document){
+            var patient = document.patientInfo;
+            patient.referenceBucket = self.bucketOf(patient.AGE);
+            return patient;
+        });
+        unscored = parseInt(parts.records.headers['x-unscored-admissions'] || '0', 10);
+    }
+    // Keyed by the referenceBucket of the patients
+    var referenceData = {};
+    (patients || []).forEach(function(patient){
+        var i = patient.referenceBucket;
+        var part = parts['referenceData.' + i];
+        referenceData[i] = {
+            minAge: self.ageBuckets[i],
+            maxAge: i + 1 < self.ageBuckets.length ? self.ageBuckets[i + 1] : null,
+            data: part ? part.body : null
+        };
+    });
+    return {
+        admissionIDs: admissionIDs,
+        count: patients ? patients.length : 0,
+        patients: patients,
+        unscoredAdmissions: unscored,
+        referenceData: referenceData,
+        readmissionData: parts.readmissionData ? parts.readmissionData.body : null,
+        partial: Object.keys(errors).length > 0,
+        errors: errors,
+        timings: timings
+    };
+};
+
+module.exports = PatientView;
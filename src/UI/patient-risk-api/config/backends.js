@@ -0,0 +1,31 @@
+/*
+* The data APIs behind /api/patient-view. Each backend is reached through its own pool of
+* keep-alive connections and gets its own timeout, so a slow backend only delays its own part of
+* the response.
+*
+* 'RECORD_GETTER_URL'        - record-getter, the records of the admissions with their risk scores
+* 'REFERENCE_DATA_URL'       - reference-data, the reference population and the readmission rates
+* '<BACKEND>_TIMEOUT_MS'     - milliseconds after which a backend's part is left out of the response
+* 'BACKEND_MAX_SOCKETS'      - connections kept open to each backend
+* 'REFERENCE_AGE_BUCKETS'    - the lower bounds of the age buckets reference-data serves
+*                              (ageBuckets in reference-data/reference_store.py)
+*/
+module.exports = function(){
+    var maxSockets = parseInt(process.env.BACKEND_MAX_SOCKETS || '16', 10);
+
+    return{
+        recordGetter: {
+            name: 'record-getter',
+            url: process.env.RECORD_GETTER_URL || 'http://record-getter.52.204.218.231.nip.io',
+            timeout: parseInt(process.env.RECORD_GETTER_TIMEOUT_MS || '5000', 10),
+            maxSockets: maxSockets
+        },
+        referenceData: {
+            name: 'reference-data',
+            url: process.env.REFERENCE_DATA_URL || 'http://reference-data-api.52.204.218.231.nip.io',
+            timeout: parseInt(process.env.REFERENCE_DATA_TIMEOUT_MS || '2000', 10),
+            maxSockets: maxSockets
+        },
+        referenceAgeBuckets: (process.env.REFERENCE_AGE_BUCKETS || '1,25,50').split(',').map(Number)
+    };
+}
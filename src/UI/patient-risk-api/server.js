@@ -7,11 +7,15 @@
 
 var mongoConfig = new require('./config/mongodb.js');
 var db = mongoConfig();
+var backendsConfig = new require('./config/backends.js');
+var backends = backendsConfig();
 
 var express = new require('express');
 var app = express();
 var bodyParser = new require('body-parser');
 var mongoose = new require('mongoose');
+var compression = new require('compression');
+var crypto = new require('crypto');
 
 mongoose.connect(db.connectionString);
 
@@ -19,7 +23,12 @@ mongoose.connect(db.connectionString);
 //Schemas
 var DischargePatient = new require('./app/models/discharged-patient');
 
+//Aggregation of the data APIs
+var PatientView = new require('./app/patient-view');
+var patientView = new PatientView(backends);
+
 //Configuration
+app.use(compression());
 app.use(bodyParser.urlencoded({ extended: true }));
 app.use(bodyParser.json());
 
@@ -30,7 +39,8 @@ var router = express.Router();
 
 router.use(function(request, response, next){
     response.header("Access-Control-Allow-Origin", "*");
-    response.header("Access-Control-Allow-Headers", "Origin, X-Requested-With, Content-Type, Accept");
+    response.header("Access-Control-Allow-Headers", "Origin, X-Requested-With, Content-Type, Accept, X-Trace-Id");
+    response.header("Access-Control-Expose-Headers", "X-Trace-Id");
     next();
 });
 
@@ -41,7 +51,8 @@ router.get('/', function(request, response){
       message: 'Readmission Risk Patient Select api is running.',
       availableResources: [
           '/ This screen',
-          '/discharge-patients GET discharged-patient[]'
+          '/discharge-patients GET discharged-patient[]',
+          '/patient-view?admissionIDs=[...]&readmissionData=false GET records, risk scores and reference data of the admissions'
       ]
   });
 });
@@ -68,6 +79,64 @@ router.route('/discharge-patients')
     });
 
 
+/*
+The records, risk scores and reference data of a list of admissions in one response, gathered from
+record-getter and reference-data concurrently (see app/patient-view.js). Without admissionIDs the
+admissions of the discharge-patients collection are used. 'referenceData' holds the reference data
+of the age buckets of the admissions, keyed by their 'referenceBucket'. readmissionData=false leaves
+out the readmission rates. A backend that fails or times out leaves its part null and sets 'partial'.
+*/
+function parseAdmissionIDs(value){
+    var admissionIDs = typeof value === 'string' ? JSON.parse(value) : value;
+    if(!Array.isArray(admissionIDs) || !admissionIDs.every(Number.isInteger)){
+        throw new Error('admissionIDs must be an array of integers');
+    }
+    return admissionIDs;
+}
+
+function sendPatientView(request, response, admissionIDs){
+    var traceId = request.get('X-Trace-Id') || crypto.randomBytes(16).toString('hex');
+    var options = {readmissionData: request.query.readmissionData !== 'false'};
+    response.header('X-Trace-Id', traceId);
+    patientView.get(admissionIDs, options, traceId, function(view){
+        response.header('Cache-Control', 'no-store');
+        // Partial views are still answered, only a view without any of its parts is an error
+        var anything = view.patients || view.readmissionData;
+        response.status(anything ? 200 : 502).json(view);
+    });
+}
+
+router.route('/patient-view')
+    .get(function (request, response){
+        var admissionIDs;
+        if(request.query.admissionIDs === undefined){
+            return DischargePatient.find({}, {HADM_ID: 1, hadm_id: 1}).lean().exec(function(error, patients){
+                if(error){
+                    return response.status(500).send(error);
+                }
+                sendPatientView(request, response, patients.map(function(patient){
+                    return patient.HADM_ID || patient.hadm_id;
+                }));
+            });
+        }
+        try{
+            admissionIDs = parseAdmissionIDs(request.query.admissionIDs);
+        } catch(error){
+            return response.status(400).json({message: error.message});
+        }
+        sendPatientView(request, response, admissionIDs);
+    })
+    .post(function (request, response){
+        var admissionIDs;
+        try{
+            admissionIDs = parseAdmissionIDs(Array.isArray(request.body) ? request.body : request.body.admissionIDs);
+        } catch(error){
+            return response.status(400).json({message: error.message});
+        }
+        sendPatientView(request, response, admissionIDs);
+    });
+
+
 //Register Routes
 app.use('/api', router);
 
@@ -6,3 +6,4 @@ export { ComorbidsDistribution } from './comorbidsDistribution';
 export { AgeDistribution } from './ageDistribution';
 export { ReferenceData } from './reference-data';
 export { ReAdmissionData } from './re-admission-data';
+export { PatientView } from './patient-view';
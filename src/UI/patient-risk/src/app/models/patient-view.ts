@@ -0,0 +1,7 @@
+import { Patient } from './patient';
+import { ReferenceData } from './reference-data';
+
+export class PatientView {
+  public patient: Patient;
+  public referenceData: ReferenceData;
+}
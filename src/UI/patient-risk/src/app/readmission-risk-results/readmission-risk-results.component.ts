@@ -1,5 +1,5 @@
 import { Component, OnInit, OnDestroy } from '@angular/core';
-import { PatientService, ReAdmissionService } from '../services';
+import { PatientService } from '../services';
 import { Patient } from "../models/patient";
 import { Router, ActivatedRoute } from '@angular/router';
 import { CHART_DIRECTIVES } from 'angular2-highcharts';
@@ -13,7 +13,7 @@ import { Subscription } from 'rxjs';
   selector: 'pk-readmission-risk-results',
   templateUrl: 'readmission-risk-results.component.html',
   styleUrls: ['readmission-risk-results.css'],
-  providers: [PatientService, ReAdmissionService],
+  providers: [PatientService],
   directives: [RiskLegendComponent, CHART_DIRECTIVES]
 })
 export class ReadmissionRiskResultsComponent implements OnInit, OnDestroy {
@@ -32,10 +32,8 @@ export class ReadmissionRiskResultsComponent implements OnInit, OnDestroy {
   private ageToolTip: string;
 
   private patientSubscription: Subscription;
-  private referenceDataSubscription: Subscription;
 
-  constructor(private patientService: PatientService, private readmissionService: ReAdmissionService,
-              private router: Router, private activatedRouter: ActivatedRoute) {
+  constructor(private patientService: PatientService, private router: Router, private activatedRouter: ActivatedRoute) {
        this.admissionId = this.activatedRouter.snapshot.params['admissionId'];
        this.marker = 'url(/app/readmission-risk-results/marker.png)';
        this.infoIcon = '/app/readmission-risk-results/info16.png';
@@ -47,20 +45,18 @@ export class ReadmissionRiskResultsComponent implements OnInit, OnDestroy {
   };
 
     public ngOnInit() {
-      this.patientSubscription = this.patientService.getAllPatients()
+      this.patientSubscription = this.patientService.getPatientView(this.admissionId)
         .subscribe(
-          patients => {
-              this.patient = patients.find(patient => patient.hadm_id == this.admissionId);
-
-             this.referenceDataSubscription = this.readmissionService.getReferenceData(this.patient.age)
-                .subscribe(
-                  referenceData =>{
-                    this.severityChart(referenceData.comorbidSeverities);
-                    this.mortalityChart(referenceData.comorbidMortalities);
-                    this.ageChart(referenceData.ages);
-                  },
-                  e => this.errorMessage = e
-                );
+          patientView => {
+            this.patient = patientView.patient;
+            let referenceData = patientView.referenceData;
+            if (!referenceData){
+              this.errorMessage = 'The reference data is not available';
+              return;
+            }
+            this.severityChart(referenceData.comorbidSeverities);
+            this.mortalityChart(referenceData.comorbidMortalities);
+            this.ageChart(referenceData.ages);
           },
           error => this.errorMessage = error
         );
@@ -70,10 +66,6 @@ export class ReadmissionRiskResultsComponent implements OnInit, OnDestroy {
       if(!this.patientSubscription.isUnsubscribed){
         this.patientSubscription.unsubscribe();
       }
-
-      if(!this.referenceDataSubscription.isUnsubscribed){
-        this.referenceDataSubscription.unsubscribe();
-      }
     }
 
   public backToPatientSelect(){
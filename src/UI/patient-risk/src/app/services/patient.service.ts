@@ -1,7 +1,8 @@
 import { Injectable } from '@angular/core';
-import { Http, Response, Headers } from '@angular/http';
+import { Http, Response, Headers, URLSearchParams } from '@angular/http';
 import { Observable } from 'rxjs/Rx';
-import { Patient } from '../models';
+import { Patient, PatientView } from '../models';
+import { referenceDataFromJson } from './readmission.service';
 
 @Injectable()
 export class PatientService {
@@ -19,6 +20,23 @@ export class PatientService {
     return patients$;
   }
 
+  // The patient and the reference data of their age in one request, see patient-risk-api
+  public getPatientView(admissionId: number): Observable<PatientView>{
+    let params: URLSearchParams = new URLSearchParams();
+    params.set('admissionIDs', JSON.stringify([Number(admissionId)]));
+    // The results screen does not show the readmission rates
+    params.set('readmissionData', 'false');
+
+    let patientView$ = this.http
+      .get(`${this.basePatientUri + 'patient-view'}`, {
+        headers: this.getHeaders(),
+        search: params
+      })
+      .map(toPatientView)
+      .catch(handleError);
+    return patientView$;
+  }
+
   private getHeaders(){
     let headers = new Headers();
     headers.append('Accept', 'application/json');
@@ -32,6 +50,20 @@ function mapPatients(response: Response): Array<Patient>{
   return patients;
 }
 
+function toPatientView(response: Response): PatientView{
+  let responseJson = response.json();
+  if (!responseJson.patients || responseJson.patients.length === 0){
+    throw new Error(responseJson.errors.records || 'Admission not found');
+  }
+  let record = responseJson.patients[0];
+  let bucket = responseJson.referenceData[record.referenceBucket];
+  let patientView = <PatientView>({
+    patient: toPatient(record),
+    referenceData: bucket.data ? referenceDataFromJson(bucket.data) : null
+  });
+  return patientView;
+}
+
 function toPatient(response: any): Patient{
   let riskScoreColor = '#333333'; //dark grey
   let riskScore = response.readmissionRisk;
@@ -53,9 +53,11 @@ function toReAdmissionData(response: Response): ReAdmissionData{
 }
 
 function toReferenceData(response: any) : ReferenceData{
-  let referenceData = new ReferenceData();
+  return referenceDataFromJson(response.json());
+}
 
-  let responseJson = response.json();
+export function referenceDataFromJson(responseJson: any) : ReferenceData{
+  let referenceData = new ReferenceData();
 
   referenceData.ages.allAges = responseJson.ages; //array of ages
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+'''
+A typed, columnar binary copy of a delimited text file that can be memory-mapped.
+
+The cache of 'data/discharge-admissions.psv' is the directory 'data/discharge-admissions.psv.cols'
+with one .npy file per column and a meta.json describing them:
+
+    numeric columns     - the dtype pandas infers, with the id columns narrowed to int32
+    date columns        - datetime64[s], parsed once with an explicit format
+    string columns      - int32 codes into the list of distinct values kept in meta.json
+
+load_columns and load_frame convert the text file the first time it is read and again whenever it
+is modified after its cache was written, so the cache never has to be built by hand. The processes
+that read the same file take a lock next to its cache (data/discharge-admissions.psv.cols.lock),
+so only one of them converts it and none reads a cache that is being replaced. The conversion can
+also be run ahead of time:
+
+    python columnar_cache.py data/discharge-admissions.psv --delimiter '|' --dates ADMITTIME,DISCHTIME --ids HADM_ID,SUBJECT_ID
+'''
+import os
+import json
+import fcntl
+import shutil
+import argparse
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+
+# Bumped when the layout of the cache changes, so that old caches are rebuilt
+cacheVersion = 1
+
+# Format of the dates in the PSVs, e.g. 04/09/2196 12:26:00 PM
+dateFormat = '%m/%d/%Y %I:%M:%S %p'
+
+
+def cache_path(sourcePath):
+    return sourcePath + '.cols'
+
+
+@contextmanager
+def cache_lock(sourcePath, shared=False):
+    '''
+    Holds the lock of the cache of a file, shared by the readers and exclusive for convert. flock
+    locks conflict between the threads of a process as well as between processes, as each call
+    opens the file again.
+    '''
+    with open(cache_path(sourcePath) + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def parse_dates(values, dateFormat=dateFormat):
+    '''
+    Input: a pandas Series of date strings
+    Output: a numpy datetime64[s] array, NaT where a value is missing
+    Description: parses with the explicit format and only falls back to pandas' format inference
+    for the values that do not match it.
+    '''
+    parsed = pd.to_datetime(values, format=dateFormat, errors='coerce')
+    failed = parsed.isnull() & values.notnull()
+    if failed.any():
+        parsed[failed] = pd.to_datetime(values[failed], errors='coerce')
+    # Seconds rather than nanoseconds, so that the ~300 year shift of the dates of birth of
+    # patients older than 89 does not overflow when subtracted
+    return parsed.values.astype('datetime64[s]')
+
+
+def options_of(delimiter, dateCols, idCols):
+    return {'delimiter': delimiter, 'dateCols': sorted(dateCols), 'idCols': sorted(idCols)}
+
+
+def convert(sourcePath, delimiter=',', dateCols=(), idCols=(), dateFormat=dateFormat):
+    '''
+    Input: a delimited text file, its delimiter, the columns holding dates and the id columns
+    Output: the path of the cache directory written for it
+    Description: when another process converted the file while this one waited for the lock, its
+    cache is used as it is.
+    '''
+    with cache_lock(sourcePath):
+        if is_fresh(read_meta(sourcePath), sourcePath, delimiter, dateCols, idCols):
+            return cache_path(sourcePath)
+        return write_cache(sourcePath, delimiter, dateCols, idCols, dateFormat)
+
+
+def write_cache(sourcePath, delimiter, dateCols, idCols, dateFormat):
+    sourceMtime = os.path.getmtime(sourcePath)
+    df = pd.read_csv(sourcePath, delimiter=delimiter, na_values=['null'])
+    path = cache_path(sourcePath)
+    tmpPath = path + '.tmp-{0}'.format(os.getpid())
+    if os.path.isdir(tmpPath):
+        shutil.rmtree(tmpPath)
+    os.makedirs(tmpPath)
+
+    columns = []
+    for ix, name in enumerate(df.columns):
+        values = df[name]
+        column = {'name': name, 'file': '{0}.npy'.format(ix)}
+        if name in dateCols:
+            column['kind'] = 'date'
+            data = parse_dates(values, dateFormat)
+        elif values.dtype == object:
+            column['kind'] = 'string'
+            codes, categories = pd.factorize(values)
+            data = codes.astype(np.int32)
+            column['categories'] = categories.tolist()
+        else:
+            column['kind'] = 'numeric'
+            data = values.values
+            if name in idCols and not values.isnull().any():
+                data = data.astype(np.int32)
+        np.save(os.path.join(tmpPath, column['file']), data)
+        columns.append(column)
+
+    with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+        json.dump({'cacheVersion': cacheVersion,
+                   'sourceMtime': sourceMtime,
+                   'numRows': len(df),
+                   'options': options_of(delimiter, dateCols, idCols),
+                   'columns': columns}, f)
+
+    # Swap the new cache in. Readers hold the shared lock while they open the columns, so none of
+    # them looks for the cache between the two renames
+    oldPath = path + '.old-{0}'.format(os.getpid())
+    if os.path.isdir(path):
+        os.rename(path, oldPath)
+    os.rename(tmpPath, path)
+    if os.path.isdir(oldPath):
+        shutil.rmtree(oldPath)
+    return path
+
+
+def read_meta(sourcePath):
+    try:
+        with open(os.path.join(cache_path(sourcePath), 'meta.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def is_fresh(meta, sourcePath, delimiter, dateCols, idCols):
+    return meta is not None \
+        and meta['cacheVersion'] == cacheVersion \
+        and meta['sourceMtime'] >= os.path.getmtime(sourcePath) \
+        and meta['options'] == options_of(delimiter, dateCols, idCols)
+
+
+def load_columns(sourcePath, delimiter=',', dateCols=(), idCols=(), mmap=True):
+    '''
+    Input: a delimited text file and the options of convert
+    Output: an ordered list of (column name, values) where values is a numpy array, or a
+    pandas Categorical for string columns
+    Description: the numeric and date columns are memory-mapped read-only from the cache, which is
+    rebuilt first when it is missing or older than the text file.
+    '''
+    while True:
+        with cache_lock(sourcePath, shared=True):
+            meta = read_meta(sourcePath)
+            if is_fresh(meta, sourcePath, delimiter, dateCols, idCols):
+                return read_columns(cache_path(sourcePath), meta, mmap)
+        convert(sourcePath, delimiter, dateCols, idCols)
+
+
+def read_columns(path, meta, mmap):
+    columns = []
+    for column in meta['columns']:
+        data = np.load(os.path.join(path, column['file']), mmap_mode='r' if mmap else None)
+        if column['kind'] == 'string':
+            data = pd.Categorical.from_codes(data, column['categories'])
+        columns.append((str(column['name']), data))
+    return columns
+
+
+def load_frame(sourcePath, delimiter=',', dateCols=(), idCols=()):
+    '''
+    Input: a delimited text file and the options of convert
+    Output: a pandas DataFrame of the file, with categorical string columns
+    '''
+    columns = load_columns(sourcePath, delimiter, dateCols, idCols, mmap=False)
+    return pd.DataFrame(dict(columns), columns=[name for name, _ in columns])
+
+
+def parse_list(value):
+    return [v for v in value.split(',') if v]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a delimited text file to a columnar cache.')
+    parser.add_argument('source')
+    parser.add_argument('--delimiter', default=',')
+    parser.add_argument('--dates', type=parse_list, default=[], help='comma separated date columns')
+    parser.add_argument('--ids', type=parse_list, default=[], help='comma separated int32 id columns')
+    args = parser.parse_args()
+    print "Wrote {0}".format(convert(args.source, args.delimiter, args.dates, args.ids))
@@ -0,0 +1,208 @@
+import json
+import fcntl
+import threading
+import time
+import Queue
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from contextlib import contextmanager
+from columnar_cache import parse_dates
+from mongo_sync import ensure_indexes, read_existing, upsert_documents, remove_documents
+from instrumentation import observe_stage, trace_headers
+
+
+# Fields of the patient documents that are stored in Mongo as dates
+dateCols = ['ADMITTIME', 'DISCHTIME', 'DOB']
+
+
+def convert_dates(docs, dateCols=dateCols):
+    '''
+    Input: a list of patient documents with dates as strings
+    Description: parses each date field of all the documents at once, rather than one strptime
+    call per value, and replaces the strings with datetimes (None where the date is missing).
+    '''
+    for col in dateCols:
+        values = pd.Series([doc.get(col) for doc in docs], dtype=object)
+        for doc, value in zip(docs, parse_dates(values).tolist()):
+            doc[col] = value
+
+
+class IngestBusy(Exception):
+    '''
+    Raised when another run did not finish within the lock timeout.
+    '''
+    pass
+
+
+class StageTimer(object):
+    '''
+    The time spent and the number of documents handled by one stage of the pipeline, which are
+    also recorded as the metrics of the stage 'ingest_<name>'.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.docs = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds, docs):
+        with self._lock:
+            self.seconds += seconds
+            self.docs += docs
+        observe_stage('ingest_' + self.name, seconds, docs)
+
+    def stats(self):
+        return {'seconds': round(self.seconds, 3),
+                'docs': self.docs,
+                'docsPerSecond': round(self.docs / self.seconds, 1) if self.seconds else None}
+
+
+class IngestPipeline(object):
+    '''
+    Copies the records of a list of admissions from record-getter into a Mongo collection.
+    The ids are split into chunks of chunkSize that 'concurrency' threads fetch from record-getter
+    over a shared pool of connections, while the calling thread converts the dates of the chunks
+    that have arrived and upserts them into Mongo, so network and database time overlap. Each
+    chunk is compared with the documents stored for its own admissions. At most 2 * concurrency
+    fetched chunks wait to be written, which bounds memory whatever the number of admissions; the
+    collection itself is only read for the HADM_IDs to remove. Once every chunk has been written, the documents of admissions that are not in the
+    list are removed; when a chunk could not be fetched nothing is removed.
+
+    Runs are serialized with an flock on lockPath, which holds between the threads of a process
+    and between the gunicorn workers that share the file: two concurrent runs would upsert the
+    same admissions and remove each other's documents. A run that cannot take the lock within
+    lockTimeout seconds raises IngestBusy.
+    '''
+
+    def __init__(self, recordGetterURL, collection, chunkSize=100, concurrency=4, timeout=30, batchSize=1000,
+                 lockPath='data/ingest.lock', lockTimeout=5):
+        self.recordGetterURL = recordGetterURL.rstrip('/')
+        self.collection = collection
+        self.chunkSize = chunkSize
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.batchSize = batchSize
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lockPath = lockPath
+        self.lockTimeout = lockTimeout
+
+    def fetch_chunk(self, admissionIDs, headers=None):
+        '''
+        Input: a list of admission ids, and the headers to send with them
+        Output: the patient documents record-getter returns for them
+        '''
+        response = self.session.get(self.recordGetterURL + '/v1/get-records',
+                                    params={'admissionIDs': json.dumps(admissionIDs), 'format': 'ndjson'},
+                                    headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return [json.loads(line)['patientInfo'] for line in response.iter_lines() if line]
+
+    def _fetch(self, chunks, results, fetchTimer, headers, cancelled):
+        '''
+        Fetches chunks until there are none left or the run is cancelled. Every chunk taken gets
+        a result, with the error when it could not be fetched, so the run never waits for a chunk
+        that will not come.
+        '''
+        while not cancelled.is_set():
+            try:
+                chunk = chunks.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                docs, error = self.fetch_chunk(chunk, headers), None
+            except Exception as e:
+                docs, error = [], e
+            fetchTimer.add(time.time() - start, len(docs))
+            # The run stops taking results when it fails, give up rather than wait for it
+            while not cancelled.is_set():
+                try:
+                    results.put((chunk, docs, error), timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+
+    def run(self, admissionIDs):
+        '''
+        Input: a list of admission ids
+        Output: a dict with the number of documents inserted, updated, removed and left unchanged,
+        the number of chunks that failed and the time and throughput of each stage
+        '''
+        with self.run_lock():
+            return self._run(admissionIDs)
+
+    @contextmanager
+    def run_lock(self):
+        with open(self.lockPath, 'a') as f:
+            deadline = time.time() + self.lockTimeout
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError:
+                    if time.time() >= deadline:
+                        raise IngestBusy("Another ingestion has been running for more than {0} seconds".format(self.lockTimeout))
+                    time.sleep(0.05)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _run(self, admissionIDs):
+        start = time.time()
+        # Each admission is fetched once, in the order of the list
+        admissionIDs = [int(admissionID) for admissionID in pd.unique(pd.Series(admissionIDs))]
+        chunks = Queue.Queue()
+        numChunks = 0
+        for i in xrange(0, len(admissionIDs), self.chunkSize):
+            chunks.put(admissionIDs[i:i + self.chunkSize])
+            numChunks += 1
+        results = Queue.Queue(maxsize=2 * self.concurrency)
+        cancelled = threading.Event()
+        timers = {name: StageTimer(name) for name in ('fetch', 'convert', 'write')}
+        # The fetching threads are outside of the request, the trace id is taken here
+        headers = trace_headers()
+
+        for i in xrange(min(self.concurrency, numChunks)):
+            thread = threading.Thread(target=self._fetch, args=(chunks, results, timers['fetch'], headers, cancelled),
+                                      name='ingest-fetch-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+        counts = {'inserted': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'failedChunks': 0}
+        keepIDs = set()
+        try:
+            ensure_indexes(self.collection)
+            for _ in xrange(numChunks):
+                chunk, docs, error = results.get()
+                if error is not None:
+                    print "Fetching {0} records failed: {1}".format(len(chunk), error)
+                    counts['failedChunks'] += 1
+                    continue
+                stageStart = time.time()
+                convert_dates(docs)
+                timers['convert'].add(time.time() - stageStart, len(docs))
+
+                stageStart = time.time()
+                existingDocs = read_existing(self.collection, [doc['HADM_ID'] for doc in docs], self.batchSize)
+                for name, count in upsert_documents(self.collection, docs, existingDocs, self.batchSize).iteritems():
+                    counts[name] += count
+                timers['write'].add(time.time() - stageStart, len(docs))
+                keepIDs.update(doc['HADM_ID'] for doc in docs)
+        finally:
+            # Stops the fetching threads when the run failed, they exit on their own otherwise
+            cancelled.set()
+
+        if counts['failedChunks'] == 0:
+            stageStart = time.time()
+            counts['removed'] = remove_documents(self.collection, keepIDs, self.batchSize)
+            timers['write'].add(time.time() - stageStart, 0)
+
+        counts['stages'] = {name: timer.stats() for name, timer in timers.iteritems()}
+        counts['seconds'] = round(time.time() - start, 3)
+        return counts
@@ -0,0 +1,114 @@
+from pymongo import ASCENDING, DeleteMany, ReplaceOne
+
+
+def ensure_indexes(collection):
+    '''
+    Input: a pymongo Collection of patient documents
+    Description: creates the indexes the sync and the readers of the collection look documents up
+    by, if they do not exist yet. Collections written before the HADM_ID index was unique can hold
+    the same admission more than once; the duplicates are removed before the index is created.
+    '''
+    hadmIndexes = [(name, index) for name, index in collection.index_information().iteritems()
+                   if index['key'] == [('HADM_ID', ASCENDING)]]
+    if not any(index.get('unique') for _, index in hadmIndexes):
+        removed = remove_duplicates(collection)
+        if removed:
+            print "Removed {0} duplicate documents before creating the unique HADM_ID index".format(removed)
+        for name, _ in hadmIndexes:
+            collection.drop_index(name)
+        collection.create_index([('HADM_ID', ASCENDING)], unique=True)
+    collection.create_index([('SUBJECT_ID', ASCENDING)])
+
+
+def remove_duplicates(collection):
+    '''
+    Input: a pymongo Collection of patient documents
+    Output: the number of documents removed
+    Description: keeps the document of each HADM_ID that was inserted last, the one with the
+    highest _id, and removes the others.
+    '''
+    duplicates = collection.aggregate([
+        {'$group': {'_id': '$HADM_ID', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ])
+    removedIDs = []
+    for duplicate in duplicates:
+        removedIDs.extend(sorted(duplicate['ids'])[:-1])
+    if not removedIDs:
+        return 0
+    return collection.delete_many({'_id': {'$in': removedIDs}}).deleted_count
+
+
+def read_existing(collection, admissionIDs, batchSize=1000):
+    '''
+    Input: a pymongo Collection, the HADM_IDs to look up and the number of ids per query
+    Output: a dict of HADM_ID to the document stored for it, without its _id, for the ids that
+    are in the collection
+    '''
+    admissionIDs = list(admissionIDs)
+    existingDocs = {}
+    for i in xrange(0, len(admissionIDs), batchSize):
+        for doc in collection.find({'HADM_ID': {'$in': admissionIDs[i:i + batchSize]}}, {'_id': False}):
+            existingDocs[doc['HADM_ID']] = doc
+    return existingDocs
+
+
+def bulk_write(collection, operations, batchSize):
+    '''
+    Output: the number of documents upserted, modified and deleted by the operations
+    '''
+    upserted, modified, deleted = 0, 0, 0
+    for i in xrange(0, len(operations), batchSize):
+        result = collection.bulk_write(operations[i:i + batchSize], ordered=False)
+        upserted += result.upserted_count
+        modified += result.modified_count
+        deleted += result.deleted_count
+    return upserted, modified, deleted
+
+
+def upsert_documents(collection, docs, existingDocs, batchSize=1000):
+    '''
+    Input: a pymongo Collection, patient documents, the documents already stored for them as
+    returned by read_existing and the number of operations sent per bulk write
+    Output: a dict with the number of documents inserted, updated and left unchanged
+    '''
+    operations = []
+    unchanged = 0
+    for doc in docs:
+        if existingDocs.get(doc['HADM_ID']) == doc:
+            unchanged += 1
+            continue
+        operations.append(ReplaceOne({'HADM_ID': doc['HADM_ID']}, doc, upsert=True))
+    inserted, updated, _ = bulk_write(collection, operations, batchSize)
+    return {'inserted': inserted, 'updated': updated, 'unchanged': unchanged}
+
+
+def remove_documents(collection, keepIDs, batchSize=1000):
+    '''
+    Input: a pymongo Collection, the HADM_IDs to keep and the number of ids deleted per operation
+    Output: the number of documents removed
+    Description: only the HADM_IDs of the collection are read, not its documents.
+    '''
+    removedIDs = [doc['HADM_ID'] for doc in collection.find({}, {'HADM_ID': True, '_id': False})
+                  if doc['HADM_ID'] not in keepIDs]
+    operations = [DeleteMany({'HADM_ID': {'$in': removedIDs[i:i + batchSize]}})
+                  for i in xrange(0, len(removedIDs), batchSize)]
+    return bulk_write(collection, operations, batchSize)[2]
+
+
+def sync_documents(collection, docs, batchSize=1000):
+    '''
+    Input: a pymongo Collection, the list of patient documents it should hold and the number of
+    operations sent per bulk write
+    Output: a dict with the number of documents inserted, updated, removed and left unchanged
+    Description: compares the documents with the ones already in the collection by HADM_ID and only
+    writes the difference, as unordered bulk writes of upserts and deletes. Unlike emptying the
+    collection and inserting every document again, readers never see an empty or partial
+    collection and unchanged documents cost no round trip.
+    '''
+    ensure_indexes(collection)
+    newDocs = {doc['HADM_ID']: doc for doc in docs}
+    existingDocs = read_existing(collection, newDocs, batchSize)
+    counts = upsert_documents(collection, newDocs.values(), existingDocs, batchSize)
+    counts['removed'] = remove_documents(collection, newDocs, batchSize)
+    return counts
@@ -0,0 +1,76 @@
+'''
+Tests of the diff-based sync of the patient collection, against mongomock's stand-in for MongoDB.
+They are skipped when mongomock is not installed:
+
+    python -m unittest test_mongo_sync
+'''
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def patient(admissionID, severity=2.0):
+    return {'HADM_ID': admissionID, 'SUBJECT_ID': admissionID + 1000, 'DRG_SEVERITY': severity}
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class SyncDocumentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.dischargepatients
+
+    def sync(self, docs):
+        from mongo_sync import sync_documents
+        # Copies, as the collection adds an _id to the documents it inserts
+        return sync_documents(self.collection, [dict(doc) for doc in docs], batchSize=2)
+
+    def stored(self):
+        return sorted(self.collection.find({}, {'_id': False}), key=lambda doc: doc['HADM_ID'])
+
+    def test_first_sync(self):
+        docs = [patient(i) for i in range(5)]
+        counts = self.sync(docs)
+        self.assertEqual(counts, {'inserted': 5, 'updated': 0, 'removed': 0, 'unchanged': 0})
+        self.assertEqual(self.stored(), docs)
+
+    def test_resync_without_changes(self):
+        docs = [patient(i) for i in range(5)]
+        self.sync(docs)
+        counts = self.sync(docs)
+        self.assertEqual(counts, {'inserted': 0, 'updated': 0, 'removed': 0, 'unchanged': 5})
+        self.assertEqual(self.stored(), docs)
+
+    def test_partial_change(self):
+        self.sync([patient(i) for i in range(5)])
+        docs = [patient(i) for i in range(5)]
+        docs[1] = patient(1, severity=4.0)
+        docs.append(patient(5))
+        counts = self.sync(docs)
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'removed': 0, 'unchanged': 4})
+        self.assertEqual(self.stored(), docs)
+
+    def test_removal(self):
+        self.sync([patient(i) for i in range(5)])
+        docs = [patient(i) for i in [0, 2, 4]]
+        counts = self.sync(docs)
+        self.assertEqual(counts, {'inserted': 0, 'updated': 0, 'removed': 2, 'unchanged': 3})
+        self.assertEqual(self.stored(), docs)
+
+    def test_duplicates_are_removed_before_the_unique_index(self):
+        # As written by the insert_one loop that came before the sync
+        self.collection.insert_one(patient(1, severity=1.0))
+        self.collection.insert_one(patient(1, severity=3.0))
+        self.collection.insert_one(patient(2))
+        counts = self.sync([patient(1, severity=3.0), patient(2)])
+        self.assertEqual(counts, {'inserted': 0, 'updated': 0, 'removed': 0, 'unchanged': 2})
+        self.assertEqual(self.stored(), [patient(1, severity=3.0), patient(2)])
+        unique = [index for index in self.collection.index_information().values()
+                  if index['key'] == [('HADM_ID', 1)] and index.get('unique')]
+        self.assertEqual(len(unique), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+A stand-in for the risk-scorer API that answers /v1/score, /v1/score-patients and /v2/score without
+Spark or a model.
+The risk of an admission is derived from its id, so the same id always gets the same score, and
+every answer can be delayed by FAKE_SCORER_LATENCY_MS milliseconds to mimic a slower scorer.
+'''
+from flask import Flask, json, request, Response
+import numpy as np
+import time
+import os
+
+
+app = Flask(__name__)
+
+# Get the port number from the environment variable VCAP_APP_PORT
+port = int(os.getenv('VCAP_APP_PORT', 8080))
+
+# Milliseconds added to every scoring request
+latency = float(os.getenv('FAKE_SCORER_LATENCY_MS', 0)) / 1000
+
+
+def fake_risks(admissionIDs):
+    '''
+    Input: a list of admission ids
+    Output: a dict of admission id to a probability in [0, 1) that only depends on the id
+    '''
+    ids = np.asarray(admissionIDs, dtype=np.int64)
+    risks = ((ids * 2654435761) % 2 ** 32) / float(2 ** 32)
+    return {int(admissionID): {'readmissionRisk': float(risk)} for admissionID, risk in zip(ids, risks)}
+
+
+def scored(admissionIDs):
+    if latency:
+        time.sleep(latency)
+    return Response(json.dumps(fake_risks(admissionIDs)), mimetype='application/json')
+
+
+@app.route('/')
+def root():
+    return Response("I am a fake Readmission Risk Scorer. I am running on port " + str(port) + ".\n",
+                    mimetype='text/plain')
+
+
+@app.route('/v1/score', methods=['GET'])
+def score_qs():
+    return scored(json.loads(request.args.get('data')))
+
+
+@app.route('/v1/score-patients', methods=['GET'])
+def score_patients():
+    return scored(json.loads(request.args.get('admissionIDs')))
+
+
+@app.route('/v2/score', methods=['POST'])
+def score_json():
+    if request.mimetype == 'application/octet-stream':
+        return scored(np.frombuffer(request.get_data(), dtype='<i4').tolist())
+    payload = request.get_json(force=True)
+    if isinstance(payload, dict):
+        payload = payload['admissionIDs']
+    return scored(payload)
+
+
+if __name__ == '__main__':
+    app.run(host='127.0.0.1', port=port, threaded=True)
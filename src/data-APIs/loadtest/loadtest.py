@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+'''
+Starts the data services on loopback and measures the latency and throughput of each hop of the
+discharge chain:
+
+    discharge   GET  discharge-planner /v1/send-records-to-mongo  (records of 100 admissions into Mongo)
+    records     GET  record-getter     /v1/get-records            (records and their scores)
+    scorer      POST risk-scorer       /v2/score                  (scores)
+    reference   GET  reference-data    /v1/get-reference-data
+
+    python loadtest.py --concurrency 1,8,32 --duration 20 --output run.jsonl
+    python loadtest.py --compare baseline.jsonl run.jsonl
+
+discharge-planner writes to an in-memory Mongo (mongo_standin.py), and the risk-scorer is replaced
+by fake_scorer.py unless --scorer local starts the real one, which needs Spark and a model, or
+--scorer-url points at a running one. The services are started with their gunicorn settings
+(--serving-mode prefork, --workers each) or as 'python server.py' (--serving-mode dev).
+
+Each hop is loaded on its own, by --concurrency threads that send requests one after the other
+for --duration seconds after --warmup seconds whose requests are not counted, so the latency of a
+hop includes the hops it calls but not load from the others. Every measurement is written as one
+JSON line.
+'''
+import os
+import sys
+import csv
+import json
+import time
+import signal
+import argparse
+import datetime
+import platform
+import threading
+import subprocess
+import numpy as np
+import requests
+
+
+servicesDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+loadtestDir = os.path.dirname(os.path.abspath(__file__))
+admissionIDsPath = os.path.join(servicesDir, 'discharge-planner', 'data', 'admission-ids.csv')
+
+# Port of each service, added to --base-port
+portOffsets = {'record-getter': 1, 'discharge-planner': 2, 'reference-data': 3, 'risk-scorer': 4}
+
+# Percentiles of the latencies reported for every hop
+percentiles = [50, 95, 99]
+
+
+class ServiceProcess(object):
+    '''
+    A service running in its own process group on loopback, with its output in logDir.
+    '''
+
+    def __init__(self, name, command, cwd, env, port, logDir):
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.url = 'http://127.0.0.1:{0}'.format(port)
+        self.logPath = os.path.join(logDir, name + '.log')
+        self.process = None
+
+    def start(self):
+        log = open(self.logPath, 'w')
+        # A process group of its own, so the workers or reloader it starts are stopped with it
+        self.process = subprocess.Popen(self.command, cwd=self.cwd, env=self.env, stdout=log,
+                                        stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        log.close()
+
+    def wait_ready(self, timeout):
+        '''
+        Waits until the service answers on its root route.
+        Raises RuntimeError when it exits or does not answer within timeout seconds.
+        '''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("{0} exited with {1}, see {2}".format(self.name, self.process.returncode,
+                                                                         self.logPath))
+            try:
+                if requests.get(self.url + '/', timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError("{0} did not start within {1}s, see {2}".format(self.name, timeout, self.logPath))
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        os.killpg(self.process.pid, signal.SIGTERM)
+        deadline = time.time() + 10
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+
+
+def gunicorn_command(args):
+    # The gunicorn installed next to this python, if any
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    return [gunicorn if os.path.exists(gunicorn) else 'gunicorn'] + args
+
+
+def start_services(args, logDir):
+    '''
+    Output: a dict of service name to its started ServiceProcess, and the URL of the scorer
+    '''
+    urls = {name: 'http://127.0.0.1:{0}'.format(args.base_port + offset) for name, offset in portOffsets.iteritems()}
+    scorerURL = args.scorer_url or urls['risk-scorer']
+    env = dict(os.environ, PYTHONUNBUFFERED='1', WEB_CONCURRENCY=str(args.workers),
+               WEB_THREADS=str(args.threads), RISK_SCORER_URL=scorerURL, FAKE_SCORER_LATENCY_MS=str(args.scorer_latency))
+    # discharge-planner reads these from variables named after their place in VCAP_SERVICES
+    env["['VCAP_SERVICES']['app1'][0]['credentials']['uri']"] = urls['record-getter']
+    env["['VCAP_SERVICES']['mongodb30'][0]['credentials']['uri']"] = 'mongodb://127.0.0.1/loadtest'
+
+    prefork = args.serving_mode == 'prefork'
+    serve = gunicorn_command(['-c', 'gunicorn.conf.py', 'server:app']) if prefork else [sys.executable, 'server.py']
+    standin = [sys.executable, os.path.join(loadtestDir, 'mongo_standin.py')]
+    commands = {'record-getter': serve,
+                'reference-data': serve,
+                'discharge-planner': standin + (['-c', 'gunicorn.conf.py', 'server:app'] if prefork else [])}
+    if args.scorer_url is None:
+        if args.scorer == 'local':
+            commands['risk-scorer'] = serve
+        else:
+            commands['risk-scorer'] = [sys.executable, os.path.join(loadtestDir, 'fake_scorer.py')]
+
+    services = {}
+    try:
+        for name, command in sorted(commands.iteritems()):
+            serviceEnv = dict(env, VCAP_APP_PORT=str(args.base_port + portOffsets[name]))
+            services[name] = ServiceProcess(name, command, os.path.join(servicesDir, name), serviceEnv,
+                                            args.base_port + portOffsets[name], logDir)
+            services[name].start()
+        for name in sorted(services):
+            services[name].wait_ready(args.startup_timeout)
+            print >> sys.stderr, "{0} is up at {1}".format(name, services[name].url)
+    except Exception:
+        stop_services(services)
+        raise
+    return services, scorerURL
+
+
+def stop_services(services):
+    for service in services.values():
+        service.stop()
+
+
+def read_admission_ids(path=admissionIDsPath):
+    with open(path) as f:
+        reader = csv.reader(f)
+        col = next(reader).index('HADM_ID')
+        return np.array([int(row[col]) for row in reader if row], dtype=np.int64)
+
+
+def hop_requests(urls, admissionIDs, idsPerRequest, timeout):
+    '''
+    Output: a dict of hop name to a function that sends one request of that hop with a session
+    and a random generator, and returns the response
+    '''
+    def discharge(session, rng):
+        return session.get(urls['discharge-planner'] + '/v1/send-records-to-mongo', timeout=timeout)
+
+    def records(session, rng):
+        ids = rng.choice(admissionIDs, idsPerRequest).tolist()
+        return session.get(urls['record-getter'] + '/v1/get-records',
+                           params={'admissionIDs': json.dumps(ids), 'format': 'ndjson'}, timeout=timeout)
+
+    def scorer(session, rng):
+        return session.post(urls['risk-scorer'] + '/v2/score', json=rng.choice(admissionIDs, idsPerRequest).tolist(),
+                            timeout=timeout)
+
+    def reference(session, rng):
+        return session.get(urls['reference-data'] + '/v1/get-reference-data',
+                           params={'ages': rng.randint(0, 90)}, headers={'Accept-Encoding': 'gzip'}, timeout=timeout)
+
+    return {'discharge': discharge, 'records': records, 'scorer': scorer, 'reference': reference}
+
+
+def drive(send, concurrency, warmup, duration, timeout):
+    '''
+    Input: the function sending one request, the number of threads sending them, the seconds of
+    warm-up and of measurement, and the timeout of a request
+    Output: the latencies in seconds of the requests that succeeded during the measurement, the
+    number of failed ones and the seconds the measurement lasted
+    '''
+    start = time.time() + warmup
+    stop = start + duration
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def run(seed):
+        session = requests.Session()
+        rng = np.random.RandomState(seed)
+        threadLatencies, threadErrors = [], 0
+        while True:
+            requestStart = time.time()
+            if requestStart >= stop:
+                break
+            try:
+                response = send(session, rng)
+                response.content
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            if requestStart >= start:
+                if ok:
+                    threadLatencies.append(time.time() - requestStart)
+                else:
+                    threadErrors += 1
+        with lock:
+            latencies.extend(threadLatencies)
+            errors[0] += threadErrors
+
+    threads = [threading.Thread(target=run, args=(seed,)) for seed in xrange(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(warmup + duration + timeout)
+    return np.array(latencies), errors[0], time.time() - start
+
+
+def record(results, hop, concurrency, latencies, numErrors, seconds):
+    result = {'hop': hop,
+              'concurrency': concurrency,
+              'requests': len(latencies),
+              'errors': numErrors,
+              'requestsPerSecond': len(latencies) / max(seconds, 1e-9)}
+    for p in percentiles:
+        result['p{0}Ms'.format(p)] = float(np.percentile(latencies, p)) * 1000 if len(latencies) else None
+    result['maxMs'] = float(latencies.max()) * 1000 if len(latencies) else None
+    results.append(result)
+    print >> sys.stderr, "{hop:>10} concurrency={concurrency:<4} rps={requestsPerSecond:8.1f} " \
+                         "p50={p50Ms}ms p95={p95Ms}ms p99={p99Ms}ms errors={errors}".format(
+                             **{k: round(v, 1) if isinstance(v, float) else v for k, v in result.iteritems()})
+
+
+def compare(baselinePath, currentPath, threshold):
+    '''
+    Prints the change in p95 latency and throughput of every measurement found in both runs.
+    Output: the number of measurements whose p95 grew or whose throughput fell by more than threshold
+    '''
+    def load(path):
+        with open(path) as f:
+            results = [json.loads(line) for line in f if line.strip()]
+        return {(r['hop'], r['concurrency']): r for r in results if 'hop' in r}
+    baseline, current = load(baselinePath), load(currentPath)
+    regressions = 0
+    for key in sorted(set(baseline) & set(current)):
+        before, after = baseline[key], current[key]
+        if before['p95Ms'] is None or after['p95Ms'] is None:
+            continue
+        latencyRatio = after['p95Ms'] / max(before['p95Ms'], 1e-9)
+        throughputRatio = after['requestsPerSecond'] / max(before['requestsPerSecond'], 1e-9)
+        flag = ''
+        if latencyRatio > 1 + threshold or throughputRatio < 1 - threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        print "{0:>10} concurrency={1:<4} p95 {2:6.2f}x  rps {3:6.2f}x {4}".format(key[0], key[1], latencyRatio,
+                                                                                throughputRatio, flag)
+    return regressions
+
+
+def parse_list(value):
+    return [v for v in value.split(',') if v]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the data services on loopback.')
+    parser.add_argument('--hops', type=parse_list, default=['scorer', 'records', 'discharge', 'reference'],
+                        help='comma separated hops to load')
+    parser.add_argument('--concurrency', type=lambda v: [int(c) for c in parse_list(v)], default=[1, 8, 32],
+                        help='comma separated numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=20, help='seconds measured per hop and concurrency')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of requests not measured first')
+    parser.add_argument('--ids-per-request', type=int, default=100,
+                        help='admission ids per records and scorer request')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds before a request fails')
+    parser.add_argument('--serving-mode', choices=['prefork', 'dev'], default='prefork')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers per service')
+    parser.add_argument('--threads', type=int, default=1, help='request threads per gunicorn worker')
+    parser.add_argument('--scorer', choices=['fake', 'local'], default='fake',
+                        help='run fake_scorer.py or the real risk-scorer')
+    parser.add_argument('--scorer-url', help='use a running risk-scorer instead of starting one')
+    parser.add_argument('--scorer-latency', type=float, default=0, help='milliseconds the fake scorer waits')
+    parser.add_argument('--base-port', type=int, default=18080)
+    parser.add_argument('--startup-timeout', type=float, default=180)
+    parser.add_argument('--log-dir', default='loadtest-logs', help='where the output of the services is written')
+    parser.add_argument('--output', help='JSON lines file for the results, stdout by default')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='compare two result files instead of running the load test')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='change ratio reported as a regression by --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    if not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+    admissionIDs = read_admission_ids()
+    services, scorerURL = start_services(args, args.log_dir)
+    results = []
+    try:
+        urls = {name: service.url for name, service in services.iteritems()}
+        urls['risk-scorer'] = scorerURL
+        sends = hop_requests(urls, admissionIDs, args.ids_per_request, args.timeout)
+        for hop in args.hops:
+            for concurrency in args.concurrency:
+                latencies, numErrors, seconds = drive(sends[hop], concurrency, args.warmup, args.duration,
+                                                      args.timeout)
+                record(results, hop, concurrency, latencies, numErrors, seconds)
+    finally:
+        stop_services(services)
+
+    run = {'run': {'timestamp': datetime.datetime.utcnow().isoformat(),
+                   'python': platform.python_version(),
+                   'host': platform.node(),
+                   'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                   'servingMode': args.serving_mode,
+                   'workers': args.workers,
+                   'threads': args.threads,
+                   'scorer': 'url' if args.scorer_url else args.scorer,
+                   'idsPerRequest': args.ids_per_request}}
+    output = open(args.output, 'w') if args.output else sys.stdout
+    for result in [run] + results:
+        output.write(json.dumps(result) + '\n')
+    if args.output:
+        output.close()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+'''
+Runs discharge-planner with an in-memory Mongo (mongomock) in place of pymongo's MongoClient, so
+that it can be load tested without a Mongo server. Run from the discharge-planner directory:
+
+    python ../loadtest/mongo_standin.py                                    # one process
+    python ../loadtest/mongo_standin.py -c gunicorn.conf.py server:app     # pre-forked workers
+
+Every process that connects gets its own empty database; with gunicorn each worker has its own.
+'''
+import os
+import sys
+import mongomock
+import pymongo
+
+pymongo.MongoClient = mongomock.MongoClient
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.getcwd())
+    if len(sys.argv) > 1:
+        from gunicorn.app.wsgiapp import run
+        sys.argv = ['gunicorn'] + sys.argv[1:]
+        run()
+    else:
+        import server
+        server.setup()
+        server.start_worker()
+        # The Flask server of 'python server.py', without the reloader that would start it again
+        # without the stand-in
+        server.app.run(host='127.0.0.1', port=server.port)
@@ -0,0 +1,532 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from columnar_cache import load_frame, parse_dates
+from event_log import save_columns, load_columns
+from instrumentation import stage
+
+
+# Columns of each source that end up in the records, in the order of the output frame
+admissionCols = ['HADM_ID',
+                 'SUBJECT_ID',
+                 'ADMISSION_TYPE',
+                 'DIAGNOSIS',
+                 'INSURANCE',
+                 'ETHNICITY',
+                 'LANGUAGE',
+                 'MARITAL_STATUS',
+                 'ADMITTIME',
+                 'DISCHTIME'
+                 ]
+
+comorbidCols = ['COMORBID_MORTALITY',
+                'COMORBID_SEVERITY'
+                ]
+
+patientCols = ['GENDER',
+               'DOB'
+               ]
+
+recordCols = admissionCols + comorbidCols + patientCols + ['AGE']
+
+# Dates are returned in the format of the PSVs, e.g. 04/09/2196 12:26:00 PM
+dateCols = ['ADMITTIME', 'DISCHTIME', 'DOB']
+
+
+def gather(values, positions):
+    '''
+    Input: a numpy array and an array of positions into it, -1 for rows that were not found
+    Output: values[positions], with NaN (NaT for dates) for the rows that were not found
+    '''
+    if values.dtype.kind == 'M':
+        result = np.full(len(positions), np.datetime64('NaT'), dtype=values.dtype)
+    else:
+        result = np.empty(len(positions), dtype=np.float64 if values.dtype.kind in 'biuf' else object)
+        result[:] = np.nan
+    found = positions >= 0
+    result[found] = values[positions[found]]
+    return result
+
+
+def format_dates(values):
+    '''
+    Input: a numpy datetime64 array
+    Output: an object array of the dates formatted like the PSVs, NaN where a date is missing
+    '''
+    formatted = np.empty(len(values), dtype=object)
+    formatted[:] = np.nan
+    for ix, value in enumerate(values.astype('datetime64[s]').tolist()):
+        if value is not None:
+            # Not strftime, which rejects the years before 1900 of the shifted dates of birth
+            formatted[ix] = '{0.month:02d}/{0.day:02d}/{0.year:04d} {1}:{0.minute:02d}:{0.second:02d} {2}' \
+                .format(value, value.hour % 12 or 12, 'PM' if value.hour >= 12 else 'AM')
+    return formatted
+
+
+def modification_times(urls):
+    return [os.path.getmtime(url) for url in urls]
+
+
+def content_hash(urls, blockSize=1024 * 1024):
+    '''
+    Output: the SHA-1 of the contents of the files, as hex
+    '''
+    digest = hashlib.sha1()
+    for url in urls:
+        fileDigest = hashlib.sha1()
+        with open(url, 'rb') as f:
+            for block in iter(lambda: f.read(blockSize), ''):
+                fileDigest.update(block)
+        digest.update(fileDigest.digest())
+    return digest.hexdigest()
+
+
+# The events the ingestion API accepts: the key of each kind and the columns its rows carry
+eventKeys = {'admissions': 'HADM_ID', 'patients': 'SUBJECT_ID', 'drgcodes': 'HADM_ID'}
+eventCols = {'admissions': admissionCols,
+             'patients': ['SUBJECT_ID'] + patientCols,
+             'drgcodes': ['HADM_ID', 'DRG_MORTALITY', 'DRG_SEVERITY']}
+idCols = ['HADM_ID', 'SUBJECT_ID']
+numericCols = ['DRG_MORTALITY', 'DRG_SEVERITY']
+
+
+def empty_like(values, capacity):
+    result = np.empty(capacity, dtype=values.dtype)
+    if values.dtype.kind == 'O':
+        result[:] = np.nan
+    return result
+
+
+def is_missing(values):
+    '''
+    Output: a boolean array, True where a value is NaN, NaT or None
+    '''
+    if values.dtype.kind == 'M':
+        return np.isnat(values)
+    if values.dtype.kind == 'f':
+        return np.isnan(values)
+    if values.dtype.kind == 'O':
+        return pd.isnull(values)
+    return np.zeros(len(values), dtype=bool)
+
+
+def missing_value(values):
+    if values.dtype.kind == 'M':
+        return np.datetime64('NaT')
+    return np.nan if values.dtype.kind in 'fO' else 0
+
+
+class KeyedColumns(object):
+    '''
+    Columns of NumPy arrays with one row per key, a hash index from key to row and spare capacity
+    at the end. Rows are updated in place and new keys are appended, doubling the capacity when it
+    runs out, so the cost of a batch of events is proportional to the size of the batch.
+    '''
+
+    def __init__(self, keys, columns):
+        self.size = len(keys)
+        self.keys = np.array(keys, dtype=np.int64)
+        self.columns = {name: np.array(values) for name, values in columns.iteritems()}
+        self.index = {key: row for row, key in enumerate(self.keys.tolist())}
+
+    @classmethod
+    def from_frame(cls, df, key):
+        '''
+        Input: a pandas DataFrame and its key column; the first row of each key is kept
+        '''
+        df = df.drop_duplicates(key)
+        columns = {}
+        for col in df.columns:
+            if col == key:
+                continue
+            values = df[col].values
+            if values.dtype.kind == 'M':
+                values = values.astype('datetime64[s]')
+            elif df[col].dtype.name == 'category':
+                values = np.asarray(df[col].astype(object))
+            columns[col] = values
+        return cls(df[key].values, columns)
+
+    def rows(self, keys):
+        '''
+        Output: the row of each key, -1 for the keys that are not in the table
+        '''
+        index = self.index
+        return np.array([index.get(key, -1) for key in keys], dtype=np.int64)
+
+    def column(self, name):
+        return self.columns[name][:self.size]
+
+    def insert_rows(self, keys):
+        '''
+        Input: an array of distinct keys
+        Output: the row of each key, appending rows for the new ones, and a mask of the new ones
+        '''
+        rows = self.rows(keys)
+        isNew = rows < 0
+        numNew = int(isNew.sum())
+        if self.size + numNew > len(self.keys):
+            self.grow(max(2 * len(self.keys), self.size + numNew))
+        rows[isNew] = np.arange(self.size, self.size + numNew)
+        self.keys[rows[isNew]] = keys[isNew]
+        for key, row in zip(keys[isNew].tolist(), rows[isNew].tolist()):
+            self.index[key] = row
+        self.size += numNew
+        return rows, isNew
+
+    def grow(self, capacity):
+        keys = np.zeros(capacity, dtype=np.int64)
+        keys[:self.size] = self.keys[:self.size]
+        self.keys = keys
+        for name, values in self.columns.items():
+            grown = empty_like(values, capacity)
+            grown[:self.size] = values[:self.size]
+            self.columns[name] = grown
+
+    def merge(self, keys, columns):
+        '''
+        Input: an array of keys, in the order of the events, and a dict of column name to array
+        Description: sets the values that are not missing in the rows of their keys, appending the
+        keys that are not in the table with missing values first. A missing value leaves the stored
+        one as it is, and of the values of a key in a column the last one wins.
+        '''
+        rows, isNew = self.insert_rows(np.unique(keys))
+        for name, values in self.columns.iteritems():
+            values[rows[isNew]] = missing_value(values)
+        for name, values in columns.iteritems():
+            present = np.flatnonzero(~is_missing(values))[::-1]
+            _, first = np.unique(keys[present], return_index=True)
+            last = present[first]
+            self.columns[name][self.rows(keys[last].tolist())] = values[last]
+
+    def add(self, keys, columns):
+        '''
+        Adds the values to the rows of the keys, starting the new keys from 0.
+        '''
+        rows, isNew = self.insert_rows(keys)
+        for name, values in columns.iteritems():
+            self.columns[name][rows[isNew]] = 0
+            self.columns[name][rows] += values
+
+    def save(self, path):
+        save_columns(path, self.keys[:self.size], {name: self.column(name) for name in self.columns})
+
+    @classmethod
+    def load(cls, path):
+        keys, columns = load_columns(path)
+        return cls(keys, columns)
+
+
+def comorbid_aggregates(hadmIDs, mortalities, severities):
+    '''
+    Input: the HADM_ID, DRG_MORTALITY and DRG_SEVERITY of DRG code rows
+    Output: the distinct HADM_IDs and the sum and count of the non-null mortalities and severities
+    of each, as a dict of column name to array
+    '''
+    keys, inverse = np.unique(np.asarray(hadmIDs, dtype=np.int64), return_inverse=True)
+    aggregates = {}
+    for col, values in [('COMORBID_MORTALITY', mortalities), ('COMORBID_SEVERITY', severities)]:
+        values = np.asarray(values, dtype=np.float64)
+        isValue = ~np.isnan(values)
+        aggregates[col + '_SUM'] = np.bincount(inverse, np.where(isValue, values, 0), minlength=len(keys))
+        aggregates[col + '_COUNT'] = np.bincount(inverse, isValue, minlength=len(keys))
+    return keys, aggregates
+
+
+def typed_events(kind, columns):
+    '''
+    Input: a kind of event and a dict of column name to a list of values, e.g. from parsed NDJSON
+    or PSV rows or from a line of the event log
+    Output: a dict of the eventCols of the kind to NumPy arrays, with ids as int64, DRG scores as
+    float64, dates as datetime64[s] and the other columns as objects, NaN (NaT) where missing
+    Description: raises ValueError when an id is missing or is not a number, or when a DRG score is
+    not a number or a date can not be parsed. Columns the events do not have are missing values.
+    '''
+    if kind not in eventCols:
+        raise ValueError("Unknown kind of event: {0}".format(kind))
+    key = eventKeys[kind]
+    if key not in columns and any(len(values) for values in columns.itervalues()):
+        raise ValueError("Every {0} event needs a {1}".format(kind, key))
+    numRows = len(columns.get(key, []))
+    typed = {}
+    for col in eventCols[kind]:
+        values = pd.Series(columns[col] if col in columns else [None] * numRows)
+        if len(values) != numRows:
+            raise ValueError("Column {0} has {1} values for {2} rows".format(col, len(values), numRows))
+        if col in idCols:
+            values = pd.to_numeric(values, errors='coerce')
+            if values.isnull().any():
+                raise ValueError("Every {0} event needs a {1}".format(kind, col))
+            typed[col] = values.values.astype(np.int64)
+        elif col in numericCols:
+            numbers = pd.to_numeric(values, errors='coerce')
+            invalid = numbers.isnull() & values.notnull()
+            if invalid.any():
+                raise ValueError("Invalid {0}: {1}".format(col, values[invalid].iloc[0]))
+            typed[col] = numbers.values.astype(np.float64)
+        elif col in dateCols:
+            values = values.where(values.notnull(), None)
+            typed[col] = parse_dates(values)
+            invalid = np.isnat(typed[col]) & values.notnull().values
+            if invalid.any():
+                raise ValueError("Invalid {0}: {1}".format(col, values[invalid].iloc[0]))
+        else:
+            typed[col] = np.asarray(values.where(values.notnull(), np.nan), dtype=object)
+    return typed
+
+
+def events_to_json(typed):
+    '''
+    Input: the output of typed_events
+    Output: a dict of column name to list that json can serialize and typed_events reads back, with
+    None for missing values
+    '''
+    columns = {}
+    for col, values in typed.iteritems():
+        if values.dtype.kind == 'M':
+            # In the format of the PSVs, which parse_dates reads without guessing
+            columns[col] = [None if isinstance(v, float) else v for v in format_dates(values)]
+        elif values.dtype.kind == 'f':
+            columns[col] = [None if v != v else v for v in values.tolist()]
+        elif values.dtype.kind == 'O':
+            columns[col] = [None if isinstance(v, float) and v != v else v for v in values.tolist()]
+        else:
+            columns[col] = values.tolist()
+    return columns
+
+
+class AdmissionTables(object):
+    '''
+    The admissions, comorbids and patients PSVs loaded into memory from their columnar caches.
+    Admissions are indexed by HADM_ID and patients by SUBJECT_ID, dates are parsed once and the comorbid
+    mortality and severity are kept as a running sum and count per HADM_ID, so building the records
+    of a list of admissions is a few indexed gathers whatever the size of the sources. Ingested
+    events update the same columns in place (see apply); generation and offset tell how far in the
+    event log the tables are.
+    '''
+
+    def __init__(self, admissions, comorbids, patients, modificationTimes):
+        self.admissions = admissions
+        self.comorbids = comorbids
+        self.patients = patients
+        self.modificationTimes = modificationTimes
+        self.contentHash = None
+        self.generation = None
+        self.offset = 0
+        self._lock = threading.RLock()
+
+    def lookup(self, admissionIDs):
+        '''
+        Input: a list of admission ids
+        Output: a pandas DataFrame with the recordCols of the admissions that were found, in the
+        order they were loaded or ingested
+        '''
+        with self._lock:
+            positions = self.admissions.rows(admissionIDs)
+            positions = np.unique(positions[positions >= 0])
+            records = pd.DataFrame({'HADM_ID': self.admissions.keys[positions]})
+            for col in admissionCols[1:]:
+                records[col] = self.admissions.columns[col][positions]
+
+            comorbidPositions = self.comorbids.rows(records['HADM_ID'].values)
+            for col in comorbidCols:
+                sums = gather(self.comorbids.columns[col + '_SUM'], comorbidPositions)
+                counts = gather(self.comorbids.columns[col + '_COUNT'], comorbidPositions)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    records[col] = sums / counts
+
+            patientPositions = self.patients.rows(records['SUBJECT_ID'].values)
+            for col in patientCols:
+                records[col] = gather(self.patients.columns[col], patientPositions)
+
+        admitTimes = records['ADMITTIME'].values.astype('datetime64[s]')
+        dobs = records['DOB'].values.astype('datetime64[s]')
+        records['AGE'] = np.round((admitTimes - dobs) / np.timedelta64(365, 'D'))
+
+        for col in dateCols:
+            records[col] = format_dates(records[col].values)
+
+        records['HADM_ID'] = records['HADM_ID'].astype(int)
+        records['SUBJECT_ID'] = records['SUBJECT_ID'].astype(int)
+        return records[recordCols]
+
+    def apply(self, kind, typed):
+        '''
+        Input: a kind of event and the output of typed_events
+        Description: admissions and patients update the rows of their keys or are appended, DRG
+        codes are added to the running sums and counts of their admission. Only the columns an
+        admission or patient event has a value for are updated. A batch with the same key more than
+        once is applied in order, the last value of each column wins.
+        '''
+        key = eventKeys[kind]
+        with self._lock:
+            if kind == 'drgcodes':
+                keys, aggregates = comorbid_aggregates(typed['HADM_ID'], typed['DRG_MORTALITY'], typed['DRG_SEVERITY'])
+                self.comorbids.add(keys, aggregates)
+                return
+            table = self.admissions if kind == 'admissions' else self.patients
+            table.merge(typed[key].astype(np.int64), {col: values for col, values in typed.iteritems() if col != key})
+
+    def save(self, path):
+        for name in ['admissions', 'comorbids', 'patients']:
+            getattr(self, name).save(os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path, modificationTimes):
+        return cls(KeyedColumns.load(os.path.join(path, 'admissions')),
+                   KeyedColumns.load(os.path.join(path, 'comorbids')),
+                   KeyedColumns.load(os.path.join(path, 'patients')),
+                   modificationTimes)
+
+
+def load_tables(urls):
+    '''
+    Input: the paths of the admissions, comorbids and patients PSVs
+    Output: an AdmissionTables
+    '''
+    admissionsURL, comorbidsURL, patientsURL = urls[0], urls[1], urls[2]
+    modificationTimes = modification_times(urls)
+
+    admissions = load_frame(admissionsURL, '|', ['ADMITTIME', 'DISCHTIME'], ['HADM_ID', 'SUBJECT_ID'])[admissionCols]
+    comorbids = load_frame(comorbidsURL, '|', [], ['HADM_ID', 'SUBJECT_ID'])[['HADM_ID', 'DRG_MORTALITY', 'DRG_SEVERITY']]
+    patients = load_frame(patientsURL, '|', ['DOB'], ['SUBJECT_ID'])[['SUBJECT_ID'] + patientCols]
+
+    keys, aggregates = comorbid_aggregates(comorbids['HADM_ID'].values, comorbids['DRG_MORTALITY'].values,
+                                           comorbids['DRG_SEVERITY'].values)
+    return AdmissionTables(KeyedColumns.from_frame(admissions, 'HADM_ID'),
+                           KeyedColumns(keys, aggregates),
+                           KeyedColumns.from_frame(patients, 'SUBJECT_ID'),
+                           modificationTimes)
+
+
+class AdmissionStore(object):
+    '''
+    Keeps the AdmissionTables of the PSVs in memory. Every lookup checks the modification times of
+    the files and reloads the tables when one of them changed; the new tables replace the old ones
+    in a single assignment, so lookups that are already running keep reading consistent tables.
+
+    With an EventLog, ingested events are appended to the log and applied to the tables in place,
+    and every lookup first applies the events other processes appended since the last one. PSVs
+    whose contents changed are taken to be a new full export that includes the earlier events: they
+    start a new generation of the log and the events of the old one are no longer applied. PSVs that
+    were only touched or copied again keep the generation and its events.
+    '''
+
+    def __init__(self, urls, eventLog=None, compactBytes=64 * 1024 * 1024):
+        self.urls = urls
+        self.eventLog = eventLog
+        self.compactBytes = compactBytes
+        self.tables = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with stage('load_tables'):
+            self.tables = self.load_tables()
+
+    def load_tables(self):
+        if self.eventLog is None:
+            return load_tables(self.urls)
+        modificationTimes = modification_times(self.urls)
+        with self.eventLog.lock():
+            manifest = self.eventLog.manifest()
+            # The contents are only hashed when the modification times changed
+            if manifest is None or manifest['modificationTimes'] != modificationTimes:
+                contentHash = content_hash(self.urls)
+                if manifest is None or manifest['contentHash'] != contentHash:
+                    manifest = self.eventLog.start_generation(contentHash, modificationTimes)
+                else:
+                    manifest = self.eventLog.update_manifest(modificationTimes=modificationTimes)
+        if manifest['snapshot']:
+            tables = AdmissionTables.load(self.eventLog.snapshot_path(manifest['generation']), modificationTimes)
+        else:
+            tables = load_tables(self.urls)
+        tables.contentHash = manifest['contentHash']
+        tables.generation = manifest['generation']
+        self.replay(tables)
+        return tables
+
+    def replay(self, tables):
+        '''
+        Applies the events appended to the log of the tables' generation since their offset.
+        Output: the number of batches applied
+        '''
+        with tables._lock:
+            batches, offset = self.eventLog.read(tables.generation, tables.offset)
+            for batch in batches:
+                tables.apply(batch['kind'], typed_events(batch['kind'], batch['columns']))
+            tables.offset = offset
+        return len(batches)
+
+    def refresh(self):
+        '''
+        Output: True when the tables were (re)loaded
+        '''
+        if self.tables is not None and modification_times(self.urls) == self.tables.modificationTimes:
+            if self.eventLog is not None:
+                return self.catch_up()
+            return False
+        with self._lock:
+            # Another request may have reloaded them while this one was waiting for the lock
+            if self.tables is not None and modification_times(self.urls) == self.tables.modificationTimes:
+                return False
+            self.load()
+            return True
+
+    def catch_up(self):
+        '''
+        Applies the events appended since the last lookup, or reloads the tables when another
+        process compacted the log.
+        Output: True when the tables were reloaded
+        '''
+        manifest = self.eventLog.manifest()
+        if manifest is not None and manifest['generation'] != self.tables.generation:
+            with self._lock:
+                if manifest['generation'] != self.tables.generation:
+                    self.load()
+                    return True
+            return False
+        self.replay(self.tables)
+        return False
+
+    def ingest(self, kind, typed):
+        '''
+        Input: a kind of event and the output of typed_events
+        Output: the generation of the log the events were appended to
+        Description: the events are appended to the log before they are applied, so they survive a
+        restart. The log is compacted once it is larger than compactBytes. An empty batch is not
+        appended.
+        '''
+        self.refresh()
+        if len(typed[eventKeys[kind]]) == 0:
+            return self.tables.generation
+        generation = self.eventLog.append({'kind': kind, 'columns': events_to_json(typed)})
+        self.catch_up()
+        if self.eventLog.size(generation) > self.compactBytes:
+            self.compact()
+        return generation
+
+    def compact(self):
+        '''
+        Writes the tables, with every event of the log applied, to the snapshot of a new generation.
+        Output: the new generation, or None when the tables were not current
+        '''
+        with stage('compact_events'):
+            with self.eventLog.lock():
+                tables = self.tables
+                manifest = self.eventLog.manifest()
+                if manifest['generation'] != tables.generation or manifest['contentHash'] != tables.contentHash:
+                    return None
+                # No batch can be appended while the lock is held, so the tables do not change
+                # while they are saved and lookups go on
+                self.replay(tables)
+                manifest = self.eventLog.start_generation(tables.contentHash, manifest['modificationTimes'],
+                                                          tables.save)
+                tables.generation = manifest['generation']
+                tables.offset = 0
+            return manifest['generation']
+
+    def lookup(self, admissionIDs):
+        self.refresh()
+        return self.tables.lookup(admissionIDs)
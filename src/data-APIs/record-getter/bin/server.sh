@@ -17,5 +17,9 @@
 
 echo "Starting record parsing script!"
 
-python server.py
+# SERVING_MODE=prefork loads the data once and serves it from several gunicorn workers (see gunicorn.conf.py)
+if [ "$SERVING_MODE" = "prefork" ]; then
+    exec gunicorn -c gunicorn.conf.py server:app
+fi
 
+python server.py
@@ -0,0 +1,188 @@
+'''
+The append-only log of the admission, patient and DRG code events ingested by record-getter, and
+the snapshots it is compacted into:
+
+    data/events/
+        CURRENT             {"generation": 3, "snapshot": true, "contentHash": "...", "modificationTimes": [...]}
+        LOCK                taken by the processes that append, compact or start a generation
+        000003.snapshot/    the tables as they were when generation 3 started
+        000003.log          the batches ingested since, one JSON line per batch
+
+A process loads the snapshot of the current generation, or the PSVs when the generation has
+none, and applies the batches of its log. From then on it only reads the lines appended after
+the last one it applied. Compacting writes the tables to the snapshot of a new generation with
+an empty log, so the log never has to be replayed from the beginning of the history.
+'''
+import os
+import json
+import fcntl
+import shutil
+from contextlib import contextmanager
+import numpy as np
+
+
+class EventLog(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def log_path(self, generation):
+        return os.path.join(self.directory, '{0:06d}.log'.format(generation))
+
+    def snapshot_path(self, generation):
+        return os.path.join(self.directory, '{0:06d}.snapshot'.format(generation))
+
+    def manifest(self):
+        '''
+        Output: the contents of CURRENT, or None when no generation was started yet
+        '''
+        try:
+            with open(os.path.join(self.directory, 'CURRENT')) as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    @contextmanager
+    def lock(self):
+        '''
+        Holds the lock of the directory. flock locks conflict between the threads of a process as
+        well as between processes, as each call opens the file again.
+        '''
+        with open(os.path.join(self.directory, 'LOCK'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def start_generation(self, contentHash, modificationTimes, save_snapshot=None):
+        '''
+        Input: the content hash and modification times of the PSVs the generation is based on, and
+        a function that writes the tables to a directory, when the generation starts from a snapshot
+        Output: the manifest of the new generation
+        Description: must be called with the lock held. The generations before the previous one
+        are removed; processes still reading the previous one reload as soon as they see CURRENT.
+        '''
+        previous = self.manifest()
+        generation = previous['generation'] + 1 if previous is not None else 0
+        if save_snapshot is not None:
+            tmpPath = self.snapshot_path(generation) + '.tmp-{0}'.format(os.getpid())
+            if os.path.isdir(tmpPath):
+                shutil.rmtree(tmpPath)
+            os.makedirs(tmpPath)
+            save_snapshot(tmpPath)
+            os.rename(tmpPath, self.snapshot_path(generation))
+        open(self.log_path(generation), 'w').close()
+        manifest = {'generation': generation,
+                    'snapshot': save_snapshot is not None,
+                    'contentHash': contentHash,
+                    'modificationTimes': modificationTimes}
+        self.write_manifest(manifest)
+
+        for name in os.listdir(self.directory):
+            prefix = name.split('.')[0]
+            if prefix.isdigit() and int(prefix) < generation - 1:
+                path = os.path.join(self.directory, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        return manifest
+
+    def update_manifest(self, **changes):
+        '''
+        Output: the manifest of the current generation with the changes applied
+        Description: must be called with the lock held.
+        '''
+        manifest = self.manifest()
+        manifest.update(changes)
+        self.write_manifest(manifest)
+        return manifest
+
+    def write_manifest(self, manifest):
+        tmpPath = os.path.join(self.directory, 'CURRENT.tmp-{0}'.format(os.getpid()))
+        with open(tmpPath, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmpPath, os.path.join(self.directory, 'CURRENT'))
+
+    def append(self, batch):
+        '''
+        Input: a batch of events, a dict that json can serialize
+        Output: the generation of the log it was appended to
+        Description: the batch is written as one line and synced to disk before returning.
+        '''
+        line = json.dumps(batch, separators=(',', ':')) + '\n'
+        with self.lock():
+            generation = self.manifest()['generation']
+            with open(self.log_path(generation), 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        return generation
+
+    def size(self, generation):
+        try:
+            return os.path.getsize(self.log_path(generation))
+        except OSError:
+            return 0
+
+    def read(self, generation, offset):
+        '''
+        Input: a generation and the offset of the first line that was not applied yet
+        Output: the batches that were appended since, and the offset after the last of them
+        Description: a line that is still being written, without its newline, is left for the
+        next read.
+        '''
+        if self.size(generation) <= offset:
+            return [], offset
+        with open(self.log_path(generation), 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind('\n') + 1
+        batches = [json.loads(line) for line in data[:end].splitlines() if line]
+        return batches, offset + end
+
+
+def save_columns(path, keys, columns):
+    '''
+    Input: a directory, an array of keys and a dict of column name to array
+    Description: numeric and date columns are written as .npy files, object columns as JSON lists
+    with null for missing values.
+    '''
+    os.makedirs(path)
+    np.save(os.path.join(path, 'keys.npy'), keys)
+    meta = []
+    for ix, (name, values) in enumerate(sorted(columns.items())):
+        if values.dtype.kind == 'O':
+            fileName = '{0}.json'.format(ix)
+            with open(os.path.join(path, fileName), 'w') as f:
+                json.dump([None if isinstance(v, float) and v != v else v for v in values.tolist()], f)
+        else:
+            fileName = '{0}.npy'.format(ix)
+            np.save(os.path.join(path, fileName), values)
+        meta.append({'name': name, 'file': fileName})
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'numRows': len(keys), 'columns': meta}, f)
+
+
+def load_columns(path):
+    '''
+    Input: a directory written by save_columns
+    Output: the keys and the dict of columns, with NaN for the missing values of object columns
+    '''
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    keys = np.load(os.path.join(path, 'keys.npy'))
+    columns = {}
+    for column in meta['columns']:
+        filePath = os.path.join(path, column['file'])
+        if filePath.endswith('.json'):
+            with open(filePath) as f:
+                values = np.array(json.load(f) + [None], dtype=object)[:-1]
+            values[np.equal(values, None)] = np.nan
+        else:
+            values = np.load(filePath)
+        columns[str(column['name'])] = values
+    return keys, columns
@@ -1,81 +1,96 @@
-import requests
 import json
 import pandas as pd
 import numpy as np
+from itertools import izip
+from admission_store import AdmissionStore
+
+# AdmissionStores of the files passed to parse_records
+stores = {}
 
 def parse_records(urls, admissionIDs):
     '''
     Input: a list of strings, and an array of integers
     Output: a pandas DataFrame
-    Description: parse_records is a custom parser procedure will query mongoDB and
-    extract the data fields for each admissionID that we want to be able to show in the
-    visualization application. The final output is a pandas dataframe where each row is 
-    an admissionID where the columns are specified in the admissionCols, comorbidCols 
-    and patientCols arrays.
+    Description: parse_records extracts the data fields for each admissionID that we want to be
+    able to show in the visualization application. The final output is a pandas dataframe where
+    each row is an admissionID where the columns are specified in the admissionCols, comorbidCols
+    and patientCols arrays of admission_store. The files are loaded into an AdmissionStore the
+    first time they are used and only read again when they change.
     '''
-    def load_data(dataLocation, collectionName, isURL=False):
-        if isURL:
-            response.get(dataLocation)
-            docsAsJSON = json.loads(response[collectionName])
-            return pd.DataFrame(docsAsJSON)
-        return pd.read_csv(dataLocation, delimiter='|')
-            
-    
-    admissionsURL, comorbidsURL, patientsURL = urls[0], urls[1], urls[2]
+    key = tuple(urls)
+    if key not in stores:
+        stores[key] = AdmissionStore(urls)
+    return stores[key].lookup(admissionIDs)
 
-    dfAdmissions = load_data(admissionsURL, None, isURL=False)
-    
-    dfComorbids = load_data(comorbidsURL, None, isURL=False).rename(index=str, columns={'DRG_MORTALITY': 'COMORBID_MORTALITY', 
-                                                                                        'DRG_SEVERITY': 'COMORBID_SEVERITY'})
-    dfPatients = load_data(patientsURL, None, isURL=False)
-    
-    subjectIDs = dfAdmissions['SUBJECT_ID'][dfAdmissions.HADM_ID.isin(admissionIDs)]
 
-    admissionCols = ['HADM_ID', 
-                     'SUBJECT_ID', 
-                     'ADMISSION_TYPE',
-                     'DIAGNOSIS', 
-                     'INSURANCE', 
-                     'ETHNICITY', 
-                     'LANGUAGE', 
-                     'MARITAL_STATUS',
-                     'ADMITTIME',
-                     'DISCHTIME'
-                     ]
+def get_risk_score(recordsDF, scorerClient):
+    '''
+    Input: the pandas DataFrame from parse_records and a ScorerClient
+    Output: the pandas DataFrame with a readmissionRisk column, and the list of admission ids that
+    could not be scored
+    Description: the scores are matched to the records by HADM_ID. When the risk-scorer fails the
+    records are still returned, with a missing readmissionRisk for the admissions without a score.
+    '''
+    scores, failedIDs = scorerClient.score(recordsDF['HADM_ID'].tolist())
+    recordsDF['readmissionRisk'] = recordsDF['HADM_ID'].map(scores).astype(np.float64)
+    return recordsDF, failedIDs
 
-    admissionInfo = dfAdmissions[admissionCols][dfAdmissions.HADM_ID.isin(admissionIDs)]
+def to_json_values(values):
+    '''
+    Input: a numpy array
+    Output: a list of the values as Python objects that json can serialize, None for missing values
+    '''
+    if values.dtype.kind == 'f':
+        return [None if v != v else v for v in values.tolist()]
+    if values.dtype.kind == 'O':
+        values = [v.item() if isinstance(v, np.generic) else v for v in values]
+        return [None if isinstance(v, float) and v != v else v for v in values]
+    return values.tolist()
 
-    patientCols = ['SUBJECT_ID', 
-                   'GENDER',
-                   'DOB'
-                   ]
 
-    patientInfo = dfPatients[patientCols][dfPatients.SUBJECT_ID.isin(subjectIDs)]
+def document_chunks(df, chunkSize=1000):
+    '''
+    Input: a pandas DataFrame and the number of rows to convert at a time
+    Output: a generator of lists of documents, one list per chunk of rows
+    Description: converts the frame chunkSize rows at a time and column by column, so only one
+    chunk of it exists as Python objects at any time, whatever the number of admissions.
+    '''
+    cols = list(df.columns)
+    for start in xrange(0, len(df), chunkSize):
+        chunk = df.iloc[start:start + chunkSize]
+        columns = [to_json_values(chunk[col].values) for col in cols]
+        documents = []
+        for record in izip(*columns):
+            docInfo = dict(izip(cols, record))
+            documents.append({'hadm_id': docInfo['HADM_ID'],
+                              'patientInfo': docInfo})
+        yield documents
 
-    comorbidCols = ['HADM_ID', 
-                    'COMORBID_MORTALITY',
-                    'COMORBID_SEVERITY'
-                    ]
 
-    grouped = dfComorbids[comorbidCols][dfComorbids.HADM_ID.isin(admissionIDs)].groupby('HADM_ID')
-    intFrame = admissionInfo.join(grouped.mean(), how='left', on='HADM_ID')
-    finalFrame = intFrame.merge(patientInfo, how='left', on='SUBJECT_ID')
+def dataframe_to_ndjson(df, chunkSize=1000):
+    '''
+    Input: a pandas DataFrame
+    Output: a generator of strings
+    Description: streams the documents of the frame as newline delimited JSON, one document per
+    line, for responses too large to build in memory.
+    '''
+    for documents in document_chunks(df, chunkSize):
+        yield ''.join(json.dumps(doc) + '\n' for doc in documents)
 
-    finalFrame['AGE'] = np.round((pd.to_datetime(finalFrame.ADMITTIME) - pd.to_datetime(finalFrame.DOB)) \
-                        / np.timedelta64(365, 'D'))      
-    
-    finalFrame['HADM_ID'] = finalFrame['HADM_ID'].astype(int)
-    finalFrame['SUBJECT_ID'] = finalFrame['SUBJECT_ID'].astype(int)
-    
-    return finalFrame
 
+def dataframe_to_json_chunks(df, chunkSize=1000):
+    '''
+    Input: a pandas DataFrame
+    Output: a generator of strings
+    Description: streams the same document as dataframe_to_docs, a chunk of documents at a time.
+    '''
+    yield '{{"count": {0}, "documents": ['.format(len(df))
+    separator = ''
+    for documents in document_chunks(df, chunkSize):
+        yield separator + ', '.join(json.dumps(doc) for doc in documents)
+        separator = ', '
+    yield ']}'
 
-def get_risk_score(admissionIDs, recordsDF, riskScorerAPI):
-    # ids = list(admissionIDs.values)
-    response = requests.get(riskScorerAPI.format(admissionIDs))
-    scoresDF = pd.read_json(response.content)
-    recordsDF['readmissionRisk'] = scoresDF['readmissionRisk']
-    return recordsDF
 
 def dataframe_to_docs(df):
     '''
@@ -84,21 +99,4 @@ def dataframe_to_docs(df):
     Description: takes the pandas DataFrame and converts it into a json-like document that will
     be the response for the API 
     '''
-
-    cols = df.columns
-    records = [list(record) for record in df.to_records()]
-    documents = []
-    numDocs = 0
-    
-    for record in records:
-        zipped = zip(cols, record[1:])
-        docInfo = {z[0]: z[1] for z in zipped}
-        doc = {'hadm_id': docInfo['HADM_ID'],
-               'patientInfo': docInfo}
-        documents.append(doc)
-        numDocs += 1
-
-    response = {'count': numDocs,
-                'documents': documents}
-    
-    return json.dumps(response)
\ No newline at end of file
+    return ''.join(dataframe_to_json_chunks(df))
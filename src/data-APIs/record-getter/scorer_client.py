@@ -0,0 +1,124 @@
+import json
+import time
+import logging
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from instrumentation import trace_headers
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_retry(retries, backoff):
+    '''
+    Output: a urllib3 Retry that retries failed connections and the 502, 503 and 504 responses of
+    the risk-scorer, for POST requests too since scoring has no side effects
+    '''
+    settings = dict(total=retries,
+                    backoff_factor=backoff,
+                    status_forcelist=[502, 503, 504],
+                    respect_retry_after_header=True,
+                    raise_on_status=False)
+    methods = frozenset(['GET', 'POST'])
+    try:
+        return Retry(allowed_methods=methods, **settings)
+    except TypeError:
+        # urllib3 before 1.26
+        return Retry(method_whitelist=methods, **settings)
+
+
+def parse_scores(response):
+    '''
+    Input: a risk-scorer response, {"<admission id>": {"readmissionRisk": <probability>}, ...}
+    Output: a dict of admission id to probability
+    '''
+    return {int(admissionID): score['readmissionRisk'] for admissionID, score in response.json().iteritems()}
+
+
+class ScorerClient(object):
+    '''
+    A client for the risk-scorer API. Requests go through one requests.Session, so connections to
+    the scorer are kept alive and reused, with connect and read timeouts and retries with backoff.
+    Lists of admission ids are split into chunks of chunkSize ids that are scored concurrently,
+    'concurrency' at a time, with POST /v2/score. A scorer that answers /v2/score with a 404 or 405
+    is called with GET <v1Path>?<v1Param>=[...] instead, and /v2/score is tried again after
+    v2ProbeInterval seconds, so a scorer that is being redeployed does not downgrade the client for
+    good. The chunks that can not be scored are left out of the results rather than failing the
+    whole list.
+    '''
+
+    def __init__(self, baseURL, chunkSize=500, concurrency=4, connectTimeout=2, readTimeout=10,
+                 retries=2, backoff=0.2, v1Path='/v1/score-patients', v1Param='admissionIDs', v2ProbeInterval=60):
+        self.baseURL = baseURL.rstrip('/')
+        self.chunkSize = chunkSize
+        self.timeout = (connectTimeout, readTimeout)
+        self.v1Path = v1Path
+        self.v1Param = v1Param
+        self.v2ProbeInterval = v2ProbeInterval
+        # /v2/score is not called before this time
+        self.v2RetryAt = 0
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.reset()
+
+    def reset(self):
+        '''
+        Opens a new pool of connections and starts new threads. A process forked from the one that
+        created the client calls it before scoring, since it inherits neither the threads nor
+        connections it can share.
+        '''
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency,
+                              max_retries=make_retry(self.retries, self.backoff))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPool(self.concurrency)
+
+    def score_chunk(self, admissionIDs, headers=None):
+        '''
+        Input: a list of admission ids, and the headers to send with them
+        Output: a dict of admission id to probability for the ids the scorer found
+        '''
+        if time.time() >= self.v2RetryAt:
+            response = self.session.post(self.baseURL + '/v2/score', json=admissionIDs, headers=headers,
+                                         timeout=self.timeout)
+            if response.status_code not in (404, 405):
+                response.raise_for_status()
+                return parse_scores(response)
+            # An older scorer, or one that is being redeployed
+            logger.warning("POST /v2/score answered %d, using %s for %ds", response.status_code, self.v1Path,
+                           self.v2ProbeInterval)
+            self.v2RetryAt = time.time() + self.v2ProbeInterval
+        response = self.session.get(self.baseURL + self.v1Path, params={self.v1Param: json.dumps(admissionIDs)},
+                                    headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return parse_scores(response)
+
+    def _score_chunk_or_fail(self, admissionIDs, headers=None):
+        try:
+            return self.score_chunk(admissionIDs, headers), None
+        except (requests.RequestException, ValueError, KeyError) as e:
+            return {}, e
+
+    def score(self, admissionIDs):
+        '''
+        Input: a list of admission ids
+        Output: a dict of admission id to probability, and the list of ids that could not be scored
+        because the scorer failed
+        '''
+        admissionIDs = [int(admissionID) for admissionID in admissionIDs]
+        chunks = [admissionIDs[i:i + self.chunkSize] for i in xrange(0, len(admissionIDs), self.chunkSize)]
+        scores = {}
+        failedIDs = []
+        # The pool's threads are outside of the request, the trace id is taken here
+        headers = trace_headers()
+        results = self.pool.map(lambda chunk: self._score_chunk_or_fail(chunk, headers), chunks)
+        for chunk, (chunkScores, error) in zip(chunks, results):
+            scores.update(chunkScores)
+            if error is not None:
+                logger.warning("Scoring failed for %d admissions: %s", len(chunk), error)
+                failedIDs.extend(chunk)
+        return scores, failedIDs
@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 from flask import Flask, json, request, Response
-from record_parser import parse_records, get_risk_score, dataframe_to_docs
+from record_parser import get_risk_score, dataframe_to_json_chunks, dataframe_to_ndjson
+from admission_store import AdmissionStore, typed_events, eventCols
+from event_log import EventLog
+from scorer_client import ScorerClient
+from instrumentation import instrument, stage, timed_iter
+import pandas as pd
+from StringIO import StringIO
 import ast
 import os
+import logging
 
 
 ########################################################################################################################
@@ -10,6 +17,10 @@ import os
 ########################################################################################################################
 
 app = Flask(__name__)
+instrument(app, 'record-getter')
+
+# The warnings of the scorer client are logged to stderr
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
 
 # Get the port number from the environment variable VCAP_APP_PORT
 # When running this app on the local machine, default the port to 8080
@@ -23,7 +34,34 @@ comorbidsURL = "data/discharge-comorbids.psv"
 patientsURL = "data/discharge-patients.psv"
 urls = [admissionsURL, comorbidsURL, patientsURL]
 
-riskScorerAPI = 'http://risk-scorer-jb.52.204.218.231.nip.io/v1/score-patients?admissionIDs={0}'
+# Admission, patient and DRG code events posted to /v1/ingest are appended to a log in
+# INGEST_DIR and applied to the tables in place; the log is compacted into a snapshot once it is
+# larger than INGEST_COMPACT_BYTES. The endpoints are not authenticated, so ingestion is off unless
+# INGEST_DIR is set, e.g. to data/events.
+ingestDir = os.getenv('INGEST_DIR', 'off')
+eventLog = EventLog(ingestDir) if ingestDir != 'off' else None
+compactBytes = int(os.getenv('INGEST_COMPACT_BYTES', 64 * 1024 * 1024))
+
+# The PSVs are kept in memory and reloaded when they change
+admissionStore = AdmissionStore(urls, eventLog, compactBytes)
+
+# Number of records serialized at a time when streaming a response
+chunkSize = int(os.getenv('RECORDS_CHUNK_SIZE', 1000))
+
+# The risk-scorer API. Admission ids are sent SCORER_CHUNK_SIZE at a time, SCORER_CONCURRENCY
+# chunks in parallel, over a pool of kept-alive connections. A scorer without POST /v2/score is
+# called with GET SCORER_V1_PATH?SCORER_V1_PARAM=[...], and /v2/score is tried again every
+# SCORER_V2_PROBE_INTERVAL seconds.
+riskScorerAPI = os.getenv('RISK_SCORER_URL', 'http://risk-scorer-jb.52.204.218.231.nip.io')
+scorerClient = ScorerClient(riskScorerAPI,
+                            chunkSize=int(os.getenv('SCORER_CHUNK_SIZE', 500)),
+                            concurrency=int(os.getenv('SCORER_CONCURRENCY', 4)),
+                            connectTimeout=float(os.getenv('SCORER_CONNECT_TIMEOUT', 2)),
+                            readTimeout=float(os.getenv('SCORER_READ_TIMEOUT', 10)),
+                            retries=int(os.getenv('SCORER_RETRIES', 2)),
+                            v1Path=os.getenv('SCORER_V1_PATH', '/v1/score-patients'),
+                            v1Param=os.getenv('SCORER_V1_PARAM', 'admissionIDs'),
+                            v2ProbeInterval=float(os.getenv('SCORER_V2_PROBE_INTERVAL', 60)))
 
 ########################################################################################################################
 # Routes
@@ -41,12 +79,78 @@ def parse_qs():
     # Convert the string input from the data payload into a literal array of discharge IDs
     dischargeIDs = ast.literal_eval(input)
     # Run the parse and format scripts
-    records = parse_records(urls, dischargeIDs)
-    dataFrame = get_risk_score(dischargeIDs, records, riskScorerAPI)
-    response = dataframe_to_docs(dataFrame)
-    print "response: ", response
-    return Response(response, mimetype='text/plain')
+    with stage('lookup', len(dischargeIDs)):
+        records = admissionStore.lookup(dischargeIDs)
+    with stage('score', len(records)):
+        dataFrame, unscoredIDs = get_risk_score(records, scorerClient)
+    headers = {'X-Unscored-Admissions': str(len(unscoredIDs))}
+    # Stream the documents rather than building the whole response in memory
+    if request.args.get('format') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        body = dataframe_to_ndjson(dataFrame, chunkSize)
+        return Response(timed_iter('serialize', body), headers=headers, mimetype='application/x-ndjson')
+    body = dataframe_to_json_chunks(dataFrame, chunkSize)
+    return Response(timed_iter('serialize', body), headers=headers, mimetype='text/plain')
+
+def parse_events(body, mimetype):
+    '''
+    Input: the body of an ingestion request and its mimetype
+    Output: a dict of column name to list of values
+    Description: NDJSON (application/x-ndjson), a JSON array of objects (application/json) or a
+    PSV with a header line (anything else), like the ones in data/.
+    '''
+    if mimetype == 'application/x-ndjson':
+        rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+    elif mimetype == 'application/json':
+        rows = json.loads(body)
+    else:
+        df = pd.read_csv(StringIO(body), delimiter='|', na_values=['null'], dtype=object)
+        return {col: df[col].where(df[col].notnull(), None).tolist() for col in df.columns}
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError("Expected one JSON object per event")
+    columns = {col: [] for col in set(col for row in rows for col in row)}
+    for row in rows:
+        for col in columns:
+            columns[col].append(row.get(col))
+    return columns
+
+@app.route('/v1/ingest/<kind>', methods=['POST'])
+def ingest(kind):
+    if eventLog is None:
+        return Response("Ingestion is turned off, set INGEST_DIR.\n", status=404, mimetype='text/plain')
+    if kind not in eventCols:
+        return Response("Unknown kind of event, expected one of: " + ', '.join(sorted(eventCols)) + ".\n",
+                        status=404, mimetype='text/plain')
+    try:
+        typed = typed_events(kind, parse_events(request.get_data(), request.mimetype))
+    except ValueError as e:
+        return Response(str(e) + "\n", status=400, mimetype='text/plain')
+    numEvents = len(typed[eventCols[kind][0]])
+    with stage('ingest_' + kind, numEvents):
+        generation = admissionStore.ingest(kind, typed)
+    response = {'kind': kind, 'events': numEvents, 'generation': generation}
+    return Response(json.dumps(response), mimetype='application/json')
+
+@app.route('/v1/admin/compact-events', methods=['POST'])
+def compact_events():
+    if eventLog is None:
+        return Response("Ingestion is turned off, set INGEST_DIR.\n", status=404, mimetype='text/plain')
+    admissionStore.refresh()
+    response = {'generation': admissionStore.compact()}
+    return Response(json.dumps(response), mimetype='application/json')
+
+def setup(prefork=False):
+    '''
+    Loads the PSVs before the first request. Run by gunicorn in the master process, so that the
+    workers it forks share the tables (see gunicorn.conf.py).
+    '''
+    admissionStore.load()
+
+def start_worker():
+    # The scorer client's threads are not inherited by forked workers
+    scorerClient.reset()
 
 if __name__ == '__main__':
+    setup()
+
     # Start up the Flask app server.
     app.run(host='0.0.0.0', port=port, debug=True)
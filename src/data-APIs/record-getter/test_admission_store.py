@@ -0,0 +1,177 @@
+'''
+Tests of the in-memory admission tables and of the events ingested into them:
+
+    python -m unittest test_admission_store
+'''
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from admission_store import KeyedColumns, AdmissionStore, typed_events
+from event_log import EventLog
+
+
+dataDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+psvNames = ['discharge-admissions.psv', 'discharge-comorbids.psv', 'discharge-patients.psv']
+
+
+class KeyedColumnsTest(unittest.TestCase):
+
+    def table(self):
+        return KeyedColumns([1, 2], {'NAME': np.array(['a', 'b'], dtype=object),
+                                     'SCORE': np.array([1.0, 2.0]),
+                                     'DATE': np.array(['2100-01-01', '2100-01-02'], dtype='datetime64[s]')})
+
+    def test_merge_updates_and_appends(self):
+        table = self.table()
+        table.merge(np.array([2, 3]), {'NAME': np.array(['B', 'c'], dtype=object), 'SCORE': np.array([20.0, 30.0])})
+        self.assertEqual(table.keys[:table.size].tolist(), [1, 2, 3])
+        self.assertEqual(table.column('NAME').tolist(), ['a', 'B', 'c'])
+        self.assertEqual(table.column('SCORE').tolist(), [1.0, 20.0, 30.0])
+        # A new key has no value for the columns the events do not have
+        self.assertTrue(np.isnat(table.column('DATE')[2]))
+        self.assertEqual(table.column('DATE')[1], np.datetime64('2100-01-02'))
+
+    def test_missing_values_keep_the_stored_ones(self):
+        table = self.table()
+        table.merge(np.array([1, 2]), {'NAME': np.array([np.nan, 'B'], dtype=object),
+                                       'SCORE': np.array([10.0, np.nan])})
+        self.assertEqual(table.column('NAME').tolist(), ['a', 'B'])
+        self.assertEqual(table.column('SCORE').tolist(), [10.0, 2.0])
+
+    def test_last_value_of_a_key_wins(self):
+        table = self.table()
+        table.merge(np.array([1, 1, 1]), {'NAME': np.array(['x', 'y', np.nan], dtype=object),
+                                          'SCORE': np.array([5.0, np.nan, np.nan])})
+        self.assertEqual(table.column('NAME').tolist(), ['y', 'b'])
+        self.assertEqual(table.column('SCORE').tolist(), [5.0, 2.0])
+
+    def test_growth(self):
+        table = self.table()
+        keys = np.arange(10, 1010)
+        table.merge(keys, {'SCORE': keys.astype(float)})
+        self.assertEqual(table.size, 1002)
+        self.assertGreaterEqual(len(table.keys), 1002)
+        self.assertEqual(table.rows([1, 2, 10, 1009]).tolist(), [0, 1, 2, 1001])
+        self.assertEqual(table.column('SCORE')[table.rows([500])[0]], 500.0)
+        self.assertEqual(table.column('NAME')[:2].tolist(), ['a', 'b'])
+
+    def test_add(self):
+        table = KeyedColumns([1], {'SUM': np.array([2.0])})
+        table.add(np.array([1, 2]), {'SUM': np.array([3.0, 4.0])})
+        self.assertEqual(table.column('SUM').tolist(), [5.0, 4.0])
+
+
+class TypedEventsTest(unittest.TestCase):
+
+    def test_types(self):
+        typed = typed_events('drgcodes', {'HADM_ID': ['1', 2], 'DRG_SEVERITY': ['3', None]})
+        self.assertEqual(typed['HADM_ID'].tolist(), [1, 2])
+        self.assertEqual(typed['DRG_SEVERITY'][0], 3.0)
+        self.assertTrue(np.isnan(typed['DRG_SEVERITY'][1]))
+        self.assertTrue(np.isnan(typed['DRG_MORTALITY']).all())
+
+    def test_invalid_events(self):
+        for kind, columns in [('drgcodes', {'DRG_SEVERITY': [4]}),
+                              ('drgcodes', {'HADM_ID': [1, None]}),
+                              ('drgcodes', {'HADM_ID': [1], 'DRG_SEVERITY': ['high']}),
+                              ('admissions', {'HADM_ID': [1], 'SUBJECT_ID': [2], 'ADMITTIME': ['garbage']}),
+                              ('admissions', {'HADM_ID': [1]}),
+                              ('transfers', {'HADM_ID': [1]})]:
+            self.assertRaises(ValueError, typed_events, kind, columns)
+
+    def test_empty_batch(self):
+        self.assertEqual(len(typed_events('drgcodes', {})['HADM_ID']), 0)
+
+
+class AdmissionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.urls = []
+        for name in psvNames:
+            shutil.copy(os.path.join(dataDir, name), self.directory)
+            self.urls.append(os.path.join(self.directory, name))
+        self.eventDir = os.path.join(self.directory, 'events')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, compactBytes=64 * 1024 * 1024):
+        store = AdmissionStore(self.urls, EventLog(self.eventDir), compactBytes)
+        store.load()
+        return store
+
+    def ingest_admission(self, store, admissionID=999999, diagnosis='SEPSIS'):
+        store.ingest('admissions', typed_events('admissions', {'HADM_ID': [admissionID], 'SUBJECT_ID': [22],
+                                                               'DIAGNOSIS': [diagnosis],
+                                                               'ADMITTIME': ['01/01/2200 10:00:00 AM']}))
+
+    def diagnosis(self, store, admissionID=999999):
+        records = store.lookup([admissionID])
+        return records['DIAGNOSIS'].tolist()[0] if len(records) else None
+
+    def touch(self, url, text=None):
+        if text is not None:
+            with open(url, 'w') as f:
+                f.write(text)
+        mtime = time.time() + 10
+        os.utime(url, (mtime, mtime))
+
+    def test_events_are_replayed_by_other_processes(self):
+        store, other = self.store(), self.store()
+        self.ingest_admission(store)
+        self.assertEqual(self.diagnosis(store), 'SEPSIS')
+        self.assertEqual(self.diagnosis(other), 'SEPSIS')
+        # And by a process that starts later
+        self.assertEqual(self.diagnosis(self.store()), 'SEPSIS')
+        self.assertEqual(self.diagnosis(store, 165315), 'BENZODIAZEPINE OVERDOSE')
+
+    def test_partial_update_keeps_the_other_columns(self):
+        store = self.store()
+        store.ingest('admissions', typed_events('admissions', {'HADM_ID': [165315], 'SUBJECT_ID': [22],
+                                                               'DIAGNOSIS': ['OVERDOSE']}))
+        records = store.lookup([165315])
+        self.assertEqual(records['DIAGNOSIS'].tolist(), ['OVERDOSE'])
+        self.assertEqual(records['ADMITTIME'].tolist(), ['04/09/2196 12:26:00 PM'])
+        self.assertEqual(records['INSURANCE'].tolist(), ['Private'])
+
+    def test_touched_psv_keeps_the_events(self):
+        store = self.store()
+        self.ingest_admission(store)
+        generation = store.tables.generation
+        self.touch(self.urls[1])
+        self.assertEqual(self.diagnosis(store), 'SEPSIS')
+        self.assertEqual(store.tables.generation, generation)
+
+    def test_changed_psv_starts_a_new_generation(self):
+        store = self.store()
+        self.ingest_admission(store)
+        generation = store.tables.generation
+        with open(self.urls[1]) as f:
+            lines = f.readlines()
+        self.touch(self.urls[1], ''.join(lines[:-1]))
+        self.assertEqual(self.diagnosis(store), None)
+        self.assertEqual(store.tables.generation, generation + 1)
+
+    def test_compaction(self):
+        store = self.store(compactBytes=1)
+        other = self.store()
+        self.ingest_admission(store)
+        # The log went over compactBytes, the tables were written to the snapshot of a new generation
+        manifest = store.eventLog.manifest()
+        self.assertEqual(manifest['generation'], 1)
+        self.assertTrue(manifest['snapshot'])
+        self.assertEqual(store.eventLog.size(1), 0)
+        self.assertEqual(self.diagnosis(other), 'SEPSIS')
+        self.assertEqual(other.tables.generation, 1)
+        self.ingest_admission(store, 999998, 'PNEUMONIA')
+        restarted = self.store()
+        self.assertEqual(self.diagnosis(restarted), 'SEPSIS')
+        self.assertEqual(self.diagnosis(restarted, 999998), 'PNEUMONIA')
+
+
+if __name__ == '__main__':
+    unittest.main()
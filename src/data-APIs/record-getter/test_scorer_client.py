@@ -0,0 +1,102 @@
+'''
+Tests of the risk-scorer client, with a stub in place of its requests.Session:
+
+    python -m unittest test_scorer_client
+'''
+import json
+import unittest
+import requests
+from scorer_client import ScorerClient
+
+
+class StubResponse(object):
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("{0} Error".format(self.status_code))
+
+
+def scores_of(admissionIDs):
+    return {str(admissionID): {'readmissionRisk': admissionID / 1000.0} for admissionID in admissionIDs}
+
+
+class StubSession(object):
+    '''
+    Answers POST /v2/score with v2Status and GET requests like the scorer the client used before
+    /v2/score. The chunks that contain one of failingIDs get a 500.
+    '''
+
+    def __init__(self, v2Status=200, failingIDs=()):
+        self.v2Status = v2Status
+        self.failingIDs = set(failingIDs)
+        self.calls = []
+
+    def answer(self, admissionIDs):
+        if self.failingIDs.intersection(admissionIDs):
+            return StubResponse(500)
+        return StubResponse(200, scores_of(admissionIDs))
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        self.calls.append(('POST', url, None))
+        if self.v2Status != 200:
+            return StubResponse(self.v2Status)
+        return self.answer(json)
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.calls.append(('GET', url, params))
+        return self.answer(json.loads(params['admissionIDs']))
+
+
+class ScorerClientTest(unittest.TestCase):
+
+    def client(self, session, **options):
+        client = ScorerClient('http://scorer/', chunkSize=2, concurrency=2, **options)
+        client.session = session
+        return client
+
+    def test_v2(self):
+        session = StubSession()
+        scores, failedIDs = self.client(session).score([1, 2, 3])
+        self.assertEqual(scores, {1: 0.001, 2: 0.002, 3: 0.003})
+        self.assertEqual(failedIDs, [])
+        self.assertEqual(sorted(call[:2] for call in session.calls), [('POST', 'http://scorer/v2/score')] * 2)
+
+    def test_fallback(self):
+        session = StubSession(v2Status=404)
+        client = self.client(session, v2ProbeInterval=60)
+        scores, failedIDs = client.score([1, 2])
+        self.assertEqual(scores, {1: 0.001, 2: 0.002})
+        self.assertEqual(failedIDs, [])
+        self.assertEqual(session.calls, [('POST', 'http://scorer/v2/score', None),
+                                         ('GET', 'http://scorer/v1/score-patients', {'admissionIDs': '[1, 2]'})])
+        # /v2/score is not called again before the probe interval
+        client.score([3])
+        self.assertEqual(session.calls[-1][:2], ('GET', 'http://scorer/v1/score-patients'))
+        self.assertEqual(len(session.calls), 3)
+
+    def test_v2_is_probed_again(self):
+        session = StubSession(v2Status=405)
+        client = self.client(session, v2ProbeInterval=0)
+        client.score([1])
+        # The scorer was redeployed with /v2/score
+        session.v2Status = 200
+        scores, _ = client.score([2])
+        self.assertEqual(scores, {2: 0.002})
+        self.assertEqual(session.calls[-1][:2], ('POST', 'http://scorer/v2/score'))
+
+    def test_partial_failure(self):
+        session = StubSession(failingIDs=[3])
+        scores, failedIDs = self.client(session).score([1, 2, 3, 4, 5])
+        self.assertEqual(scores, {1: 0.001, 2: 0.002, 5: 0.005})
+        self.assertEqual(failedIDs, [3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,275 @@
+import os
+import io
+import gzip
+import json
+import hashlib
+import threading
+import numpy as np
+from columnar_cache import load_frame
+from instrumentation import stage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# The age buckets the population reference data is segmented by, as [lower, upper) bounds
+ageBuckets = [(1, 25), (25, 50), (50, None)]
+
+def bucket_of(patientAge):
+    '''
+    Input: the age of a patient, at least 0
+    Output: the index in ageBuckets of the bucket the reference data of the patient is taken from
+    Description: patients under 1 year old are compared with the youngest bucket. The reference
+    rows of age 0 are in no bucket, as they always were.
+    '''
+    if patientAge < ageBuckets[0][0]:
+        return 0
+    for bucketIx, (lower, upper) in enumerate(ageBuckets):
+        if upper is None or patientAge < upper:
+            return bucketIx
+
+
+# Quantiles of each column returned with the density grids
+densityQuantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def gzip_compress(body):
+    buf = io.BytesIO()
+    # mtime=0 so the same body always compresses to the same bytes
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+class Payload(object):
+    '''
+    A JSON response body serialized once, with its gzip (and brotli, when the brotli package is
+    installed) compressed versions. Each version has its own strong ETag derived from the body.
+    '''
+
+    def __init__(self, body):
+        self.body = body
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        self.encodings = {'identity': (body, digest),
+                          'gzip': (gzip_compress(body), digest + '-gzip')}
+        if brotli is not None:
+            self.encodings['br'] = (brotli.compress(body, quality=11), digest + '-br')
+
+    def select(self, acceptEncodings):
+        '''
+        Input: the Accept-Encoding of a request, as a werkzeug Accept
+        Output: the content encoding, the bytes and the ETag to answer it with
+        '''
+        for encoding in ('br', 'gzip'):
+            if encoding in self.encodings and acceptEncodings[encoding] > 0:
+                return (encoding,) + self.encodings[encoding]
+        return ('identity',) + self.encodings['identity']
+
+
+def convert_reference_to_json(df):
+    referenceResult = {'ages': list(np.round(df.age.values, 2)),
+                       'comorbid_severities': list(np.round(df.avg_severity.values, 2)),
+                       'comorbid_mortalities': list(np.round(df.avg_mortality.values, 2))}
+    return json.dumps(referenceResult)
+
+
+def convert_readmission_to_json(df):
+    readmissionResult = {'readmissionRates': list(df.readmissionRate.values),
+                         'dates': list(df.date.values)}
+    return json.dumps(readmissionResult)
+
+
+def density_to_json(df, ageEdges, scoreEdges):
+    '''
+    Input: reference data, the edges of the age bins and of the comorbid score bins
+    Output: the JSON of the counts of the rows in each age, severity and mortality bin and in each
+    cell of the age x severity and age x mortality grids, with the quantiles of the three columns
+    '''
+    ages, severities, mortalities = df.age.values, df.avg_severity.values, df.avg_mortality.values
+    ageBySeverity = np.histogram2d(ages, severities, bins=[ageEdges, scoreEdges])[0].astype(np.int64)
+    ageByMortality = np.histogram2d(ages, mortalities, bins=[ageEdges, scoreEdges])[0].astype(np.int64)
+    densityResult = {'count': len(df),
+                     'ageEdges': np.round(ageEdges, 2).tolist(),
+                     'scoreEdges': np.round(scoreEdges, 2).tolist(),
+                     # The 1D counts are the margins of the grids
+                     'ages': ageBySeverity.sum(axis=1).tolist(),
+                     'comorbid_severities': ageBySeverity.sum(axis=0).tolist(),
+                     'comorbid_mortalities': ageByMortality.sum(axis=0).tolist(),
+                     'age_by_severity': ageBySeverity.tolist(),
+                     'age_by_mortality': ageByMortality.tolist(),
+                     'quantiles': {'probabilities': densityQuantiles}}
+    for name, values in (('ages', ages), ('comorbid_severities', severities), ('comorbid_mortalities', mortalities)):
+        densityResult['quantiles'][name] = np.round(np.percentile(values, [100 * q for q in densityQuantiles]), 2).tolist() \
+            if len(values) else None
+    return json.dumps(densityResult)
+
+
+def mid_rank(below, atOrBelow, count):
+    '''
+    Output: the percentage of count rows below a score, counting the rows equal to it as half
+    below, or None when there are no rows
+    '''
+    if count == 0:
+        return None
+    return 100.0 * (below + atOrBelow) / 2 / count
+
+
+class RankIndex(object):
+    '''
+    The values of a column among the rows of an age bucket, sorted once when the data is loaded, so
+    that the number of values below a score is a binary search, O(log n), and the index takes no
+    more memory than the column.
+    '''
+
+    def __init__(self, values):
+        self.values = np.sort(values)
+
+    def count_below(self, score, inclusive=False):
+        '''
+        Output: the number of values below score, or at most score when inclusive
+        '''
+        return int(np.searchsorted(self.values, score, 'right' if inclusive else 'left'))
+
+    def percentile_rank(self, score):
+        return mid_rank(self.count_below(score), self.count_below(score, inclusive=True), len(self.values))
+
+
+def percentile_rank(values, score):
+    '''
+    Output: the percentile rank of score among values, for the age ranges that are not a bucket.
+    The values are counted as they are, in O(n), rather than sorted.
+    '''
+    return mid_rank(np.count_nonzero(values < score), np.count_nonzero(values <= score), len(values))
+
+
+def modification_times(urls):
+    return [os.path.getmtime(url) for url in urls]
+
+
+class ReferenceTables(object):
+    '''
+    The reference and readmission data, with the payload of every age bucket and of the
+    readmission rates built when they are loaded. The reference data is sorted by age, so that the
+    rows of an age range are found with two binary searches and are a slice of the table rather
+    than a copy. The scores of each bucket are sorted for its percentile ranks.
+    '''
+
+    def __init__(self, referenceDF, readmissionDF, modificationTimes):
+        order = np.argsort(referenceDF.age.values, kind='mergesort')
+        self.referenceDF = referenceDF.iloc[order].reset_index(drop=True)
+        self.ages = self.referenceDF.age.values
+        self.readmissionDF = readmissionDF
+        self.modificationTimes = modificationTimes
+        self.bucketPayloads = [Payload(convert_reference_to_json(self.bucket(bucketIx)))
+                               for bucketIx in xrange(len(ageBuckets))]
+        self.bucketRanks = [(RankIndex(self.bucket(bucketIx).avg_severity.values),
+                             RankIndex(self.bucket(bucketIx).avg_mortality.values))
+                            for bucketIx in xrange(len(ageBuckets))]
+        self.readmissionPayload = Payload(convert_readmission_to_json(readmissionDF))
+        # Density payloads are built on first request, per (bucket, number of bins)
+        self.densityPayloads = {}
+        self._densityLock = threading.Lock()
+
+    def age_range(self, minAge, maxAge=None):
+        '''
+        Output: the positions [start, stop) of the rows with minAge <= age < maxAge, with no upper
+        bound when maxAge is None
+        '''
+        start = np.searchsorted(self.ages, minAge, 'left')
+        stop = len(self.ages) if maxAge is None else np.searchsorted(self.ages, maxAge, 'left')
+        return int(start), int(max(start, stop))
+
+    def rows(self, minAge, maxAge=None):
+        start, stop = self.age_range(minAge, maxAge)
+        return self.referenceDF.iloc[start:stop]
+
+    def bucket(self, bucketIx):
+        return self.rows(*ageBuckets[bucketIx])
+
+    def percentile_ranks(self, minAge, maxAge, severity, mortality):
+        '''
+        Input: an age range and the comorbid severity and mortality of a patient
+        Output: a dict with the number of rows in the range and the percentile ranks of the scores
+        among them
+        Description: the ranks of an age bucket are binary searches in its sorted scores, those of
+        other ranges count the scores of the range.
+        '''
+        start, stop = self.age_range(minAge, maxAge)
+        if (minAge, maxAge) in ageBuckets:
+            severityIndex, mortalityIndex = self.bucketRanks[ageBuckets.index((minAge, maxAge))]
+            severityRank = severityIndex.percentile_rank(severity)
+            mortalityRank = mortalityIndex.percentile_rank(mortality)
+        else:
+            rows = self.referenceDF.iloc[start:stop]
+            severityRank = percentile_rank(rows.avg_severity.values, severity)
+            mortalityRank = percentile_rank(rows.avg_mortality.values, mortality)
+        return {'count': stop - start,
+                'comorbid_severity': severityRank,
+                'comorbid_mortality': mortalityRank}
+
+    def density_payload(self, bucketIx, numBins):
+        '''
+        Input: the index of an age bucket and the number of bins of each axis
+        Output: the Payload of the density grids of the bucket
+        Description: the age bins span the bucket, and the score bins span the scores of the whole
+        population, so that the grids of the buckets line up.
+        '''
+        key = (bucketIx, numBins)
+        payload = self.densityPayloads.get(key)
+        if payload is not None:
+            return payload
+        with self._densityLock:
+            if key not in self.densityPayloads:
+                df = self.bucket(bucketIx)
+                lower, upper = ageBuckets[bucketIx]
+                ageEdges = np.linspace(lower, upper if upper is not None else max(self.referenceDF.age.max(), lower + 1),
+                                       numBins + 1)
+                maxScore = max(self.referenceDF.avg_severity.max(), self.referenceDF.avg_mortality.max(), 1)
+                scoreEdges = np.linspace(0, maxScore, numBins + 1)
+                with stage('build_density', len(df)):
+                    self.densityPayloads[key] = Payload(density_to_json(df, ageEdges, scoreEdges))
+            return self.densityPayloads[key]
+
+
+def load_tables(urls):
+    '''
+    Input: the paths of the reference and readmission CSVs
+    Output: a ReferenceTables
+    '''
+    modificationTimes = modification_times(urls)
+    return ReferenceTables(load_frame(urls[0]), load_frame(urls[1]), modificationTimes)
+
+
+class ReferenceStore(object):
+    '''
+    Keeps the ReferenceTables of the CSVs in memory, and reloads them, payloads included, when one
+    of the files is modified.
+    '''
+
+    def __init__(self, urls):
+        self.urls = urls
+        self.tables = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with stage('load_tables'):
+            self.tables = load_tables(self.urls)
+
+    def refresh(self):
+        '''
+        Output: True when the tables were (re)loaded
+        '''
+        if self.tables is not None and modification_times(self.urls) == self.tables.modificationTimes:
+            return False
+        with self._lock:
+            # Another request may have reloaded them while this one was waiting for the lock
+            if self.tables is not None and modification_times(self.urls) == self.tables.modificationTimes:
+                return False
+            self.load()
+            return True
+
+    def current(self):
+        self.refresh()
+        return self.tables
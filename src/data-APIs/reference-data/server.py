@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 from flask import Flask, json, request, Response
-import pandas as pd
-import numpy as np
-import json
-import requests
 import os
+import math
+from reference_store import ReferenceStore, ageBuckets, bucket_of, convert_reference_to_json
+from instrumentation import instrument, stage
 
 
 ########################################################################################################################
@@ -12,33 +11,79 @@ import os
 ########################################################################################################################
 
 app = Flask(__name__)
+instrument(app, 'reference-data')
 
 # Get the port number from the environment variable VCAP_APP_PORT
 # When running this app on the local machine, default the port to 8080
 port = int(os.getenv('VCAP_APP_PORT', 8080))
 
-referenceDF = pd.read_csv('data/app-reference-data.csv')
-readmissionDF = pd.read_csv('data/app-readmission-data.csv')
-
-def get_data(df, age):
-    patientAge = int(age)
-    print patientAge
-    if (patientAge < 25) & (patientAge >= 1):
-        return df[(df.age < 25) & (df.age >= 1)]
-    elif (patientAge >= 25) & (patientAge < 50):
-        return df[(df.age >= 25) & (df.age < 50)]
-    return df[df.age >= 50]
-
-def convert_reference_to_json(df):
-    referenceResult = {'ages': list(np.round(df.age.values, 2)),
-                       'comorbid_severities': list(np.round(df.avg_severity.values, 2)),
-                       'comorbid_mortalities': list(np.round(df.avg_mortality.values, 2))}
-    return json.dumps(referenceResult)
-
-def convert_readmission_to_json(df):
-    readmissionResult = {'readmissionRates': list(df.readmissionRate.values),
-                         'dates': list(df.date.values)}
-    return json.dumps(readmissionResult)
+# Where the population reference data and the weekly readmission rates are read from
+referenceURL = os.getenv('REFERENCE_DATA_URL', 'data/app-reference-data.csv')
+readmissionURL = os.getenv('READMISSION_DATA_URL', 'data/app-readmission-data.csv')
+
+# The number of bins of each axis of the density grids, by default and at most
+defaultDensityBins = int(os.getenv('DENSITY_BINS', 20))
+maxDensityBins = int(os.getenv('MAX_DENSITY_BINS', 100))
+
+referenceStore = ReferenceStore([referenceURL, readmissionURL])
+
+def add_cors_headers(response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET'
+    response.headers['Access-Control-Allow-Headers'] = 'X-Requested-With, If-None-Match'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag'
+    return response
+
+def bad_request(message):
+    return add_cors_headers(Response(message + "\n", status=400, mimetype='text/plain'))
+
+def finite_float(args, name):
+    '''
+    Output: the query argument 'name' as a float. Raises ValueError when it is not a finite number.
+    '''
+    value = float(args[name])
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError(name + " must be a finite number")
+    return value
+
+def age_range_of(args):
+    '''
+    Input: the query arguments of a request
+    Output: the (minAge, maxAge) range they ask for, from minAge and an optional maxAge, or else
+    the age bucket of 'ages'. Raises ValueError when there is neither or an age is invalid.
+    '''
+    if 'minAge' in args:
+        minAge = finite_float(args, 'minAge')
+        maxAge = finite_float(args, 'maxAge') if 'maxAge' in args else None
+    elif 'ages' in args:
+        patientAge = int(args['ages'])
+        if patientAge < 0:
+            raise ValueError("ages must not be negative")
+        minAge, maxAge = ageBuckets[bucket_of(patientAge)]
+    else:
+        raise ValueError("Expected ages or minAge")
+    if maxAge is not None and maxAge < minAge:
+        raise ValueError("maxAge must not be less than minAge")
+    return minAge, maxAge
+
+def respond(payload):
+    '''
+    Input: a Payload
+    Output: the response to the current request: the payload in the best encoding the client
+    accepts, or 304 Not Modified when the client already has that version
+    '''
+    encoding, body, etag = payload.select(request.accept_encodings)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Clients revalidate every time, so that they see reloaded data
+    response.headers['Cache-Control'] = 'no-cache'
+    return add_cors_headers(response)
 ########################################################################################################################
 # Routes
 ########################################################################################################################
@@ -51,24 +96,60 @@ def root():
 
 @app.route('/v1/get-reference-data', methods=['GET'])
 def parse_qs():
-    patientAge = request.args.get('ages')
-    patientReferenceDF = get_data(referenceDF, patientAge)
-    jsonResponse = convert_reference_to_json(patientReferenceDF)
-    response = Response(jsonResponse, mimetype='application/json')
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET'
-    response.headers['Access-Control-Allow-Headers'] = 'X-Requested-With'
-    return response
+    try:
+        minAge, maxAge = age_range_of(request.args)
+    except ValueError as e:
+        return bad_request(str(e))
+    tables = referenceStore.current()
+    if 'minAge' not in request.args:
+        return respond(tables.bucketPayloads[bucket_of(int(request.args['ages']))])
+    # Arbitrary ranges are serialized for each request, from a slice of the age-sorted table
+    rows = tables.rows(minAge, maxAge)
+    with stage('serialize', len(rows)):
+        jsonResponse = convert_reference_to_json(rows)
+    return add_cors_headers(Response(jsonResponse, mimetype='application/json'))
 
 @app.route('/v1/get-readmission-data', methods=['GET'])
 def return_qs():
-    jsonResponse = convert_readmission_to_json(readmissionDF)
-    response = Response(jsonResponse, mimetype='application/json')
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET'
-    response.headers['Access-Control-Allow-Headers'] = 'X-Requested-With'
-    return response
+    return respond(referenceStore.current().readmissionPayload)
+
+@app.route('/v1/get-reference-density', methods=['GET'])
+def density_qs():
+    try:
+        patientAge = int(request.args.get('ages'))
+        numBins = int(request.args.get('bins', defaultDensityBins))
+    except (TypeError, ValueError):
+        return bad_request("Expected integer ages and bins.")
+    if patientAge < 0:
+        return bad_request("ages must not be negative")
+    if not 1 <= numBins <= maxDensityBins:
+        return bad_request("bins must be between 1 and " + str(maxDensityBins) + ".")
+    return respond(referenceStore.current().density_payload(bucket_of(patientAge), numBins))
+
+@app.route('/v1/get-reference-percentile', methods=['GET'])
+def percentile_qs():
+    try:
+        minAge, maxAge = age_range_of(request.args)
+        severity = finite_float(request.args, 'severity')
+        mortality = finite_float(request.args, 'mortality')
+    except (KeyError, ValueError) as e:
+        return bad_request("Expected ages or minAge/maxAge, and severity and mortality: " + str(e))
+    with stage('percentile_ranks'):
+        result = referenceStore.current().percentile_ranks(minAge, maxAge, severity, mortality)
+    result.update({'minAge': minAge, 'maxAge': maxAge})
+    return add_cors_headers(Response(json.dumps(result), mimetype='application/json'))
+
+def setup(prefork=False):
+    '''
+    Loads the data and builds the payloads before the first request. Run by gunicorn in the
+    master process, so that the workers it forks share them (see gunicorn.conf.py).
+    '''
+    referenceStore.load()
+
+def start_worker():
+    pass
 
 if __name__ == '__main__':
+    setup()
     # Start up the Flask app server.
     app.run(host='0.0.0.0', port=port, debug=True)
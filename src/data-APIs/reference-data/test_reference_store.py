@@ -0,0 +1,81 @@
+'''
+Tests of the age buckets and percentile ranks of the reference data:
+
+    python -m unittest test_reference_store
+'''
+import unittest
+import numpy as np
+import pandas as pd
+from reference_store import RankIndex, ReferenceTables, ageBuckets, bucket_of, percentile_rank
+
+
+def brute_force_rank(values, score):
+    values = np.asarray(values)
+    return 100.0 * ((values < score).sum() + (values <= score).sum()) / 2 / len(values)
+
+
+def reference_frame(numRows, seed=3):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({'age': rng.randint(0, 90, numRows).astype(float),
+                         # Few distinct values, so that many scores are equal
+                         'avg_severity': rng.randint(0, 5, numRows) / 2.0,
+                         'avg_mortality': np.round(rng.uniform(0, 4, numRows), 2)})
+
+
+def readmission_frame():
+    return pd.DataFrame({'readmissionRate': [0.1, 0.2], 'date': ['2016-01-04', '2016-01-11']})
+
+
+class RankIndexTest(unittest.TestCase):
+
+    def test_count_below(self):
+        rng = np.random.RandomState(1)
+        values = rng.randint(0, 20, 1000) / 4.0
+        index = RankIndex(values)
+        for score in [-1, 0, 0.25, 1.5, 2.6, 4.75, 5, 10]:
+            self.assertEqual(index.count_below(score), (values < score).sum())
+            self.assertEqual(index.count_below(score, inclusive=True), (values <= score).sum())
+            self.assertAlmostEqual(index.percentile_rank(score), brute_force_rank(values, score))
+
+    def test_empty(self):
+        self.assertEqual(RankIndex(np.array([])).percentile_rank(1.0), None)
+        self.assertEqual(percentile_rank(np.array([]), 1.0), None)
+
+
+class ReferenceTablesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.df = reference_frame(5000)
+        cls.tables = ReferenceTables(cls.df, readmission_frame(), [0, 0])
+
+    def rows_of(self, minAge, maxAge):
+        ages = self.df.age
+        return self.df[(ages >= minAge) & ((ages < maxAge) if maxAge is not None else True)]
+
+    def test_bucket_of(self):
+        self.assertEqual(ageBuckets[0], (1, 25))
+        self.assertEqual([bucket_of(age) for age in [0, 1, 24, 25, 49, 50, 89]], [0, 0, 0, 1, 1, 2, 2])
+
+    def test_buckets_leave_out_age_zero(self):
+        # As the 1-25 bucket always did
+        bucket = self.tables.bucket(0)
+        self.assertEqual(len(bucket), len(self.rows_of(1, 25)))
+        self.assertTrue((bucket.age >= 1).all())
+
+    def test_percentile_ranks(self):
+        ranges = ageBuckets + [(0, 25), (30, 40), (89, None), (95, None)]
+        for minAge, maxAge in ranges:
+            rows = self.rows_of(minAge, maxAge)
+            for severity, mortality in [(0, 0), (1, 1.5), (2.5, 3.99), (10, 10)]:
+                ranks = self.tables.percentile_ranks(minAge, maxAge, severity, mortality)
+                self.assertEqual(ranks['count'], len(rows))
+                if len(rows) == 0:
+                    self.assertEqual(ranks['comorbid_severity'], None)
+                    continue
+                self.assertAlmostEqual(ranks['comorbid_severity'], brute_force_rank(rows.avg_severity, severity))
+                self.assertAlmostEqual(ranks['comorbid_mortality'], brute_force_rank(rows.avg_mortality, mortality))
+
+
+if __name__ == '__main__':
+    unittest.main()
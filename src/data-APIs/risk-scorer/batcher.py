@@ -0,0 +1,148 @@
+import threading
+import time
+import Queue
+
+
+class BatcherFull(Exception):
+    '''
+    Raised when too many requests are already waiting to be scored.
+    '''
+    pass
+
+
+class BatcherTimeout(Exception):
+    '''
+    Raised when a request was not scored within its timeout.
+    '''
+    pass
+
+
+class PendingRequest(object):
+
+    def __init__(self, admissionIDs, deadline=None):
+        self.admissionIDs = admissionIDs
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    '''
+    Coalesces concurrent scoring requests into batches. The first request that arrives opens a
+    window of 'window' seconds; every request that arrives before the window closes, up to
+    maxBatchSize admission ids, is scored together in a single call to scoreFn and the results
+    are handed back to each caller. A request with more than maxBatchSize ids is split into
+    chunks of maxBatchSize, which are scored in batches of their own. At most maxPending chunks
+    can wait for a batch, after that submit raises BatcherFull so callers can be turned away
+    instead of piling up. Chunks whose caller stopped waiting are dropped without being scored.
+
+    scoreFn takes a list of admission ids and returns the ids that were found and their
+    probabilities.
+    '''
+
+    def __init__(self, scoreFn, window=0.01, maxBatchSize=1000, maxPending=1000, numWorkers=1):
+        self.scoreFn = scoreFn
+        self.window = window
+        self.maxBatchSize = maxBatchSize
+        self.numWorkers = numWorkers
+        self.queue = Queue.Queue(maxsize=maxPending)
+        self._threads = []
+
+    def start(self):
+        for i in xrange(self.numWorkers):
+            thread = threading.Thread(target=self._run, name='score-batcher-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, admissionIDs, timeout=None):
+        '''
+        Input: a list of admission ids and the number of seconds to wait for the scores
+        Output: a dict of admission id to probability for the ids that were found
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
+        chunks = [PendingRequest(admissionIDs[start:start + self.maxBatchSize], deadline)
+                  for start in xrange(0, max(len(admissionIDs), 1), self.maxBatchSize)]
+        for ix, pending in enumerate(chunks):
+            try:
+                self.queue.put_nowait(pending)
+            except Queue.Full:
+                # The chunks that were queued are dropped by the workers
+                for queued in chunks[:ix]:
+                    queued.deadline = 0
+                raise BatcherFull("{0} requests are already waiting to be scored".format(self.queue.maxsize))
+
+        result = {}
+        for pending in chunks:
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0 or not pending.done.wait(remaining):
+                for queued in chunks:
+                    queued.deadline = 0
+                raise BatcherTimeout("Scores were not ready after {0} seconds".format(timeout))
+            if pending.error is not None:
+                raise pending.error
+            result.update(pending.result)
+        return result
+
+    def _next(self, timeout=None):
+        '''
+        Output: the next pending chunk whose caller is still waiting for it
+        Description: raises Queue.Empty when there is none within the timeout.
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise Queue.Empty()
+            pending = self.queue.get(timeout=remaining)
+            if not self._drop_expired(pending):
+                return pending
+
+    def _drop_expired(self, pending):
+        '''
+        Output: True when the caller of the chunk stopped waiting for it, which is then dropped
+        '''
+        if pending.deadline is None or pending.deadline > time.time():
+            return False
+        pending.error = BatcherTimeout("Dropped after its deadline")
+        pending.done.set()
+        return True
+
+    def _run(self):
+        carried = None
+        while True:
+            first = carried if carried is not None and not self._drop_expired(carried) else self._next()
+            carried = None
+            batch = [first]
+            batchSize = len(first.admissionIDs)
+            deadline = time.time() + self.window
+            while batchSize < self.maxBatchSize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._next(timeout=remaining)
+                except Queue.Empty:
+                    break
+                if batchSize + len(pending.admissionIDs) > self.maxBatchSize:
+                    # Start the next batch with it rather than going over the limit
+                    carried = pending
+                    break
+                batch.append(pending)
+                batchSize += len(pending.admissionIDs)
+            self._score(batch)
+
+    def _score(self, batch):
+        admissionIDs = list(set(admissionID for pending in batch for admissionID in pending.admissionIDs))
+        try:
+            foundIDs, probabilities = self.scoreFn(admissionIDs)
+            scores = dict(zip(foundIDs, probabilities))
+            for pending in batch:
+                pending.result = {admissionID: scores[admissionID]
+                                  for admissionID in pending.admissionIDs if admissionID in scores}
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        for pending in batch:
+            pending.done.set()
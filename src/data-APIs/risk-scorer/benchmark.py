@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+'''
+Times each stage of the risk-scorer pipeline on synthetic data.
+
+The synthetic admissions, patients and DRG codes tables have the columns of the PSVs in
+record-getter/data and draw their categorical values from them. Each stage is timed separately
+for every combination of table size and batch size, and every measurement is written as one JSON
+line, so two runs can be compared with --compare.
+
+    python benchmark.py --scales 1000,100000 --batch-sizes 1,10,100,1000,10000 --output run.jsonl
+    python benchmark.py --compare baseline.jsonl run.jsonl
+
+The Spark stages (get_patient_data, pre_process_patients, vectorize_data, take_parallelize and
+predict_proba) run against a local SparkContext and are left out with --no-spark. Spark evaluates
+lazily, so each Spark stage is timed until its result has been materialized with cache() and
+count().
+'''
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import datetime
+import platform
+import numpy as np
+from encoder import readmissionEncoder
+from forest import CompiledForest, random_features
+from feature_store import FeatureTable, dictionary_encode, categoricalCols
+
+
+dataDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'record-getter', 'data')
+
+admissionCols = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'ADMITTIME', 'DISCHTIME', 'DEATHTIME', 'ADMISSION_TYPE',
+                 'ADMISSION_LOCATION', 'DISCHARGE_LOCATION', 'INSURANCE', 'LANGUAGE', 'RELIGION',
+                 'MARITAL_STATUS', 'ETHNICITY', 'EDREGTIME', 'EDOUTTIME', 'DIAGNOSIS',
+                 'HOSPITAL_EXPIRE_FLAG', 'HAS_IOEVENTS_DATA', 'HAS_CHARTEVENTS_DATA']
+patientCols = ['ROW_ID', 'SUBJECT_ID', 'GENDER', 'DOB', 'DOD', 'DOD_HOSP', 'DOD_SSN', 'EXPIRE_FLAG']
+codeCols = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'DRG_TYPE', 'DRG_CODE', 'DESCRIPTION', 'DRG_SEVERITY', 'DRG_MORTALITY']
+
+# Columns whose values are sampled from the sample PSVs
+sampledAdmissionCols = ['ADMISSION_TYPE', 'ADMISSION_LOCATION', 'DISCHARGE_LOCATION', 'INSURANCE', 'LANGUAGE',
+                        'RELIGION', 'MARITAL_STATUS', 'ETHNICITY', 'DIAGNOSIS']
+sampledPatientCols = ['GENDER']
+sampledCodeCols = ['DRG_TYPE', 'DRG_CODE', 'DESCRIPTION', 'DRG_SEVERITY', 'DRG_MORTALITY']
+
+# Ratios observed in the sample PSVs
+patientsPerAdmission = 0.8
+codesPerAdmission = 2.3
+
+
+def value_distributions(path, cols):
+    '''
+    Input: a PSV file and the columns to summarize
+    Output: a dict of column name to (distinct values, their frequencies)
+    '''
+    counts = {col: {} for col in cols}
+    with open(path) as f:
+        for row in csv.DictReader(f, delimiter='|'):
+            for col in cols:
+                value = None if row[col] == 'null' else row[col]
+                counts[col][value] = counts[col].get(value, 0) + 1
+    distributions = {}
+    for col in cols:
+        values = counts[col].keys()
+        frequencies = np.array([counts[col][v] for v in values], dtype=np.float64)
+        distributions[col] = (values, frequencies / frequencies.sum())
+    return distributions
+
+
+def sample(rng, distribution, size):
+    values, frequencies = distribution
+    return [values[ix] for ix in rng.choice(len(values), size, p=frequencies)]
+
+
+def epoch_seconds(year):
+    return (datetime.datetime(year, 1, 1) - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def format_times(epochSeconds):
+    return [datetime.datetime.utcfromtimestamp(s).strftime('%Y-%m-%d %H:%M:%S') for s in epochSeconds]
+
+
+def generate_tables(numAdmissions, outDir, seed=42):
+    '''
+    Input: the number of admissions and the directory to write the CSVs to
+    Output: the paths of the admissions, patients and DRG codes CSVs, in the order of
+    helpers.sourcePaths
+    '''
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    admissionValues = value_distributions(os.path.join(dataDir, 'discharge-admissions.psv'), sampledAdmissionCols)
+    patientValues = value_distributions(os.path.join(dataDir, 'discharge-patients.psv'), sampledPatientCols)
+    codeValues = value_distributions(os.path.join(dataDir, 'discharge-comorbids.psv'), sampledCodeCols)
+
+    numPatients = max(1, int(numAdmissions * patientsPerAdmission))
+    subjectIDs = np.arange(1, numPatients + 1)
+    hadmIDs = 100000 + rng.permutation(numAdmissions * 2)[:numAdmissions]
+    admissionSubjects = np.concatenate([subjectIDs, rng.choice(subjectIDs, numAdmissions - numPatients)])[:numAdmissions]
+
+    # Dates in the shifted years of the sample data
+    dob = rng.uniform(epoch_seconds(2050), epoch_seconds(2150), numPatients)
+    admit = dob[admissionSubjects - 1] + rng.uniform(0, 90 * 365 * 86400, numAdmissions)
+    discharge = admit + rng.uniform(86400, 30 * 86400, numAdmissions)
+
+    paths = [os.path.join(outDir, name) for name in ['admissions.csv', 'patients.csv', 'drgcodes.csv']]
+
+    columns = {'ROW_ID': np.arange(numAdmissions), 'SUBJECT_ID': admissionSubjects, 'HADM_ID': hadmIDs,
+               'ADMITTIME': format_times(admit), 'DISCHTIME': format_times(discharge),
+               'DEATHTIME': [None] * numAdmissions, 'EDREGTIME': [None] * numAdmissions,
+               'EDOUTTIME': [None] * numAdmissions, 'HOSPITAL_EXPIRE_FLAG': np.zeros(numAdmissions, dtype=int),
+               'HAS_IOEVENTS_DATA': np.ones(numAdmissions, dtype=int),
+               'HAS_CHARTEVENTS_DATA': np.ones(numAdmissions, dtype=int)}
+    for col in sampledAdmissionCols:
+        columns[col] = sample(rng, admissionValues[col], numAdmissions)
+    write_csv(paths[0], admissionCols, columns, numAdmissions)
+
+    columns = {'ROW_ID': np.arange(numPatients), 'SUBJECT_ID': subjectIDs, 'DOB': format_times(dob),
+               'DOD': [None] * numPatients, 'DOD_HOSP': [None] * numPatients, 'DOD_SSN': [None] * numPatients,
+               'EXPIRE_FLAG': np.zeros(numPatients, dtype=int)}
+    for col in sampledPatientCols:
+        columns[col] = sample(rng, patientValues[col], numPatients)
+    write_csv(paths[1], patientCols, columns, numPatients)
+
+    numCodes = int(numAdmissions * codesPerAdmission)
+    codeAdmissions = rng.randint(0, numAdmissions, numCodes)
+    columns = {'ROW_ID': np.arange(numCodes), 'SUBJECT_ID': admissionSubjects[codeAdmissions],
+               'HADM_ID': hadmIDs[codeAdmissions]}
+    for col in sampledCodeCols:
+        columns[col] = sample(rng, codeValues[col], numCodes)
+    write_csv(paths[2], codeCols, columns, numCodes)
+    return paths, hadmIDs
+
+
+def write_csv(path, cols, columns, numRows):
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(cols)
+        values = [columns[col] for col in cols]
+        for ix in xrange(numRows):
+            writer.writerow(['' if v[ix] is None else v[ix] for v in values])
+
+
+def random_forest(numTrees=20, maxDepth=6, seed=42):
+    '''
+    Output: a CompiledForest of complete trees with random splits, shaped like the production
+    model (20 trees of depth 6), for timing the compiled engine without a trained model
+    '''
+    rng = np.random.RandomState(seed)
+    nodesPerTree = 2 ** (maxDepth + 1) - 1
+    numInternal = 2 ** maxDepth - 1
+    feature, threshold, left, right, value, roots = [], [], [], [], [], []
+    for tree in xrange(numTrees):
+        offset = tree * nodesPerTree
+        roots.append(offset)
+        for node in xrange(nodesPerTree):
+            if node < numInternal:
+                feature.append(rng.randint(6, 9))
+                threshold.append(rng.uniform(0, 4))
+                left.append(offset + 2 * node + 1)
+                right.append(offset + 2 * node + 2)
+                value.append(0.0)
+            else:
+                feature.append(-1)
+                threshold.append(0.0)
+                left.append(-1)
+                right.append(-1)
+                value.append(float(rng.randint(0, 2)))
+    return CompiledForest(feature, threshold, np.zeros(len(feature)), left, right, value, roots, maxDepth)
+
+
+def synthetic_feature_table(hadmIDs, seed=42):
+    '''
+    Output: a FeatureTable of joined rows for hadmIDs, without going through Spark
+    '''
+    rng = np.random.RandomState(seed)
+    admissionValues = value_distributions(os.path.join(dataDir, 'discharge-admissions.psv'), sampledAdmissionCols)
+    patientValues = value_distributions(os.path.join(dataDir, 'discharge-patients.psv'), sampledPatientCols)
+    n = len(hadmIDs)
+    columns = {'HADM_ID': np.asarray(hadmIDs, dtype=np.int64),
+               'SUBJECT_ID': np.arange(n, dtype=np.int64),
+               'AGE': np.round(rng.uniform(18, 91, n)),
+               'AVG_DRG_SEVERITY': rng.randint(0, 5, n).astype(np.float64),
+               'AVG_DRG_MORTALITY': rng.randint(0, 5, n).astype(np.float64)}
+    categories = {}
+    for col in categoricalCols:
+        distribution = patientValues[col] if col in patientValues else admissionValues[col]
+        columns[col], categories[col] = dictionary_encode(sample(rng, distribution, n))
+    table = FeatureTable(columns, categories, None, [])
+    allRows = np.arange(n)
+    table.features = readmissionEncoder.encode({col: table.column(col, allRows) for col in readmissionEncoder.columns()})
+    return table
+
+
+def time_stage(fn, repeats):
+    '''
+    Output: the result of the last call to fn, and the wall-clock seconds of every call
+    '''
+    seconds = []
+    result = None
+    for _ in xrange(repeats):
+        start = time.time()
+        result = fn()
+        seconds.append(time.time() - start)
+    return result, seconds
+
+
+def record(results, stage, engine, numAdmissions, batchSize, seconds):
+    result = {'stage': stage,
+              'engine': engine,
+              'admissions': numAdmissions,
+              'batchSize': batchSize,
+              'repeats': len(seconds),
+              'minSeconds': min(seconds),
+              'medianSeconds': float(np.median(seconds)),
+              'rowsPerSecond': batchSize / max(float(np.median(seconds)), 1e-9)}
+    results.append(result)
+    print >> sys.stderr, "{stage:>24} {engine:>8} admissions={admissions:<8} batch={batchSize:<6} " \
+                         "median={medianSeconds:.6f}s".format(**result)
+
+
+def run_numpy_stages(results, table, forest, numAdmissions, batchSize, repeats, rng):
+    admissionIDs = rng.choice(table.columns['HADM_ID'], batchSize).tolist()
+    (foundIDs, rows), seconds = time_stage(lambda: table.rows(admissionIDs), repeats)
+    record(results, 'feature_lookup', 'numpy', numAdmissions, batchSize, seconds)
+    columns = {col: table.column(col, rows) for col in readmissionEncoder.columns()}
+    features, seconds = time_stage(lambda: readmissionEncoder.encode(columns), repeats)
+    record(results, 'encode', 'numpy', numAdmissions, batchSize, seconds)
+    _, seconds = time_stage(lambda: forest.predict_proba(features), repeats)
+    record(results, 'predict_proba', 'compiled', numAdmissions, batchSize, seconds)
+
+
+def setup_spark_stages():
+    '''
+    Output: a SparkContext, a SQLContext and a RandomForestModel trained on random features
+    '''
+    from helpers import setup_spark
+    from pyspark.sql import SQLContext
+    from pyspark.mllib.regression import LabeledPoint
+    from pyspark.mllib.tree import RandomForest
+    sc = setup_spark()
+    features = random_features(1000)
+    labels = np.random.RandomState(42).randint(0, 2, len(features))
+    points = sc.parallelize([LabeledPoint(label, row) for label, row in zip(labels, features)])
+    model = RandomForest.trainClassifier(points, numClasses=2,
+                                         categoricalFeaturesInfo={0: 4, 1: 6, 2: 3, 3: 6, 4: 4, 5: 9},
+                                         numTrees=20, maxDepth=6, seed=42)
+    return sc, SQLContext(sc), model
+
+
+def run_spark_stages(results, spark, paths, hadmIDs, numAdmissions, batchSize, repeats, rng):
+    from helpers import get_patient_data, pre_process_patients, vectorize_data, predict_proba
+    sc, sqlContext, model = spark
+    admissionIDs = rng.choice(hadmIDs, batchSize).tolist()
+
+    def materialize(df):
+        df.cache()
+        df.count()
+        return df
+
+    joined, seconds = time_stage(lambda: materialize(get_patient_data(admissionIDs, sqlContext, paths)), repeats)
+    record(results, 'get_patient_data', 'spark', numAdmissions, batchSize, seconds)
+    data, seconds = time_stage(lambda: materialize(pre_process_patients(joined, sqlContext)), repeats)
+    record(results, 'pre_process_patients', 'spark', numAdmissions, batchSize, seconds)
+    vectors, seconds = time_stage(lambda: materialize(vectorize_data(data)), repeats)
+    record(results, 'vectorize_data', 'spark', numAdmissions, batchSize, seconds)
+    dataPts, seconds = time_stage(lambda: sc.parallelize(vectors.take(batchSize)), repeats)
+    record(results, 'take_parallelize', 'spark', numAdmissions, batchSize, seconds)
+    _, seconds = time_stage(lambda: predict_proba(model, dataPts), repeats)
+    record(results, 'predict_proba', 'spark', numAdmissions, batchSize, seconds)
+
+
+def compare(baselinePath, currentPath, threshold):
+    '''
+    Prints the change in median time of every measurement found in both runs.
+    Output: the number of measurements that got slower by more than threshold
+    '''
+    def load(path):
+        with open(path) as f:
+            results = [json.loads(line) for line in f if line.strip()]
+        return {(r['stage'], r['engine'], r['admissions'], r['batchSize']): r
+                for r in results if 'stage' in r}
+
+    baseline, current = load(baselinePath), load(currentPath)
+    regressions = 0
+    for key in sorted(set(baseline) & set(current)):
+        ratio = current[key]['medianSeconds'] / max(baseline[key]['medianSeconds'], 1e-9)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        print "{0:>24} {1:>8} admissions={2:<8} batch={3:<6} {4:6.2f}x {5}".format(key[0], key[1], key[2], key[3], ratio, flag)
+    return regressions
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the risk-scorer pipeline.')
+    parser.add_argument('--scales', type=parse_list, default=[1000, 100000, 1000000],
+                        help='comma separated numbers of synthetic admissions')
+    parser.add_argument('--batch-sizes', type=parse_list, default=[1, 10, 100, 1000, 10000],
+                        help='comma separated numbers of admission ids scored per call')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--data-dir', default='benchmark-data',
+                        help='where the synthetic CSVs are written')
+    parser.add_argument('--output', help='JSON lines file for the results, stdout by default')
+    parser.add_argument('--no-spark', action='store_true', help='only run the in-process stages')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='compare two result files instead of running the benchmark')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown ratio reported as a regression by --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    spark = None if args.no_spark else setup_spark_stages()
+    forest = random_forest()
+    rng = np.random.RandomState(42)
+    results = []
+    for numAdmissions in args.scales:
+        scaleDir = os.path.join(args.data_dir, str(numAdmissions))
+        paths, hadmIDs = generate_tables(numAdmissions, scaleDir)
+        table = synthetic_feature_table(hadmIDs)
+        for batchSize in args.batch_sizes:
+            if batchSize > numAdmissions:
+                continue
+            run_numpy_stages(results, table, forest, numAdmissions, batchSize, args.repeats, rng)
+            if spark is not None:
+                run_spark_stages(results, spark, paths, hadmIDs, numAdmissions, batchSize, args.repeats, rng)
+
+    run = {'run': {'timestamp': datetime.datetime.utcnow().isoformat(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'host': platform.node(),
+                   'spark': spark is not None}}
+    output = open(args.output, 'w') if args.output else sys.stdout
+    for result in [run] + results:
+        output.write(json.dumps(result) + '\n')
+    if args.output:
+        output.close()
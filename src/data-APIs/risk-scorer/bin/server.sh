@@ -50,5 +50,9 @@ export SPARK_HOME=`pwd`/${SPARK_DIST}
 #DBG ls $SPARK_HOME
 export PYTHONPATH=$PYTHONPATH:${SPARK_HOME}/python:${SPARK_HOME}/python/lib/py4j-0.8.2.1-src.zip
 
-python server.py
+# SERVING_MODE=prefork loads the data once and serves it from several gunicorn workers (see gunicorn.conf.py)
+if [ "$SERVING_MODE" = "prefork" ]; then
+    exec gunicorn -c gunicorn.conf.py server:app
+fi
 
+python server.py
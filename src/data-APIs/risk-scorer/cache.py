@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ScoreCache(object):
+    '''
+    A bounded cache of risk scores keyed by (HADM_ID, model version, feature hash), so an
+    admission is only scored again when the model or its features change. Entries expire 'ttl'
+    seconds after they were stored and the least recently used entry is evicted once the cache
+    holds maxSize entries. Setting a new model version drops every entry of the old one.
+    '''
+
+    def __init__(self, maxSize=100000, ttl=3600):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.modelVersion = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_model_version(self, modelVersion):
+        with self._lock:
+            if modelVersion != self.modelVersion:
+                self._entries.clear()
+                self.modelVersion = modelVersion
+
+    def key(self, admissionID, modelVersion, features):
+        '''
+        Input: an admission id, the version of the model scoring it and its 1D array of features
+        Output: the cache key of the admission
+        '''
+        return (admissionID, modelVersion, hash(features.tobytes()))
+
+    def get_many(self, keys):
+        '''
+        Input: a list of cache keys
+        Output: a dict of key to probability for the keys that are in the cache
+        '''
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is None or entry[0] < now:
+                    self.misses += 1
+                    continue
+                # Re-insert to mark the entry as the most recently used
+                self._entries[key] = entry
+                found[key] = entry[1]
+                self.hits += 1
+        return found
+
+    def put_many(self, keys, probabilities):
+        if self.maxSize <= 0:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key, probability in zip(keys, probabilities):
+                if key[1] != self.modelVersion:
+                    # Scored by a model that has been replaced since
+                    continue
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, probability)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'maxSize': self.maxSize,
+                    'ttl': self.ttl,
+                    'modelVersion': self.modelVersion,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
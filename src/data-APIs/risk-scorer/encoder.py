@@ -0,0 +1,211 @@
+import json
+import numpy as np
+
+
+class CategoricalEncoder(object):
+    '''
+    Encodes the joined patient data into the numeric features the model was trained on.
+
+    Each categorical feature is a list of rules that are tried in order, the first rule that
+    matches gives the code of the value and the default is used when none matches. A rule is a
+    list of [column, kind, pattern, code] where kind is one of:
+
+        'exact'    - the value equals pattern, e.g. LIKE 'MARRIED'
+        'prefix'   - the value starts with pattern, e.g. LIKE 'WHITE%'
+        'contains' - the value contains pattern, e.g. LIKE '%MIDDLE EASTERN%'
+
+    Null values never match a rule, like in SQL. Numeric features are copied from their column,
+    with nulls filled and values above a cap replaced. The same encoder can write itself out as
+    the Spark SQL used by pre_process_patients, so training and serving share one definition.
+    '''
+
+    def __init__(self, features, version=1):
+        self.features = features
+        self.version = version
+        self.featureCols = [feature['name'] for feature in features]
+
+    def columns(self):
+        '''
+        Output: the names of the source columns the encoder reads
+        '''
+        names = []
+        for feature in self.features:
+            sources = [rule[0] for rule in feature.get('rules', [])] + [feature.get('column')]
+            names.extend(name for name in sources if name is not None and name not in names)
+        return names
+
+    def encode(self, columns):
+        '''
+        Input: a dict of source column name to a 1D array of values
+        Output: a 2D float64 array with one row per value and one column per feature
+        Description: each rule is evaluated once per distinct value of its column and the result
+        is broadcast back to the rows, so the cost of the string matching does not grow with
+        the number of rows.
+        '''
+        numRows = len(columns[self.columns()[0]])
+        encoded = np.empty((numRows, len(self.features)), dtype=np.float64)
+        matchTables = {}
+        for ix, feature in enumerate(self.features):
+            if 'rules' not in feature:
+                encoded[:, ix] = encode_numeric(feature, columns[feature['column']])
+                continue
+            values = np.full(numRows, feature['default'], dtype=np.float64)
+            assigned = np.zeros(numRows, dtype=bool)
+            for column, kind, pattern, code in feature['rules']:
+                if column not in matchTables:
+                    matchTables[column] = distinct_values(columns[column])
+                isNull, distinct, inverse = matchTables[column]
+                matches = np.array([match(value, kind, pattern) for value in distinct], dtype=bool)
+                matched = matches[inverse] & ~isNull & ~assigned
+                values[matched] = code
+                assigned |= matched
+            encoded[:, ix] = values
+        return encoded
+
+    def arities(self):
+        '''
+        Output: a dict of the index of each categorical feature to its number of codes, the
+        categoricalFeaturesInfo of MLlib's RandomForest
+        '''
+        return {ix: int(max([rule[3] for rule in feature['rules']] + [feature['default']])) + 1
+                for ix, feature in enumerate(self.features) if 'rules' in feature}
+
+    def to_sql(self, table, keyCols=['HADM_ID']):
+        '''
+        Input: the name of a registered table with the source columns
+        Output: a Spark SQL query that encodes the table the same way as encode
+        '''
+        selects = list(keyCols)
+        for feature in self.features:
+            if 'rules' not in feature:
+                selects.append(numeric_to_sql(feature))
+                continue
+            cases = ["WHEN {0} THEN {1}".format(rule_to_sql(column, kind, pattern), float(code))
+                     for column, kind, pattern, code in feature['rules']]
+            selects.append("CASE {0} ELSE {1} END as {2}".format(' '.join(cases),
+                                                                 float(feature['default']),
+                                                                 feature['name']))
+        return "SELECT {0} FROM {1}".format(',\n'.join(selects), table)
+
+    def to_dict(self):
+        return {'version': self.version, 'features': self.features}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls([dict(feature) for feature in d['features']], version=d['version'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def distinct_values(values):
+    '''
+    Input: a 1D array of strings that may contain None
+    Output: the null mask, the distinct values and the index of each row's value in them
+    '''
+    values = np.asarray(values, dtype=object)
+    isNull = np.equal(values, None)
+    distinct, inverse = np.unique(np.where(isNull, u'', values).astype(np.unicode_), return_inverse=True)
+    return isNull, distinct, inverse
+
+
+def match(value, kind, pattern):
+    if kind == 'exact':
+        return value == pattern
+    if kind == 'prefix':
+        return value.startswith(pattern)
+    if kind == 'contains':
+        return pattern in value
+    raise ValueError("Unknown rule kind: {0}".format(kind))
+
+
+def encode_numeric(feature, values):
+    values = np.array(values, dtype=np.float64)
+    if 'fillna' in feature:
+        values[np.isnan(values)] = feature['fillna']
+    if 'cap' in feature:
+        limit, replacement = feature['cap']
+        with np.errstate(invalid='ignore'):
+            values[values > limit] = replacement
+    return values
+
+
+def rule_to_sql(column, kind, pattern):
+    pattern = pattern.replace("'", "''")
+    if kind == 'exact':
+        return "{0} = '{1}'".format(column, pattern)
+    if kind == 'prefix':
+        return "{0} LIKE '{1}%'".format(column, pattern)
+    if kind == 'contains':
+        return "{0} LIKE '%{1}%'".format(column, pattern)
+    raise ValueError("Unknown rule kind: {0}".format(kind))
+
+
+def numeric_to_sql(feature):
+    expression = feature['column']
+    if 'fillna' in feature:
+        expression = "IF ({0} IS NULL, {1}, {0})".format(expression, feature['fillna'])
+    if 'cap' in feature:
+        limit, replacement = feature['cap']
+        expression = "IF ({0} > {1}, {2}, {0})".format(expression, limit, replacement)
+    return "{0} as {1}".format(expression, feature['name'])
+
+
+# The encoding of the readmission-scorer-v1 model.
+# Ordinarily the best practice would be to use StringIndexer, but the ability to save a fitted
+# StringIndexer is not currently available in Spark 1.5 or 1.6.
+readmissionEncoder = CategoricalEncoder([
+    {'name': 'admission_type',
+     'rules': [['ADMISSION_TYPE', 'exact', 'NEWBORN', 0.0],
+               ['ADMISSION_TYPE', 'exact', 'EMERGENCY', 1.0],
+               ['ADMISSION_TYPE', 'exact', 'URGENT', 2.0]],
+     'default': 3.0},
+    {'name': 'insurance',
+     'rules': [['INSURANCE', 'exact', 'Private', 0.0],
+               ['INSURANCE', 'exact', 'Medicare', 1.0],
+               ['INSURANCE', 'exact', 'Medicaid', 2.0],
+               ['INSURANCE', 'exact', 'Government', 3.0],
+               ['INSURANCE', 'exact', 'Self Pay', 4.0]],
+     'default': 5.0},
+    {'name': 'gender',
+     'rules': [['GENDER', 'exact', 'M', 0.0],
+               ['GENDER', 'exact', 'F', 1.0]],
+     'default': 2.0},
+    {'name': 'ethn',
+     'rules': [['ETHNICITY', 'prefix', 'WHITE', 0.0],
+               ['ETHNICITY', 'prefix', 'EUROPEAN', 0.0],
+               ['ETHNICITY', 'prefix', 'PORTUGUESE', 0.0],
+               ['ETHNICITY', 'prefix', 'BLACK', 1.0],
+               ['ETHNICITY', 'prefix', 'AFRICAN', 1.0],
+               ['ETHNICITY', 'prefix', 'HISPANIC', 2.0],
+               ['ETHNICITY', 'prefix', 'LATINO', 2.0],
+               ['ETHNICITY', 'contains', 'MIDDLE EASTERN', 3.0],
+               ['ETHNICITY', 'prefix', 'ASIAN', 4.0],
+               ['ETHNICITY', 'contains', 'ASIAN - INDIAN', 4.0]],
+     'default': 5.0},
+    {'name': 'lang',
+     'rules': [['ADMISSION_TYPE', 'exact', 'NEWBORN', 0.0],
+               ['LANGUAGE', 'exact', 'ENGL', 1.0],
+               ['LANGUAGE', 'exact', '', 2.0]],
+     'default': 3.0},
+    {'name': 'status',
+     'rules': [['MARITAL_STATUS', 'exact', 'NEWBORN', 0.0],
+               ['MARITAL_STATUS', 'exact', '', 1.0],
+               ['MARITAL_STATUS', 'exact', 'LIFE PARTNER', 1.0],
+               ['MARITAL_STATUS', 'prefix', 'UNKNOWN', 2.0],
+               ['MARITAL_STATUS', 'exact', 'MARRIED', 3.0],
+               ['MARITAL_STATUS', 'exact', 'DIVORCED', 4.0],
+               ['MARITAL_STATUS', 'exact', 'SINGLE', 5.0],
+               ['MARITAL_STATUS', 'exact', 'WIDOWED', 6.0],
+               ['MARITAL_STATUS', 'exact', 'SEPARATED', 7.0]],
+     'default': 8.0},
+    {'name': 'avg_severity', 'column': 'AVG_DRG_SEVERITY', 'fillna': 0},
+    {'name': 'avg_mortality', 'column': 'AVG_DRG_MORTALITY', 'fillna': 0},
+    {'name': 'age', 'column': 'AGE', 'cap': [200, 91]},
+])
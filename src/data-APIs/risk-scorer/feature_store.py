@@ -0,0 +1,160 @@
+import threading
+import time
+import numpy as np
+from helpers import sourcePaths, load_source_tables, join_patient_data
+from encoder import readmissionEncoder
+
+
+# Columns of the joined table that are kept next to the encoded features
+numericCols = ['HADM_ID', 'SUBJECT_ID', 'AGE', 'AVG_DRG_SEVERITY', 'AVG_DRG_MORTALITY']
+categoricalCols = ['ADMISSION_TYPE', 'ETHNICITY', 'INSURANCE', 'LANGUAGE', 'MARITAL_STATUS', 'GENDER']
+
+
+class FeatureTable(object):
+    '''
+    An immutable, columnar copy of the joined patient data with one row per HADM_ID.
+    Numeric columns are NumPy arrays, categorical columns are dictionary encoded (int32 codes into
+    a list of distinct values) and the encoded model features are a 2D float64 array. Rows are
+    found through a hash index on HADM_ID.
+    '''
+
+    def __init__(self, columns, categories, features, modificationTimes):
+        self.columns = columns
+        self.categories = categories
+        self.features = features
+        self.modificationTimes = modificationTimes
+        self.index = {admissionID: row for row, admissionID in enumerate(columns['HADM_ID'].tolist())}
+
+    def __len__(self):
+        return len(self.columns['HADM_ID'])
+
+    def rows(self, admissionIDs):
+        '''
+        Input: a list of admission ids
+        Output: the ids that were found, and their row numbers
+        '''
+        found = [(admissionID, self.index.get(admissionID)) for admissionID in admissionIDs]
+        found = [f for f in found if f[1] is not None]
+        return [f[0] for f in found], np.array([f[1] for f in found], dtype=np.int64)
+
+    def column(self, name, rows):
+        if name in self.categories:
+            return np.array(self.categories[name], dtype=object)[self.columns[name][rows]]
+        return self.columns[name][rows]
+
+
+def dictionary_encode(values):
+    '''
+    Input: a list of values
+    Output: an int32 array of codes and the list of distinct values the codes point to
+    '''
+    lookup = {}
+    codes = np.array([lookup.setdefault(v, len(lookup)) for v in values], dtype=np.int32)
+    categories = [None] * len(lookup)
+    for value, code in lookup.iteritems():
+        categories[code] = value
+    return codes, categories
+
+
+def build_feature_table(sqlContext, paths=sourcePaths, encoder=readmissionEncoder):
+    '''
+    Input: a SQLContext, the locations of the admissions, patients and DRG codes CSVs and a
+    CategoricalEncoder
+    Output: a FeatureTable
+    Description: runs the joins from helpers once over the whole admissions table, brings the
+    result back to the driver and encodes it.
+    '''
+    modificationTimes = source_modification_times(sqlContext, paths)
+    df_admissions, df_patients, df_drgcodes = load_source_tables(sqlContext, paths)
+    joined = join_patient_data(df_admissions, df_patients, df_drgcodes, sqlContext)
+    names = joined.columns
+    rows = joined.collect()
+
+    columns = {}
+    categories = {}
+    for name in numericCols:
+        ix = names.index(name)
+        dtype = np.int64 if name in ['HADM_ID', 'SUBJECT_ID'] else np.float64
+        columns[name] = np.array([row[ix] for row in rows], dtype=dtype)
+    for name in categoricalCols:
+        ix = names.index(name)
+        columns[name], categories[name] = dictionary_encode([row[ix] for row in rows])
+    table = FeatureTable(columns, categories, None, modificationTimes)
+    allRows = np.arange(len(table))
+    table.features = encoder.encode({name: table.column(name, allRows) for name in encoder.columns()})
+    return table
+
+
+def source_modification_times(sqlContext, paths):
+    '''
+    Input: a SQLContext and a list of Hadoop file system paths
+    Output: the modification time of each path, in milliseconds
+    '''
+    sc = sqlContext._sc
+    hadoopConf = sc._jsc.hadoopConfiguration()
+    times = []
+    for path in paths:
+        hadoopPath = sc._jvm.org.apache.hadoop.fs.Path(path)
+        times.append(hadoopPath.getFileSystem(hadoopConf).getFileStatus(hadoopPath).getModificationTime())
+    return times
+
+
+class FeatureStore(object):
+    '''
+    Keeps the FeatureTable for every admission in memory so that scoring a list of admissions is a
+    keyed lookup instead of reading and joining the source CSVs. A background thread checks the
+    modification times of the sources every refreshInterval seconds and rebuilds the table when
+    they change; the new table replaces the old one in a single assignment, so lookups that are
+    already running keep reading a consistent table.
+    '''
+
+    def __init__(self, sqlContext, paths=sourcePaths, refreshInterval=300, encoder=readmissionEncoder):
+        self.sqlContext = sqlContext
+        self.paths = paths
+        self.encoder = encoder
+        self.refreshInterval = refreshInterval
+        self.table = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def load(self):
+        with self._lock:
+            self.table = build_feature_table(self.sqlContext, self.paths, self.encoder)
+        return self.table
+
+    def refresh(self):
+        '''
+        Rebuilds the table if any of the source files changed since it was built.
+        Output: True when the table was rebuilt
+        '''
+        if self.table is not None and \
+           source_modification_times(self.sqlContext, self.paths) == self.table.modificationTimes:
+            return False
+        self.load()
+        return True
+
+    def lookup(self, admissionIDs):
+        '''
+        Input: a list of admission ids
+        Output: the ids that were found, and a 2D NumPy array with their features
+        '''
+        table = self.table
+        foundIDs, rows = table.rows(admissionIDs)
+        return foundIDs, table.features[rows]
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._watch, name='feature-store-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.refreshInterval)
+            try:
+                if self.refresh():
+                    print "Feature store reloaded {0} admissions".format(len(self.table))
+            except Exception as e:
+                # Keep serving the current table, the next check will try again
+                print "Feature store refresh failed: ", e
@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+
+
+# The node arrays of a CompiledForest, in the order they are passed to its constructor
+nodeArrays = ['feature', 'threshold', 'categories', 'left', 'right', 'value', 'roots']
+
+
+class CompiledForest(object):
+    '''
+    A RandomForestModel flattened into NumPy node arrays so that it can be evaluated in-process,
+    without a SparkContext. The nodes of every tree are stored back to back in the same arrays and
+    'roots' holds the index of the top node of each tree. For a node i:
+
+        feature[i]      - index of the feature the node splits on, -1 for leaves
+        threshold[i]    - go left when x[feature] <= threshold (continuous splits)
+        categories[i]   - bitmask of the categories that go left, 0 for continuous splits
+        left[i], right[i] - indices of the child nodes, -1 for leaves
+        value[i]        - the class predicted by a leaf
+    '''
+
+    def __init__(self, feature, threshold, categories, left, right, value, roots, maxDepth, version=None):
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.categories = np.asarray(categories, dtype=np.uint64)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.maxDepth = int(maxDepth)
+        self.version = version if version is not None else self.fingerprint()
+
+    def numTrees(self):
+        return len(self.roots)
+
+    def fingerprint(self):
+        '''
+        Output: a hex digest of the node arrays, which changes whenever the model does
+        '''
+        digest = hashlib.sha1()
+        for name in nodeArrays:
+            digest.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        return digest.hexdigest()
+
+    def predict_proba(self, X):
+        '''
+        Input: a 2D array of feature vectors, one row per patient
+        Output: a 1D array of probabilities
+        Description: walks every tree of the forest over the whole batch at once, one tree level
+        per iteration, and averages the votes of the trees. This gives the same result as
+        helpers.predict_proba without starting a Spark job per tree.
+        '''
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        rows = np.arange(X.shape[0])[:, np.newaxis]
+        nodes = np.tile(self.roots, (X.shape[0], 1))
+
+        for _ in xrange(self.maxDepth):
+            features = self.feature[nodes]
+            isLeaf = features < 0
+            if isLeaf.all():
+                break
+            x = X[rows, np.where(isLeaf, 0, features)]
+            # Categorical splits send a value left when its bit is set in the category mask
+            masks = self.categories[nodes]
+            bits = np.clip(x, 0, 63).astype(np.uint64)
+            inCategories = ((masks >> bits) & np.uint64(1)).astype(bool) & (bits == x)
+            goLeft = np.where(masks != 0, inCategories, x <= self.threshold[nodes])
+            nodes = np.where(isLeaf, nodes, np.where(goLeft, self.left[nodes], self.right[nodes]))
+
+        return self.value[nodes].mean(axis=1)
+
+    def save(self, path):
+        '''
+        Writes the forest to the directory 'path' as one .npy file per node array and a meta.json,
+        so that it can be memory-mapped by load.
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in nodeArrays:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version': self.version,
+                       'numTrees': self.numTrees(),
+                       'maxDepth': self.maxDepth}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Input: a directory written by save
+        Output: a CompiledForest
+        Description: with mmap the node arrays are memory-mapped read-only instead of being read,
+        so loading takes milliseconds and every process that loads the same snapshot shares the
+        same pages of memory.
+        '''
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None, allow_pickle=False)
+                  for name in nodeArrays]
+        return cls(*arrays, maxDepth=meta['maxDepth'], version=meta['version'])
+
+
+def export_forest(model):
+    '''
+    Input: A PySpark RandomForestModel object
+    Output: A CompiledForest
+    Description: walks the nodes of every decision tree of the underlying Java model once and
+    copies the splits and leaf predictions into flat arrays.
+    '''
+    nodes = {'feature': [], 'threshold': [], 'categories': [], 'left': [], 'right': [], 'value': []}
+
+    def append_node(node, depth):
+        ix = len(nodes['feature'])
+        for col, default in [('feature', -1), ('threshold', 0.0), ('categories', 0),
+                             ('left', -1), ('right', -1), ('value', 0.0)]:
+            nodes[col].append(default)
+        if node.isLeaf():
+            nodes['value'][ix] = node.predict().predict()
+            return ix, depth
+        split = node.split().get()
+        nodes['feature'][ix] = split.feature()
+        if split.featureType().toString() == 'Continuous':
+            nodes['threshold'][ix] = split.threshold()
+        else:
+            nodes['categories'][ix] = categories_to_mask(split.categories().mkString(','))
+        nodes['left'][ix], leftDepth = append_node(node.leftNode().get(), depth + 1)
+        nodes['right'][ix], rightDepth = append_node(node.rightNode().get(), depth + 1)
+        return ix, max(leftDepth, rightDepth)
+
+    trees = model._java_model.trees()
+    roots = []
+    maxDepth = 0
+    for i in xrange(model.numTrees()):
+        root, depth = append_node(trees[i].topNode(), 0)
+        roots.append(root)
+        maxDepth = max(maxDepth, depth)
+
+    return CompiledForest(nodes['feature'],
+                          nodes['threshold'],
+                          nodes['categories'],
+                          nodes['left'],
+                          nodes['right'],
+                          nodes['value'],
+                          roots,
+                          maxDepth)
+
+
+def categories_to_mask(categories):
+    '''
+    Input: a comma separated string of category values, e.g. "0.0,2.0"
+    Output: an integer with the bit of each category set
+    '''
+    mask = 0
+    for category in categories.split(','):
+        if not category:
+            continue
+        bit = int(float(category))
+        if bit < 0 or bit > 63 or bit != float(category):
+            raise ValueError("Unsupported category value for a compiled forest: {0}".format(category))
+        mask |= 1 << bit
+    return mask
+
+
+def random_features(numPts, seed=42):
+    '''
+    Input: the number of feature vectors to generate
+    Output: a 2D array of feature vectors laid out like helpers.featureCols
+    Description: synthetic patients covering every category and the range of the continuous
+    features, used to compare the compiled forest with the Spark one.
+    '''
+    rng = np.random.RandomState(seed)
+    # admission_type, insurance, gender, ethn, lang, status
+    arities = [4, 6, 3, 6, 4, 9]
+    categoricals = [rng.randint(0, arity, numPts) for arity in arities]
+    severity = rng.randint(0, 5, numPts) / rng.randint(1, 4, numPts).astype(float)
+    mortality = rng.randint(0, 5, numPts) / rng.randint(1, 4, numPts).astype(float)
+    age = np.round(rng.uniform(0, 92, numPts))
+    return np.column_stack(categoricals + [severity, mortality, age]).astype(np.float64)
+
+
+def check_parity(sc, model, forest, X):
+    '''
+    Input: a SparkContext, a RandomForestModel, its CompiledForest and a 2D array of features
+    Output: the largest absolute difference between the two sets of probabilities
+    '''
+    from pyspark.mllib.regression import LabeledPoint
+    from helpers import predict_proba
+
+    dataPts = sc.parallelize([LabeledPoint(1, row) for row in X])
+    sparkProbabilities = np.array(predict_proba(model, dataPts))
+    compiledProbabilities = forest.predict_proba(X)
+    return np.abs(sparkProbabilities - compiledProbabilities).max()
+
+
+if __name__ == '__main__':
+    # Usage: python forest.py <model uri> <snapshot directory>
+    # Exports the saved RandomForestModel, checks it against the Spark scoring path and publishes
+    # it as the current snapshot.
+    from helpers import setup_spark, setup_model
+    from snapshots import publish_snapshot
+    sc = setup_spark()
+    model = setup_model(sc, sys.argv[1])
+    forest = export_forest(model)
+    difference = check_parity(sc, model, forest, random_features(1000))
+    if difference > 1e-9:
+        sys.exit("Compiled forest does not match the Spark model: max difference {0}".format(difference))
+    path = publish_snapshot(forest, sys.argv[2])
+    print "Exported {0} trees to {1}".format(forest.numTrees(), path)
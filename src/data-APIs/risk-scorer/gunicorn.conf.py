@@ -0,0 +1,91 @@
+'''
+Settings of the pre-forked serving mode, the same for every service:
+
+    gunicorn -c gunicorn.conf.py server:app
+
+This file lives in src/data-APIs/shared. Each service has a copy, so that it can be pushed on
+its own; edit this one and copy it with 'python sync_shared.py'. The settings of a service are
+overridden with the environment variables below, in its manifest.yml.
+
+The app is imported and server.setup(prefork=True) loads its data and models once, in the master
+process, before the workers are forked. The workers share those tables copy-on-write, so adding a
+worker adds the memory of a request handler, not of another copy of the data. Threads do not
+survive a fork, so each worker calls server.start_worker() to start its own.
+
+Every process writes its metrics to PROMETHEUS_MULTIPROC_DIR, so that /metrics adds up the metrics
+of all the workers whichever one answers it, and their profiles to PROFILER_DIR (see
+instrumentation.py).
+'''
+import os
+import re
+import errno
+import tempfile
+import multiprocessing
+
+
+# The files prometheus_client writes for a process, e.g. counter_1234.db or gauge_liveall_1234.db
+metricsFilePattern = re.compile(r'^[a-z]+(_[a-z]+)?_(?P<pid>[0-9]+)\.db$')
+
+
+def remove_dead_metrics(metricsDir):
+    '''
+    Removes the metrics files of processes that are not running, left by a previous run, which
+    /metrics would otherwise add to the new ones. The settings are read again on every reload, so
+    the files of running workers are kept. Other files in the directory are left alone.
+    '''
+    if not os.path.isdir(metricsDir):
+        os.makedirs(metricsDir)
+    for name in os.listdir(metricsDir):
+        match = metricsFilePattern.match(name)
+        if match is None:
+            continue
+        pid = int(match.group('pid'))
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                os.remove(os.path.join(metricsDir, name))
+
+# Set before the app imports prometheus_client, which reads it when it is imported, and created
+# before the app records its first metric
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(),
+                                                               'metrics-' + os.path.basename(os.getcwd())))
+remove_dead_metrics(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+# Where the workers share the profiles of the sampling profiler
+os.environ.setdefault('PROFILER_DIR', os.path.join(tempfile.gettempdir(), 'profiles-' + os.path.basename(os.getcwd())))
+
+# Get the port number from the environment variable VCAP_APP_PORT, like server.py
+bind = '0.0.0.0:' + os.getenv('VCAP_APP_PORT', '8080')
+
+# Number of worker processes, one per core by default, and of request threads in each of them
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('WEB_THREADS', 1))
+
+# A worker that does not answer for WEB_TIMEOUT seconds is killed and replaced. On a graceful
+# restart (kill -HUP of the master) workers get WEB_GRACEFUL_TIMEOUT seconds to finish their requests.
+timeout = int(os.getenv('WEB_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+
+# Workers are replaced after WEB_MAX_REQUESTS requests, plus up to WEB_MAX_REQUESTS_JITTER so they
+# do not all restart at once. 0 never replaces them.
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', 0))
+
+preload_app = True
+
+
+def when_ready(arbiter):
+    import server
+    server.setup(prefork=True)
+    arbiter.log.info("Loaded %s, forking %s workers", server.__file__, arbiter.cfg.workers)
+
+
+def post_fork(arbiter, worker):
+    import server
+    server.start_worker()
+
+
+def child_exit(arbiter, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
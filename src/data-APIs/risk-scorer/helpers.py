@@ -1,46 +1,86 @@
 import os
-from pyspark.ml.feature import VectorAssembler
-from pyspark.mllib.feature import LabeledPoint
-from pyspark.mllib.tree import DecisionTreeModel, RandomForestModel
-from pyspark.sql.types import *
 from itertools import izip
 import json
+import numpy as np
+from encoder import readmissionEncoder
 
+# pyspark is imported by the functions that use it, so that the in-process engines, the feature
+# store and benchmark.py --no-spark can import this module without Spark installed
 
-def get_patient_data(dischargeIDs, sqlContext):
-    # These helper will be replaced with one that queries a SQL databse to get the appropriate info
-    # Right now, as a placeholder I am querying a list of patients from HDFS
-    hdfsMasterName = "cdh-master-0.node.envname.consul"
+def setup_spark(master="local[*]"):
+    from pyspark import SparkContext
+    os.environ['PYSPARK_SUBMIT_ARGS'] = "--packages com.databricks:spark-csv_2.10:1.4.0 pyspark-shell"
+    os.environ['PYSPARK_PYTHON'] = "python2.7"
+    sc = SparkContext(master, "risk-scorer")
+    return sc
 
-    hdfsPathAdmissions = "hdfs://{0}/org/1fc35ebe-d845-45e3-a2b1-b3effe9483e2/brokers/userspace/9e6d3f28-a119-43d9-ad67-fdbe4860be98/9997ff80-b53f-46c4-9dca-f76cc56c876a/000000_1"
-    hdfsPathAdmissions = hdfsPathAdmissions.format(hdfsMasterName)
-    
-    hdfsPathPatients = "hdfs://{0}/org/1fc35ebe-d845-45e3-a2b1-b3effe9483e2/brokers/userspace/9e6d3f28-a119-43d9-ad67-fdbe4860be98/d82b3a1e-de79-4312-98be-1499e25e25c6/000000_1" 
-    hdfsPathPatients = hdfsPathPatients.format(hdfsMasterName)
-    
-    hdfsPathCodes = "hdfs://{0}/org/1fc35ebe-d845-45e3-a2b1-b3effe9483e2/brokers/userspace/9e6d3f28-a119-43d9-ad67-fdbe4860be98/e69a6c0a-5507-4cec-a184-c2a480ee2a6a/000000_1"
-    hdfsPathCodes = hdfsPathCodes.format(hdfsMasterName)
+def setup_model(sc, model_uri):
+    from pyspark.mllib.tree import RandomForestModel
+    model = RandomForestModel.load(sc, model_uri)
+    return model
+
+# The features that are assembled into the vectors, in the order the model was trained on
+featureCols = readmissionEncoder.featureCols
+
+# These helpers will be replaced with ones that query a SQL databse to get the appropriate info
+# Right now, as a placeholder I am querying a list of patients from HDFS
+hdfsMasterName = "cdh-master-0.node.envname.consul"
+
+hdfsPathAdmissions = "hdfs://{0}/org/1fc35ebe-d845-45e3-a2b1-b3effe9483e2/brokers/userspace/9e6d3f28-a119-43d9-ad67-fdbe4860be98/9997ff80-b53f-46c4-9dca-f76cc56c876a/000000_1"
+hdfsPathAdmissions = hdfsPathAdmissions.format(hdfsMasterName)
+
+hdfsPathPatients = "hdfs://{0}/org/1fc35ebe-d845-45e3-a2b1-b3effe9483e2/brokers/userspace/9e6d3f28-a119-43d9-ad67-fdbe4860be98/d82b3a1e-de79-4312-98be-1499e25e25c6/000000_1" 
+hdfsPathPatients = hdfsPathPatients.format(hdfsMasterName)
+
+hdfsPathCodes = "hdfs://{0}/org/1fc35ebe-d845-45e3-a2b1-b3effe9483e2/brokers/userspace/9e6d3f28-a119-43d9-ad67-fdbe4860be98/e69a6c0a-5507-4cec-a184-c2a480ee2a6a/000000_1"
+hdfsPathCodes = hdfsPathCodes.format(hdfsMasterName)
+
+sourcePaths = [hdfsPathAdmissions, hdfsPathPatients, hdfsPathCodes]
 
+
+def load_source_tables(sqlContext, paths=sourcePaths):
+    '''
+    Input: a SQLContext and the locations of the admissions, patients and DRG codes CSVs
+    Output: three PySpark DataFrames
+    '''
+    admissionsPath, patientsPath, codesPath = paths[0], paths[1], paths[2]
     df_admissions = sqlContext.read.format('com.databricks.spark.csv').\
                                 options(header='true', inferSchema=True).\
-                                load(hdfsPathAdmissions)
+                                load(admissionsPath)
     df_patients = sqlContext.read.format('com.databricks.spark.csv').\
                                 options(header='true', inferSchema=True).\
-                                load(hdfsPathPatients)    
+                                load(patientsPath)    
     df_drgcodes = sqlContext.read.format('com.databricks.spark.csv').\
                                 options(header='true', inferSchema=True).\
-                                load(hdfsPathCodes)
+                                load(codesPath)
+    return df_admissions, df_patients, df_drgcodes
+
+def get_patient_data(dischargeIDs, sqlContext, paths=sourcePaths):
+    df_admissions, df_patients, df_drgcodes = load_source_tables(sqlContext, paths)
     
     # Select the admission records for the patients of interest
     discharges = df_admissions[df_admissions.HADM_ID.isin(dischargeIDs)]
-    sqlContext.registerDataFrameAsTable(discharges, "discharges")
     
     # Get the subject_ids for each of those records
     dischargeSubjectIDs = [d[0] for d in discharges.select('SUBJECT_ID').collect()]
     
     # Get the comorbidity scores for everyone in the discharge group
-    drgCodes = df_drgcodes[df_drgcodes.HADM_ID.isin(dischargeIDs)].na.fill(0)
-    sqlContext.registerDataFrameAsTable(drgCodes, "drgCodes")                     
+    drgCodes = df_drgcodes[df_drgcodes.HADM_ID.isin(dischargeIDs)]
+    
+    # Select the subejct_id, gender, and age from the discharge patients
+    patients = df_patients[df_patients.SUBJECT_ID.isin(dischargeSubjectIDs)]
+    
+    return join_patient_data(discharges, patients, drgCodes, sqlContext)
+
+def join_patient_data(discharges, patients, drgCodes, sqlContext):
+    '''
+    Input: PySpark DataFrames of admissions, patients and DRG codes, and a SQLContext
+    Output: PySpark DataFrame registered as the "joined" table
+    Description: joins one row per admission with the patient's age and gender and the average
+    comorbidity scores of the admission.
+    '''
+    sqlContext.registerDataFrameAsTable(discharges, "discharges")
+    sqlContext.registerDataFrameAsTable(drgCodes.na.fill(0), "drgCodes")                     
     
     dischargeComorbids = sqlContext.sql("""
                                        select
@@ -52,9 +92,7 @@ def get_patient_data(dischargeIDs, sqlContext):
                                         """)
     sqlContext.registerDataFrameAsTable(dischargeComorbids, "dischargeComorbids")
     
-    # Select the subejct_id, gender, and age from the discharge patients
-    dischargePatientInfo = df_patients[df_patients.SUBJECT_ID.isin(dischargeSubjectIDs)] \
-                            .select('SUBJECT_ID', 'GENDER', 'DOB')
+    dischargePatientInfo = patients.select('SUBJECT_ID', 'GENDER', 'DOB')
     sqlContext.registerDataFrameAsTable(dischargePatientInfo, 'patientInfo')
     
     # Join the admission table info with the comorbodity table info
@@ -98,101 +136,58 @@ def get_patient_data(dischargeIDs, sqlContext):
     
     return joined
 
-def pre_process_patients(df, sqlContext):
+def pre_process_patients(df, sqlContext, encoder=readmissionEncoder):
     '''
     Input: PySpark DataFrame
     Output: PySpark DataFrame
-    Description: Encodes categoricals as numerica values for classification. Ordinarily the best practice
-                would be to use StringIndexer, but the ability to save a fitted StringIndexer is not currently
-                available in Spark 1.5 or 1.6. 
+    Description: Encodes categoricals as numerica values for classification. The SQL is generated from the
+                CategoricalEncoder, so it matches the encoding of encode_patients.
     '''
-    
-    data = sqlContext.sql("""
-                        SELECT 
-                            CASE
-                                WHEN ADMISSION_TYPE LIKE 'NEWBORN' THEN 0.0
-                                WHEN ADMISSION_TYPE LIKE 'EMERGENCY' THEN 1.0
-                                WHEN ADMISSION_TYPE LIKE 'URGENT' THEN 2.0
-                                ELSE 3.0
-                                END as admission_type,
-                            CASE 
-                                WHEN INSURANCE LIKE 'Private' THEN 0.0
-                                WHEN INSURANCE LIKE 'Medicare' THEN 1.0
-                                WHEN INSURANCE LIKE 'Medicaid' THEN 2.0
-                                WHEN INSURANCE LIKE 'Government' THEN 3.0
-                                WHEN INSURANCE LIKE 'Self Pay' THEN 4.0
-                                ELSE 5.0
-                                END as insurance,
-                            CASE
-                                WHEN GENDER LIKE 'M' THEN 0.0
-                                WHEN GENDER LIKE 'F' THEN 1.0
-                                ELSE 2.0
-                                END as gender,
-                            IF (AGE > 200, 91, AGE) as age,
-                            IF (AVG_DRG_SEVERITY IS NULL, 0, AVG_DRG_SEVERITY) as avg_severity,
-                            IF (AVG_DRG_MORTALITY IS NULL, 0, AVG_DRG_MORTALITY) as avg_mortality,
-                            CASE
-                                WHEN ETHNICITY LIKE 'WHITE%' OR 
-                                     ETHNICITY LIKE 'EUROPEAN%' OR
-                                     ETHNICITY LIKE 'PORTUGUESE%' THEN 0.0
-                                WHEN ETHNICITY LIKE 'BLACK%' OR 
-                                     ETHNICITY LIKE 'AFRICAN%' THEN 1.0
-                                WHEN ETHNICITY LIKE 'HISPANIC%' OR 
-                                     ETHNICITY LIKE 'LATINO%' THEN 2.0
-                                WHEN ETHNICITY LIKE '%MIDDLE EASTERN%' THEN 3.0
-                                WHEN ETHNICITY LIKE 'ASIAN%' OR
-                                     ETHNICITY LIKE '%ASIAN - INDIAN%' THEN 4.0
-                                ELSE 5.0 
-                                END as ethn,
-                            CASE 
-                              WHEN ADMISSION_TYPE='NEWBORN' THEN 0.0
-                              WHEN LANGUAGE='ENGL' THEN 1.0
-                              WHEN LANGUAGE='' THEN 2.0
-                              ELSE 3.0
-                              END as lang,
-                            CASE
-                              WHEN MARITAL_STATUS LIKE 'NEWBORN' THEN 0.0
-                              WHEN MARITAL_STATUS LIKE '' OR MARITAL_STATUS LIKE 'LIFE PARTNER' THEN 1.0
-                              WHEN MARITAL_STATUS LIKE 'UNKNOWN%' THEN 2.0
-                              WHEN MARITAL_STATUS LIKE 'MARRIED' THEN 3.0
-                              WHEN MARITAL_STATUS LIKE 'DIVORCED' THEN 4.0
-                              WHEN MARITAL_STATUS LIKE 'SINGLE' THEN 5.0
-                              WHEN MARITAL_STATUS LIKE 'WIDOWED' THEN 6.0
-                              WHEN MARITAL_STATUS LIKE 'SEPARATED' THEN 7.0
-                              ELSE 8.0
-                              END as status
-                        FROM joined
-                    """)
+    sqlContext.registerDataFrameAsTable(df, "joined")
+    data = sqlContext.sql(encoder.to_sql("joined"))
     return data
 
-def vectorize_data(df, featureCols):
+def vectorize_data(df, featureCols=featureCols):
     '''
     Input:
     Output:
     Description:
     '''
-    # These features are currently hard-coded, but they can be paramterized
-    featureCols = ['admission_type', 
-                  'insurance', 
-                  'gender', 
-                  'ethn', 
-                  'lang', 
-                  'status', 
-                  'avg_severity', 
-                  'avg_mortality', 
-                  'age']
-
+    from pyspark.ml.feature import VectorAssembler
+    from pyspark.mllib.feature import LabeledPoint
     va = VectorAssembler(inputCols=featureCols, outputCol='features')
     assembled = va.transform(df)
     vectors = assembled.select('features').map(lambda f: LabeledPoint(1, f.features))
     return vectors
 
+def encode_patients(df, encoder=readmissionEncoder):
+    '''
+    Input: PySpark DataFrame from get_patient_data
+    Output: a list of admission ids and a 2D NumPy array with one row of features per admission
+    Description: brings the joined patient data back to the driver and encodes it with NumPy, so
+    that it can be scored by a CompiledForest without running a Spark job per tree.
+    '''
+    cols = encoder.columns()
+    rows = df.select(['HADM_ID'] + cols).collect()
+    admissionIDs = [row[0] for row in rows]
+    columns = {col: [row[ix + 1] for row in rows] for ix, col in enumerate(cols)}
+    return admissionIDs, encoder.encode(columns)
+
+def features_to_points(sc, features):
+    '''
+    Input: a SparkContext and a 2D NumPy array of features
+    Output: RDD of LabeledPoints ready for predict_proba
+    '''
+    from pyspark.mllib.feature import LabeledPoint
+    return sc.parallelize([LabeledPoint(1, row) for row in features])
+
 def predict_proba(model, data):
     '''
     Input: A PySpark RandomForestModel object, RDD of LabeledPoints
     Output: List of probabilies 
     This wrapper exposes the probabilities (i.e. confidences) for a given prediciton. 
     '''
+    from pyspark.mllib.tree import DecisionTreeModel
     # Collect the individual decision tree models by calling the underlying
     # Java model. These are returned as JavaArray defined by py4j.
     trees = model._java_model.trees()
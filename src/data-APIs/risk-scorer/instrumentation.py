@@ -0,0 +1,423 @@
+'''
+Metrics, trace ids and a sampling profiler for the data APIs. This file lives in
+src/data-APIs/shared and is copied into every service by sync_shared.py.
+
+    instrument(app, 'record-getter')        # once, after creating the Flask app
+
+    with stage('lookup', len(admissionIDs)):
+        ...                                 # timed as a stage of the request
+
+instrument adds to the app:
+
+    GET  /metrics                   request counts, latencies, request and response sizes per route
+                                    and the time and number of items of every stage, in the Prometheus
+                                    text format
+    POST /v1/admin/profiler         starts sampling the stacks of every thread, for 'seconds' seconds
+                                    (30 by default, from 1 to PROFILER_MAX_SECONDS) every 'interval'
+                                    seconds (0.005 by default, between 0.001 and 1)
+    DELETE /v1/admin/profiler       stops the running profile, its samples are kept
+    GET  /v1/admin/profiler         the stacks sampled by the last profile, one 'frame;frame;... count'
+                                    line per stack, the input of flamegraph.pl; with 'pid', only
+                                    the stacks of that process
+
+Every request gets a trace id, the X-Trace-Id header it came with or a new one. It is returned in
+the X-Trace-Id header of the response, and trace_headers() gives the headers that pass it on to
+the services the request calls.
+
+When PROMETHEUS_MULTIPROC_DIR is set, as gunicorn.conf.py does, the metrics of all the worker
+processes are written to files in that directory and /metrics adds them up. In the same way, when
+PROFILER_DIR is set, a profile started through one worker is written to that directory and every
+worker joins it on its next request; each worker writes its samples there and GET adds them up.
+'''
+import os
+import sys
+import glob
+import time
+import uuid
+import threading
+import collections
+from contextlib import contextmanager
+from flask import g, request, Response, json, has_request_context
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+
+
+# Name of the service, the 'service' label of every metric
+serviceName = 'unknown'
+
+traceHeader = 'X-Trace-Id'
+
+sizeBuckets = (100, 1000, 10000, 100000, 1000000, 10000000, float('inf'))
+
+requestCount = Counter('http_requests_total', 'Requests handled', ['service', 'route', 'method', 'status'])
+requestSeconds = Histogram('http_request_seconds', 'Time to handle a request, until its body is sent',
+                           ['service', 'route', 'method'])
+requestBytes = Histogram('http_request_bytes', 'Size of the request bodies', ['service', 'route'],
+                         buckets=sizeBuckets)
+responseBytes = Histogram('http_response_bytes', 'Size of the response bodies', ['service', 'route'],
+                          buckets=sizeBuckets)
+stageSeconds = Histogram('stage_seconds', 'Time spent in a stage of handling requests', ['service', 'stage'],
+                         buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                                  float('inf')))
+stageItems = Counter('stage_items_total', 'Admissions, documents or rows handled by a stage', ['service', 'stage'])
+
+
+def current_trace_id():
+    '''
+    Output: the trace id of the request being handled, or None outside of a request
+    '''
+    if has_request_context():
+        return getattr(g, 'traceID', None)
+    return None
+
+
+def trace_headers(traceID=None):
+    '''
+    Input: a trace id, the one of the current request by default
+    Output: the headers that pass the trace id on to another service
+    '''
+    traceID = traceID or current_trace_id()
+    return {traceHeader: traceID} if traceID else {}
+
+
+def observe_stage(name, seconds, items=None):
+    stageSeconds.labels(serviceName, name).observe(seconds)
+    if items:
+        stageItems.labels(serviceName, name).inc(items)
+
+
+@contextmanager
+def stage(name, items=None):
+    '''
+    Times the block as the stage 'name', which handled 'items' admissions, documents or rows.
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.time() - start, items)
+
+
+# Where the workers of a service share their profiles, None for a single process
+profilerDir = os.getenv('PROFILER_DIR')
+
+# Seconds between two checks of a worker for a profile started through another one, and between
+# two writes of its samples while it profiles
+profilerCheckInterval = 1.0
+
+# Bounds of the duration of a profile, and of the interval between two samples, in seconds
+maxProfileSeconds = float(os.getenv('PROFILER_MAX_SECONDS', 300))
+minProfileInterval = 0.001
+maxProfileInterval = 1.0
+
+
+def write_json(path, data):
+    # Written under a temporary name and renamed, so a reader never sees half of it
+    tmpPath = '{0}.tmp-{1}'.format(path, os.getpid())
+    with open(tmpPath, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmpPath, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+class Profiler(object):
+    '''
+    Samples the stack of every thread of the process at a fixed interval, from a thread of its own,
+    and counts how often each stack was seen. Nothing runs while it is not sampling. With a
+    directory, the counts are written to '<profile id>-<pid>.json' in it every second and when the
+    profile ends.
+    '''
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.profileID = None
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.until = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval, profileID=None):
+        '''
+        Output: False when a profile is already running
+        '''
+        with self._lock:
+            if self.running():
+                return False
+            self.profileID = profileID or uuid.uuid4().hex
+            self.counts = collections.Counter()
+            self.samples = 0
+            self.until = time.time() + seconds
+            self._thread = threading.Thread(target=self._sample, args=(interval,), name='profiler')
+            self._thread.daemon = True
+            self._thread.start()
+            return True
+
+    def stop(self):
+        '''
+        Output: False when no profile was running
+        Description: the sampling thread stops within an interval and saves its samples.
+        '''
+        with self._lock:
+            running = self.running()
+            self.until = min(self.until, time.time())
+            return running
+
+    def _sample(self, interval):
+        ownID = threading.current_thread().ident
+        saved = time.time()
+        while time.time() < self.until:
+            for threadID, frame in sys._current_frames().items():
+                if threadID == ownID:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                        code.co_firstlineno))
+                    frame = frame.f_back
+                self.counts[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            if self.directory is not None and time.time() - saved >= profilerCheckInterval:
+                self.save(running=True)
+                saved = time.time()
+            time.sleep(interval)
+        if self.directory is not None:
+            self.save(running=False)
+
+    def save(self, running):
+        write_json(os.path.join(self.directory, '{0}-{1}.json'.format(self.profileID, os.getpid())),
+                   {'pid': os.getpid(), 'samples': self.samples, 'running': running, 'counts': dict(self.counts)})
+
+    def collapsed(self):
+        return collapsed(self.counts)
+
+
+def collapsed(counts):
+    return ''.join('{0} {1}\n'.format(stack, count) for stack, count in counts.most_common())
+
+
+profiler = Profiler(profilerDir)
+if profilerDir is not None and not os.path.isdir(profilerDir):
+    try:
+        os.makedirs(profilerDir)
+    except OSError:
+        # Created by another worker in the meantime
+        pass
+lastProfileCheck = [0.0]
+
+
+def request_profile(seconds, interval):
+    '''
+    Output: the id of the profile, which every worker that shares profilerDir joins
+    Description: the profiles of earlier requests are removed.
+    '''
+    profileID = uuid.uuid4().hex
+    for path in glob.glob(os.path.join(profilerDir, '*.json')):
+        os.remove(path)
+    write_json(os.path.join(profilerDir, 'REQUEST'),
+               {'id': profileID, 'until': time.time() + seconds, 'interval': interval})
+    return profileID
+
+
+def join_requested_profile():
+    '''
+    Starts the profile requested through another worker, if this one is not running it yet, and
+    stops it when it was stopped through another worker. Checked at most once per profilerCheckInterval, on the requests the worker handles.
+    '''
+    now = time.time()
+    if now - lastProfileCheck[0] < profilerCheckInterval:
+        return
+    lastProfileCheck[0] = now
+    requested = read_json(os.path.join(profilerDir, 'REQUEST'))
+    if requested is None:
+        return
+    if requested['id'] != profiler.profileID and requested['until'] > now:
+        profiler.start(requested['until'] - now, requested['interval'], requested['id'])
+    elif requested['id'] == profiler.profileID and requested['until'] < profiler.until:
+        # Stopped through another worker
+        profiler.stop()
+
+
+def stop_requested_profile():
+    '''
+    Output: False when no profile was requested or it already ended
+    Description: the other workers stop sampling on their next check.
+    '''
+    requestPath = os.path.join(profilerDir, 'REQUEST')
+    requested = read_json(requestPath)
+    if requested is None or requested['until'] <= time.time():
+        return False
+    requested['until'] = time.time()
+    write_json(requestPath, requested)
+    return True
+
+
+def merged_profile(pid=None):
+    '''
+    Output: the counts of the stacks sampled by the workers for the last requested profile, the
+    number of samples, whether a worker is still sampling and the pids of the workers
+    '''
+    requested = read_json(os.path.join(profilerDir, 'REQUEST'))
+    counts = collections.Counter()
+    samples, running, pids = 0, False, []
+    if requested is None:
+        return counts, samples, running, pids
+    for path in glob.glob(os.path.join(profilerDir, requested['id'] + '-*.json')):
+        workerProfile = read_json(path)
+        if workerProfile is None or (pid is not None and workerProfile['pid'] != pid):
+            continue
+        counts.update(workerProfile['counts'])
+        samples += workerProfile['samples']
+        running = running or workerProfile['running']
+        pids.append(workerProfile['pid'])
+    return counts, samples, running or requested['until'] > time.time(), sorted(pids)
+
+
+def timed_iter(name, iterable):
+    '''
+    Yields the items of iterable and records the time spent producing them, but not the time
+    spent between items, as the stage 'name' once they have all been produced.
+    '''
+    seconds = 0.0
+    items = 0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.time() - start
+            items += 1
+            yield item
+    finally:
+        observe_stage(name, seconds)
+
+
+def route_of(req):
+    # The URL rule rather than the path, so that the routes are a small, fixed set of labels
+    return req.url_rule.rule if req.url_rule is not None else 'unmatched'
+
+
+def counted_body(body, route, method, start):
+    '''
+    Yields the chunks of a streamed response and records its size and latency once it is sent.
+    '''
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        responseBytes.labels(serviceName, route).observe(size)
+        requestSeconds.labels(serviceName, route, method).observe(time.time() - start)
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def before_request():
+    g.requestStart = time.time()
+    if profilerDir is not None:
+        join_requested_profile()
+    g.traceID = request.headers.get(traceHeader) or uuid.uuid4().hex
+
+
+def after_request(response):
+    route, method = route_of(request), request.method
+    # A request that failed before before_request ran has neither
+    start = getattr(g, 'requestStart', time.time())
+    traceID = getattr(g, 'traceID', None) or request.headers.get(traceHeader) or uuid.uuid4().hex
+    requestCount.labels(serviceName, route, method, str(response.status_code)).inc()
+    requestBytes.labels(serviceName, route).observe(request.content_length or 0)
+    response.headers[traceHeader] = traceID
+    if response.is_streamed:
+        response.response = counted_body(response.response, route, method, start)
+    else:
+        responseBytes.labels(serviceName, route).observe(response.content_length or 0)
+        requestSeconds.labels(serviceName, route, method).observe(time.time() - start)
+    return response
+
+
+def metrics():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def bounded_float(args, name, default, lower, upper):
+    '''
+    Output: the query argument 'name' as a float, default when it is missing. Raises ValueError
+    when it is not a number between lower and upper.
+    '''
+    value = float(args.get(name, default))
+    if not lower <= value <= upper:
+        raise ValueError("{0} must be between {1} and {2}".format(name, lower, upper))
+    return value
+
+
+def start_profile():
+    try:
+        seconds = bounded_float(request.args, 'seconds', 30, 1, maxProfileSeconds)
+        interval = bounded_float(request.args, 'interval', 0.005, minProfileInterval, maxProfileInterval)
+    except ValueError as e:
+        return Response(str(e) + "\n", status=400, mimetype='text/plain')
+    if profiler.running():
+        started = False
+    elif profilerDir is not None:
+        started = profiler.start(seconds, interval, request_profile(seconds, interval))
+    else:
+        started = profiler.start(seconds, interval)
+    response = {'profiling': True, 'until': profiler.until, 'pid': os.getpid(), 'id': profiler.profileID}
+    return Response(json.dumps(response), status=202 if started else 409, mimetype='application/json')
+
+
+def stop_profile():
+    stopped = profiler.stop()
+    if profilerDir is not None:
+        stopped = stop_requested_profile() or stopped
+    response = {'profiling': False, 'stopped': stopped, 'pid': os.getpid(), 'id': profiler.profileID}
+    return Response(json.dumps(response), mimetype='application/json')
+
+
+def get_profile():
+    if profilerDir is None:
+        counts, samples, running, pids = profiler.counts, profiler.samples, profiler.running(), [os.getpid()]
+    else:
+        pid = int(request.args['pid']) if 'pid' in request.args else None
+        counts, samples, running, pids = merged_profile(pid)
+    response = Response(collapsed(counts), mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(samples)
+    response.headers['X-Profile-Running'] = str(running).lower()
+    response.headers['X-Profile-Pids'] = ','.join(str(pid) for pid in pids)
+    return response
+
+
+def instrument(app, service):
+    '''
+    Input: a Flask app and the name of its service
+    Description: times and counts every request of the app and adds the /metrics and profiler routes.
+    '''
+    global serviceName
+    serviceName = service
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
+    app.add_url_rule('/v1/admin/profiler', 'start_profile', start_profile, methods=['POST'])
+    app.add_url_rule('/v1/admin/profiler', 'get_profile', get_profile, methods=['GET'])
+    app.add_url_rule('/v1/admin/profiler', 'stop_profile', stop_profile, methods=['DELETE'])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+'''
+Scores every admission of a census with the compiled forest and writes the scores to a ScoreFile
+that the risk-scorer can serve from (see the 'precomputed' engine).
+
+    python score_census.py --ids ../discharge-planner/data/admission-ids.csv --out census-scores
+
+The features of every admission are built once, with Spark, and saved to --features as NumPy
+arrays sorted by HADM_ID; later runs reuse them while the modification times of the sources are
+the ones they were built from, unless --refresh-features is given. The ids are then
+split into shards of --shard-size that a pool of --workers processes score without Spark, each
+worker memory-mapping the features and the current model snapshot. Every scored shard is written
+to a checkpoint directory before the next one is taken, so a job that is interrupted picks up from
+the shards that are missing when it is run again with the same arguments.
+'''
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+from snapshots import load_snapshot, current_version
+from score_file import ScoreFile
+
+
+def save_features(table, path):
+    '''
+    Input: a FeatureTable and a directory
+    Description: writes the HADM_IDs and the encoded features of the table sorted by HADM_ID.
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    order = np.argsort(table.columns['HADM_ID'], kind='mergesort')
+    np.save(os.path.join(path, 'HADM_ID.npy'), table.columns['HADM_ID'][order])
+    np.save(os.path.join(path, 'features.npy'), table.features[order])
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'numAdmissions': len(table), 'modificationTimes': table.modificationTimes}, f)
+
+
+def read_features_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def prepare_features(path, refresh=False):
+    '''
+    Input: the directory of the saved features, and whether to rebuild them in any case
+    Description: builds the features with Spark unless the saved ones were built from sources
+    with the same modification times as now.
+    '''
+    from pyspark.sql import SQLContext
+    from helpers import setup_spark
+    from helpers import sourcePaths
+    from feature_store import build_feature_table, source_modification_times
+    sc = setup_spark()
+    try:
+        sqlContext = SQLContext(sc)
+        meta = read_features_meta(path)
+        if not refresh and meta is not None and \
+           meta['modificationTimes'] == source_modification_times(sqlContext, sourcePaths):
+            print "Reusing the features in {0}".format(path)
+            return
+        save_features(build_feature_table(sqlContext), path)
+    finally:
+        sc.stop()
+
+
+def read_ids(path):
+    '''
+    Input: a CSV file with a HADM_ID column
+    Output: an int64 array of the admission ids, without duplicates
+    '''
+    with open(path) as f:
+        reader = csv.reader(f)
+        col = next(reader).index('HADM_ID')
+        admissionIDs = np.array([int(row[col]) for row in reader if row], dtype=np.int64)
+    return np.unique(admissionIDs)
+
+
+def run_key(modelVersion, featuresPath, admissionIDs, shardSize):
+    '''
+    Output: the name of the checkpoint directory of a run, which changes with anything that would
+    change its shards
+    '''
+    digest = hashlib.sha1()
+    digest.update(modelVersion)
+    with open(os.path.join(featuresPath, 'meta.json')) as f:
+        digest.update(f.read())
+    digest.update(np.ascontiguousarray(admissionIDs).tobytes())
+    digest.update(str(shardSize))
+    return digest.hexdigest()[:16]
+
+
+# Set in every worker by init_worker
+workerForest = None
+workerIDs = None
+workerFeatures = None
+
+
+def init_worker(snapshotDir, modelVersion, featuresPath):
+    global workerForest, workerIDs, workerFeatures
+    workerForest, _ = load_snapshot(snapshotDir, modelVersion)
+    workerIDs = np.load(os.path.join(featuresPath, 'HADM_ID.npy'), mmap_mode='r')
+    workerFeatures = np.load(os.path.join(featuresPath, 'features.npy'), mmap_mode='r')
+
+
+def shard_path(checkpointDir, shardIx):
+    return os.path.join(checkpointDir, 'shard-{0:06d}.npz'.format(shardIx))
+
+
+def score_shard(args):
+    '''
+    Input: the index of a shard, its admission ids and the checkpoint directory
+    Output: the index of the shard, the number of admissions scored and the seconds it took
+    '''
+    shardIx, admissionIDs, checkpointDir = args
+    start = time.time()
+    positions = np.minimum(np.searchsorted(workerIDs, admissionIDs), max(len(workerIDs) - 1, 0))
+    found = workerIDs[positions] == admissionIDs if len(workerIDs) else np.zeros(len(admissionIDs), dtype=bool)
+    probabilities = workerForest.predict_proba(workerFeatures[positions[found]])
+    # Written under a temporary name and renamed, so a checkpoint is never half written
+    tmpPath = shard_path(checkpointDir, shardIx) + '.tmp-{0}.npz'.format(os.getpid())
+    np.savez(tmpPath, HADM_ID=admissionIDs[found], readmissionRisk=probabilities)
+    os.rename(tmpPath, shard_path(checkpointDir, shardIx))
+    return shardIx, int(found.sum()), time.time() - start
+
+
+def score_census(admissionIDs, snapshotDir, featuresPath, outPath, checkpointRoot, shardSize=10000,
+                 workers=None):
+    '''
+    Input: the admission ids to score, the model snapshot directory, the saved features, the score
+    file to write, the directory of the checkpoints, the number of ids per shard and of processes
+    Output: the ScoreFile that was written
+    '''
+    modelVersion = current_version(snapshotDir)
+    if modelVersion is None:
+        raise ValueError("No model has been published to {0}".format(snapshotDir))
+    checkpointDir = os.path.join(checkpointRoot, run_key(modelVersion, featuresPath, admissionIDs, shardSize))
+    if not os.path.isdir(checkpointDir):
+        os.makedirs(checkpointDir)
+
+    shards = [(shardIx, admissionIDs[i:i + shardSize], checkpointDir)
+              for shardIx, i in enumerate(xrange(0, len(admissionIDs), shardSize))]
+    pending = [shard for shard in shards if not os.path.exists(shard_path(checkpointDir, shard[0]))]
+    print "Scoring {0} admissions with model {1}: {2} of {3} shards left".format(
+        len(admissionIDs), modelVersion, len(pending), len(shards))
+
+    start = time.time()
+    if pending:
+        pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                    initargs=(snapshotDir, modelVersion, featuresPath))
+        try:
+            done = 0
+            for shardIx, numScored, seconds in pool.imap_unordered(score_shard, pending):
+                done += 1
+                print "Shard {0}: {1} admissions in {2:.2f}s ({3}/{4})".format(
+                    shardIx, numScored, seconds, done, len(pending))
+        finally:
+            pool.close()
+            pool.join()
+
+    ids, probabilities = [], []
+    for shardIx, _, _ in shards:
+        with np.load(shard_path(checkpointDir, shardIx)) as shard:
+            ids.append(shard['HADM_ID'])
+            probabilities.append(shard['readmissionRisk'])
+    scoreFile = ScoreFile(np.concatenate(ids), np.concatenate(probabilities), modelVersion,
+                          read_features_meta(featuresPath)['modificationTimes'])
+    scoreFile.save(outPath)
+    elapsed = time.time() - start
+    print "Wrote {0} scores to {1} in {2:.1f}s ({3:.0f} admissions/s)".format(
+        len(scoreFile), outPath, elapsed, len(admissionIDs) / max(elapsed, 1e-9))
+    return scoreFile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score every admission of a census.')
+    parser.add_argument('--ids', help='CSV with a HADM_ID column, every admission with features by default')
+    parser.add_argument('--out', default='census-scores', help='score file directory to write')
+    parser.add_argument('--snapshots', default=os.getenv('MODEL_SNAPSHOT_DIR', 'snapshots'))
+    parser.add_argument('--features', default='census-features', help='where the features are saved')
+    parser.add_argument('--refresh-features', action='store_true', help='rebuild the features with Spark')
+    parser.add_argument('--checkpoints', default='census-checkpoints')
+    parser.add_argument('--shard-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    prepare_features(args.features, args.refresh_features)
+    if args.ids:
+        admissionIDs = read_ids(args.ids)
+    else:
+        admissionIDs = np.load(os.path.join(args.features, 'HADM_ID.npy'))
+    if len(admissionIDs) == 0:
+        sys.exit("No admissions to score")
+    score_census(admissionIDs, args.snapshots, args.features, args.out, args.checkpoints,
+                 shardSize=args.shard_size, workers=args.workers)
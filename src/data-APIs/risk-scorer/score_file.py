@@ -0,0 +1,122 @@
+import os
+import json
+import shutil
+import threading
+import time
+import numpy as np
+
+
+class ScoreFile(object):
+    '''
+    Precomputed risk scores, saved as two columns sorted by admission id so that a list of
+    admissions is looked up with a binary search once loaded. On disk a score file is a directory with
+    HADM_ID.npy, readmissionRisk.npy and a meta.json naming the model version that produced them
+    and the modification times of the sources of the features they were scored from; load
+    memory-maps the columns.
+    '''
+
+    def __init__(self, admissionIDs, probabilities, modelVersion, featureModificationTimes=None):
+        self.admissionIDs = admissionIDs
+        self.probabilities = probabilities
+        self.modelVersion = modelVersion
+        self.featureModificationTimes = featureModificationTimes
+
+    def __len__(self):
+        return len(self.admissionIDs)
+
+    def lookup(self, admissionIDs):
+        '''
+        Input: a list of admission ids
+        Output: the ids that have a score, and a list of their probabilities
+        '''
+        admissionIDs = np.asarray(admissionIDs, dtype=np.int64)
+        positions = np.searchsorted(self.admissionIDs, admissionIDs)
+        positions = np.minimum(positions, max(len(self) - 1, 0))
+        found = (self.admissionIDs[positions] == admissionIDs) if len(self) else np.zeros(len(admissionIDs), dtype=bool)
+        return admissionIDs[found].tolist(), self.probabilities[positions[found]].tolist()
+
+    def save(self, path):
+        '''
+        Writes the scores to the directory 'path', replacing the previous ones in a single rename.
+        '''
+        order = np.argsort(self.admissionIDs, kind='mergesort')
+        tmpPath = path.rstrip('/') + '.tmp-{0}'.format(os.getpid())
+        if os.path.isdir(tmpPath):
+            shutil.rmtree(tmpPath)
+        os.makedirs(tmpPath)
+        np.save(os.path.join(tmpPath, 'HADM_ID.npy'), np.asarray(self.admissionIDs, dtype=np.int64)[order])
+        np.save(os.path.join(tmpPath, 'readmissionRisk.npy'), np.asarray(self.probabilities, dtype=np.float64)[order])
+        with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+            json.dump({'modelVersion': self.modelVersion, 'numScores': len(self),
+                       'featureModificationTimes': self.featureModificationTimes}, f)
+        oldPath = path.rstrip('/') + '.old-{0}'.format(os.getpid())
+        if os.path.isdir(path):
+            os.rename(path, oldPath)
+        os.rename(tmpPath, path)
+        if os.path.isdir(oldPath):
+            shutil.rmtree(oldPath)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        mode = 'r' if mmap else None
+        return cls(np.load(os.path.join(path, 'HADM_ID.npy'), mmap_mode=mode),
+                   np.load(os.path.join(path, 'readmissionRisk.npy'), mmap_mode=mode),
+                   meta['modelVersion'], meta.get('featureModificationTimes'))
+
+
+class ScoreFileWatcher(object):
+    '''
+    Checks the meta.json of a score file every 'interval' seconds and calls onLoad with the new
+    ScoreFile when score_census.py wrote another one, the same way SnapshotWatcher follows model
+    snapshots. ScoreFile.save replaces the directory, so a new score file has a new meta.json.
+    '''
+
+    def __init__(self, path, onLoad, interval=10):
+        self.path = path
+        self.onLoad = onLoad
+        self.interval = interval
+        self.stamp = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def current_stamp(self):
+        try:
+            info = os.stat(os.path.join(self.path, 'meta.json'))
+        except OSError:
+            return None
+        return info.st_ino, info.st_mtime
+
+    def check(self):
+        '''
+        Loads the score file if it was written since it was last loaded.
+        Output: True when a new score file was loaded
+        '''
+        with self._lock:
+            stamp = self.current_stamp()
+            if stamp is None or stamp == self.stamp:
+                return False
+            self.onLoad(ScoreFile.load(self.path))
+            self.stamp = stamp
+            return True
+
+    def poll(self):
+        try:
+            if self.check():
+                print "Loaded score file {0}".format(self.path)
+        except Exception as e:
+            # Keep serving the current scores, the next check will try again
+            print "Score file reload failed: ", e
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._watch, name='score-file-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
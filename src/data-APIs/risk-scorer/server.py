@@ -2,22 +2,137 @@
 
 import os
 from flask import Flask, json, request, Response
-from pyspark import SparkContext
 from pyspark.sql import SQLContext
-from pyspark.mllib.tree import DecisionTreeModel, RandomForestModel
-from helpers import get_patient_data, pre_process_patients, vectorize_data, predict_proba, create_api_response
+from helpers import setup_spark, setup_model, get_patient_data, encode_patients, features_to_points, predict_proba, create_api_response
+from forest import export_forest
+from snapshots import SnapshotWatcher, publish_snapshot, load_snapshot, load_metrics, current_version, set_current_version
+from encoder import readmissionEncoder
+from feature_store import FeatureStore
+from batcher import MicroBatcher, BatcherFull, BatcherTimeout
+from cache import ScoreCache
+from score_file import ScoreFileWatcher
+from instrumentation import instrument, stage
+import numpy as np
+import threading
 import ast
 
 
-def setup_spark():
-    os.environ['PYSPARK_SUBMIT_ARGS'] = "--packages com.databricks:spark-csv_2.10:1.4.0 pyspark-shell"
-    os.environ['PYSPARK_PYTHON'] = "python2.7"
-    sc = SparkContext("local[*]", "risk-scorer")
-    return sc 
+def setup_forest(sc, snapshot_dir):
+    '''
+    Output: the CompiledForest of the current snapshot, and the RandomForestModel when it had to be
+    loaded from model_uri or the 'spark' engine is the default
+    Description: when no snapshot has been published yet, the model is exported and published so
+    that the next start only has to memory-map it.
+    '''
+    forest = None
+    model = None
+    if current_version(snapshot_dir) is not None:
+        forest, encoder = load_snapshot(snapshot_dir)
+        check_encoder(encoder)
+    if forest is None or scoring_engine == 'spark':
+        model = setup_model(sc, model_uri)
+    if forest is None:
+        forest = export_forest(model)
+        publish_snapshot(forest, snapshot_dir)
+    return forest, model
 
-def setup_model(sc, model_uri):
-    model = RandomForestModel.load(sc, model_uri)
-    return model
+def check_encoder(encoder):
+    if encoder.to_dict() != readmissionEncoder.to_dict():
+        raise ValueError("The model was trained with a different encoding than the one used to serve it")
+
+def swap_forest(newForest, encoder):
+    '''
+    Replaces the forest that is being served. Requests that already started keep the forest they
+    picked up, new requests get the new one.
+    '''
+    global forest, forestMetrics
+    check_encoder(encoder)
+    scoreCache.set_model_version(newForest.version)
+    forestMetrics = load_metrics(snapshot_dir, newForest.version)
+    forest = newForest
+
+def swap_score_file(newScoreFile):
+    global scoreFile
+    scoreFile = newScoreFile
+
+def setup_feature_store(sc, refresh_interval):
+    featureStore = FeatureStore(SQLContext(sc), refreshInterval=refresh_interval)
+    featureStore.load()
+    return featureStore
+
+def score_file_is_current(currentScores):
+    '''
+    Output: True when the score file was written by the model being served, from features built
+    from the same sources as the ones of the feature store
+    '''
+    if currentScores is None or currentScores.modelVersion != forest.version:
+        return False
+    currentFeatures = featureStore
+    return currentFeatures is None or \
+        currentScores.featureModificationTimes == currentFeatures.table.modificationTimes
+
+def get_features(dischargeIDs):
+    '''
+    Input: a list of admission ids
+    Output: the ids that were found, and a 2D NumPy array with their encoded features
+    '''
+    if featureStore is not None:
+        with stage('feature_lookup', len(dischargeIDs)):
+            return featureStore.lookup(dischargeIDs)
+    with stage('spark_features', len(dischargeIDs)):
+        pd = get_patient_data(dischargeIDs, SQLContext(sc))
+        return encode_patients(pd)
+
+def score_admissions(dischargeIDs, engine):
+    '''
+    Input: a list of admission ids and the name of a scoring engine
+    Output: the ids that were found, and a list of their probabilities
+    Description: with the 'compiled' engine only the admissions that are not in the score cache
+    are scored. The 'spark' engine always runs the model loaded from model_uri. The 'precomputed'
+    engine reads the scores of the census score file, when it is current, and scores the
+    admissions it does not have with the 'compiled' engine.
+    '''
+    if engine == 'precomputed':
+        currentScores = scoreFile
+        if not score_file_is_current(currentScores):
+            return score_admissions(dischargeIDs, 'compiled')
+        with stage('score_file_lookup', len(dischargeIDs)):
+            foundIDs, probabilities = currentScores.lookup(dischargeIDs)
+        found = set(foundIDs)
+        missing = [dischargeID for dischargeID in dischargeIDs if dischargeID not in found]
+        if missing:
+            missingIDs, missingProbabilities = score_admissions(missing, 'compiled')
+            foundIDs += missingIDs
+            probabilities += list(missingProbabilities)
+        return foundIDs, probabilities
+    dischargeIDs, features = get_features(dischargeIDs)
+    if engine == 'spark':
+        with stage('spark_predict', len(dischargeIDs)):
+            return dischargeIDs, predict_proba(model, features_to_points(sc, features))
+    currentForest = forest
+    keys = [scoreCache.key(dischargeID, currentForest.version, row) for dischargeID, row in zip(dischargeIDs, features)]
+    cached = scoreCache.get_many(keys)
+    misses = [ix for ix, key in enumerate(keys) if key not in cached]
+    if misses:
+        with stage('predict', len(misses)):
+            scored = currentForest.predict_proba(features[misses]).tolist()
+        scoreCache.put_many([keys[ix] for ix in misses], scored)
+        cached.update(zip([keys[ix] for ix in misses], scored))
+    return dischargeIDs, [cached[key] for key in keys]
+
+def parse_admission_ids(request):
+    '''
+    Input: a Flask request
+    Output: a list of admission ids
+    Description: the ids are either a JSON array (or an object with an 'admissionIDs' array) or,
+    with the application/octet-stream content type, packed little-endian int32s.
+    '''
+    if request.mimetype == 'application/octet-stream':
+        return np.frombuffer(request.get_data(), dtype='<i4').tolist()
+    payload = request.get_json(force=True)
+    if isinstance(payload, dict):
+        payload = payload['admissionIDs']
+    return [int(admissionID) for admissionID in payload]
 
 
 ########################################################################################################################
@@ -25,6 +140,7 @@ def setup_model(sc, model_uri):
 ########################################################################################################################
 
 app = Flask(__name__)
+instrument(app, 'risk-scorer')
 
 # Get the port number from the environment variable VCAP_APP_PORT
 # When running this app on the local machine, default the port to 8080
@@ -34,6 +150,51 @@ port = int(os.getenv('VCAP_APP_PORT', 8080))
 # This should be changed to whatever model uri you have saved your spark model to.
 model_uri = os.getenv('uri', 'hdfs://cdh-master-0.node.envname.consul/user/vcap/readmission-scorer-v1.dat')
 
+# Scoring engine used when a request does not ask for one.
+# 'spark' runs every tree of the model as a Spark job, 'compiled' scores the exported forest in-process
+# and 'precomputed' serves the scores written by score_census.py to SCORE_FILE.
+scoring_engine = os.getenv('SCORING_ENGINE', 'compiled')
+scoring_engines = ['spark', 'compiled', 'precomputed']
+score_file = os.getenv('SCORE_FILE', 'census-scores')
+scoreFile = None
+
+# Keep the joined patient data in memory instead of reading it from HDFS on every request.
+# The sources are checked for changes every FEATURE_STORE_REFRESH seconds.
+use_feature_store = os.getenv('FEATURE_STORE', 'on') == 'on'
+feature_store_refresh = int(os.getenv('FEATURE_STORE_REFRESH', 300))
+featureStore = None
+
+# The compiled forest is memory-mapped from MODEL_SNAPSHOT_DIR. Publishing a new version there
+# (see snapshots.py) or calling /v1/admin/reload-model swaps it in without a restart; the
+# directory is checked every MODEL_WATCH_INTERVAL seconds.
+snapshot_dir = os.getenv('MODEL_SNAPSHOT_DIR', 'snapshots')
+model_watch_interval = float(os.getenv('MODEL_WATCH_INTERVAL', 10))
+sc = None
+model = None
+forest = None
+# The holdout metrics published with the forest, read once per model swap
+forestMetrics = None
+snapshotWatcher = SnapshotWatcher(snapshot_dir, swap_forest, interval=model_watch_interval)
+# A new score file written to SCORE_FILE is picked up on the same interval
+scoreFileWatcher = ScoreFileWatcher(score_file, swap_score_file, interval=model_watch_interval)
+
+# Scores are cached per admission, model version and features for SCORE_CACHE_TTL seconds,
+# keeping at most SCORE_CACHE_SIZE of them. A size of 0 disables the cache.
+scoreCache = ScoreCache(maxSize=int(os.getenv('SCORE_CACHE_SIZE', 100000)),
+                        ttl=float(os.getenv('SCORE_CACHE_TTL', 3600)))
+
+# Concurrent /v2/score requests are collected for up to SCORE_BATCH_WINDOW_MS milliseconds and
+# scored together, in batches of at most SCORE_MAX_BATCH admission ids. Requests are turned away
+# with a 503 when SCORE_MAX_PENDING requests are already waiting.
+score_batch_window = float(os.getenv('SCORE_BATCH_WINDOW_MS', 10)) / 1000
+score_max_batch = int(os.getenv('SCORE_MAX_BATCH', 1000))
+score_max_pending = int(os.getenv('SCORE_MAX_PENDING', 1000))
+score_timeout = float(os.getenv('SCORE_TIMEOUT', 30))
+batcher = MicroBatcher(lambda dischargeIDs: score_admissions(dischargeIDs, scoring_engine),
+                       window=score_batch_window,
+                       maxBatchSize=score_max_batch,
+                       maxPending=score_max_pending)
+
 # Routes
 
 # Root welcome.
@@ -44,28 +205,101 @@ def root():
 
 @app.route('/v1/score', methods=['GET'])
 def score_qs():
-    sqlContext = SQLContext(sc)
     input = request.args.get('data')
     # Converts data payload to a list of admission_ids, e.g. [123, 456, 789, ...]
     dischargeIDs = ast.literal_eval(input)
-    pd = get_patient_data(dischargeIDs, sqlContext)
-    data = pre_process_patients(pd, sqlContext)
-    vectors = vectorize_data(data, None)
-    dataPts = sc.parallelize(vectors.take(len(dischargeIDs)))
-    probabilities = predict_proba(model, dataPts)
-    apiResponse = create_api_response(dischargeIDs, probabilities)
-    print "response: ", apiResponse
+    engine = request.args.get('engine', scoring_engine)
+    if engine not in scoring_engines:
+        return Response("Unknown scoring engine: " + engine + "\n", status=400, mimetype='text/plain')
+    if engine == 'spark' and model is None:
+        return Response("The spark engine is not loaded, set SCORING_ENGINE=spark to use it.\n", status=400, mimetype='text/plain')
+    dischargeIDs, probabilities = score_admissions(dischargeIDs, engine)
+    with stage('serialize', len(dischargeIDs)):
+        apiResponse = create_api_response(dischargeIDs, probabilities)
     return Response(apiResponse, mimetype='text/plain')
 
-# Placeholder for POST json score support.
-@app.route('/v2', methods=['GET'])
+@app.route('/v2/score', methods=['POST'])
 def score_json():
-    response = "Hi, I'm /v2! Feel free to give me new methods."
-    print response
-    return Response(response, mimetype='text/plain')
+    try:
+        dischargeIDs = parse_admission_ids(request)
+    except (ValueError, TypeError, KeyError):
+        return Response("Expected a JSON array of admission ids or packed int32 ids.\n", status=400, mimetype='text/plain')
+    try:
+        scores = batcher.submit(dischargeIDs, timeout=score_timeout)
+    except BatcherFull:
+        response = Response("Too many scoring requests, try again later.\n", status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = '1'
+        return response
+    except BatcherTimeout:
+        return Response("Scoring timed out.\n", status=504, mimetype='text/plain')
+    with stage('serialize', len(scores)):
+        apiResponse = create_api_response(scores.keys(), scores.values())
+    return Response(apiResponse, mimetype='application/json')
 
-if __name__ == '__main__':
+@app.route('/v1/cache-stats', methods=['GET'])
+def cache_stats():
+    return Response(json.dumps(scoreCache.stats()), mimetype='application/json')
+
+@app.route('/v1/model-version', methods=['GET'])
+def model_version():
+    response = {'version': forest.version, 'numTrees': forest.numTrees()}
+    # Models published by train.py come with their holdout ROC metrics
+    if forestMetrics is not None:
+        response['metrics'] = forestMetrics
+    return Response(json.dumps(response), mimetype='application/json')
+
+@app.route('/v1/admin/reload-model', methods=['POST'])
+def reload_model():
+    # Switch CURRENT to the requested version, if any, then load it in the background
+    version = request.args.get('version')
+    try:
+        if version is not None:
+            set_current_version(snapshot_dir, version)
+    except ValueError as e:
+        return Response(str(e) + "\n", status=404, mimetype='text/plain')
+    threading.Thread(target=snapshotWatcher.poll).start()
+    response = {'serving': forest.version, 'loading': version or current_version(snapshot_dir)}
+    return Response(json.dumps(response), status=202, mimetype='application/json')
+
+def setup(prefork=False):
+    '''
+    Loads the model, the score file and the features before the first request.
+    Description: with prefork, gunicorn runs it in the master process and the workers it forks
+    share the memory-mapped forest and the feature table (see gunicorn.conf.py). Spark talks to its
+    JVM over a single connection that forked processes can not share, so it is stopped before the
+    workers are forked: they score with the compiled forest, the 'spark' engine is not available
+    and the features are only refreshed when the service is restarted.
+    '''
+    global sc, forest, forestMetrics, model, featureStore
+    if prefork and (scoring_engine == 'spark' or not use_feature_store):
+        raise ValueError("Pre-forked workers can not use Spark, set SCORING_ENGINE to compiled or precomputed "
+                         "and FEATURE_STORE=on")
     sc = setup_spark()
-    model = setup_model(sc, model_uri)
+    with stage('load_model'):
+        forest, model = setup_forest(sc, snapshot_dir)
+        forestMetrics = load_metrics(snapshot_dir, forest.version)
+    scoreCache.set_model_version(forest.version)
+    snapshotWatcher.version = forest.version
+    # A score file that can not be loaded is left out, the compiled engine scores instead
+    scoreFileWatcher.poll()
+    if use_feature_store:
+        with stage('load_features'):
+            featureStore = setup_feature_store(sc, feature_store_refresh)
+    if prefork:
+        sc.stop()
+        sc = None
+        model = None
+
+def start_worker():
+    # Started in each process that serves requests, threads are not inherited by forked workers
+    snapshotWatcher.start()
+    scoreFileWatcher.start()
+    if featureStore is not None and sc is not None:
+        featureStore.start()
+    batcher.start()
+
+if __name__ == '__main__':
+    setup()
+    start_worker()
       # Start up the Flask app server.
-    app.run(host='0.0.0.0', port=port, debug=True)
+    app.run(host='0.0.0.0', port=port, debug=True, threaded=True)
@@ -0,0 +1,154 @@
+import os
+import re
+import json
+import threading
+import time
+from forest import CompiledForest
+from encoder import CategoricalEncoder, readmissionEncoder
+
+
+# A snapshot directory holds one sub-directory per model version and a CURRENT file with the name
+# of the version that should be served, e.g.
+#
+#   snapshots/
+#       CURRENT
+#       3f2a.../   feature.npy, threshold.npy, ..., meta.json, encoder.json, metrics.json
+#       9b1c.../
+#
+# A new version is written next to the old ones and CURRENT is switched to it with an atomic
+# rename, so a reader always sees either the old or the new version in full.
+
+# A model version is the fingerprint of its forest, see CompiledForest.fingerprint
+versionPattern = re.compile(r'^[0-9a-f]{40}$')
+
+
+def publish_snapshot(forest, snapshotDir, encoder=readmissionEncoder, metrics=None, promote=True):
+    '''
+    Input: a CompiledForest, a snapshot directory, the encoder the forest was trained with,
+    optionally a dict of its evaluation metrics (see train.py) and whether to make it CURRENT
+    Output: the path of the published version
+    Description: a version that is not promoted is only served once it is named in
+    /v1/admin/reload-model?version=
+    '''
+    versionDir = os.path.join(snapshotDir, forest.version)
+    if not os.path.isdir(versionDir):
+        tmpDir = versionDir + '.tmp-{0}'.format(os.getpid())
+        forest.save(tmpDir)
+        encoder.save(os.path.join(tmpDir, 'encoder.json'))
+        if metrics is not None:
+            with open(os.path.join(tmpDir, 'metrics.json'), 'w') as f:
+                json.dump(metrics, f)
+        os.rename(tmpDir, versionDir)
+    if promote:
+        set_current_version(snapshotDir, forest.version)
+    return versionDir
+
+
+def check_version(snapshotDir, version):
+    '''
+    Description: raises ValueError unless 'version' is a model fingerprint with a sub-directory
+    of the snapshot directory, so that a version coming from a request cannot point anywhere else.
+    '''
+    if not isinstance(version, basestring) or not versionPattern.match(version):
+        raise ValueError("Not a model version: {0!r}".format(version))
+    if version not in os.listdir(snapshotDir) or not os.path.isdir(os.path.join(snapshotDir, version)):
+        raise ValueError("No snapshot for model version {0} in {1}".format(version, snapshotDir))
+
+
+def set_current_version(snapshotDir, version):
+    check_version(snapshotDir, version)
+    tmpPath = os.path.join(snapshotDir, 'CURRENT.tmp-{0}'.format(os.getpid()))
+    with open(tmpPath, 'w') as f:
+        f.write(version)
+    os.rename(tmpPath, os.path.join(snapshotDir, 'CURRENT'))
+
+
+def current_version(snapshotDir):
+    '''
+    Output: the version named in CURRENT, or None when nothing was published yet
+    '''
+    try:
+        with open(os.path.join(snapshotDir, 'CURRENT')) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def load_snapshot(snapshotDir, version=None):
+    '''
+    Input: a snapshot directory and a model version, the current one by default
+    Output: the memory-mapped CompiledForest and the CategoricalEncoder saved with it
+    '''
+    version = version or current_version(snapshotDir)
+    if version is None:
+        raise ValueError("No model has been published to {0}".format(snapshotDir))
+    check_version(snapshotDir, version)
+    versionDir = os.path.join(snapshotDir, version)
+    return CompiledForest.load(versionDir), CategoricalEncoder.load(os.path.join(versionDir, 'encoder.json'))
+
+
+def load_metrics(snapshotDir, version):
+    '''
+    Output: the metrics published with a model version, or None when it has none
+    '''
+    if not versionPattern.match(version):
+        return None
+    try:
+        with open(os.path.join(snapshotDir, version, 'metrics.json')) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+class SnapshotWatcher(object):
+    '''
+    Polls the CURRENT file of a snapshot directory every 'interval' seconds and calls onLoad with
+    the new forest and encoder when another version is published. The loading happens on the
+    watcher's thread, so requests keep being served by the old forest until onLoad swaps it.
+    '''
+
+    def __init__(self, snapshotDir, onLoad, interval=10, version=None):
+        self.snapshotDir = snapshotDir
+        self.onLoad = onLoad
+        self.interval = interval
+        self.version = version
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def check(self, version=None):
+        '''
+        Loads 'version', or the current one, if it is not the version being served.
+        Output: True when a new version was loaded
+        '''
+        with self._lock:
+            version = version or current_version(self.snapshotDir)
+            if version is None or version == self.version:
+                return False
+            forest, encoder = load_snapshot(self.snapshotDir, version)
+            self.onLoad(forest, encoder)
+            self.version = version
+            return True
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._watch, name='snapshot-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def poll(self):
+        '''
+        Runs check and logs its outcome instead of raising, for the watcher's and other
+        background threads.
+        '''
+        try:
+            if self.check():
+                print "Loaded model version {0}".format(self.version)
+        except Exception as e:
+            # Keep serving the current model, the next check will try again
+            print "Model reload failed: ", e
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
@@ -0,0 +1,151 @@
+'''
+Tests of the micro-batcher, with a stub in place of the scoring function:
+
+    python -m unittest test_batcher
+'''
+import time
+import Queue
+import threading
+import unittest
+from batcher import MicroBatcher, BatcherFull, BatcherTimeout
+
+
+class StubScorer(object):
+    '''
+    Scores every admission id but 0 as id / 1000 and records the ids of every call. While
+    'blocked' is cleared, the calls wait for it and set 'waiting'.
+    '''
+
+    def __init__(self):
+        self.calls = []
+        self.blocked = threading.Event()
+        self.blocked.set()
+        self.waiting = threading.Event()
+
+    def __call__(self, admissionIDs):
+        if not self.blocked.is_set():
+            self.waiting.set()
+        self.blocked.wait()
+        self.calls.append(sorted(admissionIDs))
+        foundIDs = [admissionID for admissionID in admissionIDs if admissionID != 0]
+        return foundIDs, [admissionID / 1000.0 for admissionID in foundIDs]
+
+
+def scores_of(admissionIDs):
+    return {admissionID: admissionID / 1000.0 for admissionID in admissionIDs if admissionID != 0}
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scorer = StubScorer()
+        self.results = {}
+        self.errors = {}
+        self.threads = []
+
+    def tearDown(self):
+        self.scorer.blocked.set()
+
+    def submit_later(self, batcher, admissionIDs, timeout=5):
+        '''
+        Submits admissionIDs from a thread of its own, the result or error is kept under the
+        first id.
+        '''
+        def submit():
+            try:
+                self.results[admissionIDs[0]] = batcher.submit(admissionIDs, timeout)
+            except Exception as e:
+                self.errors[admissionIDs[0]] = e
+        thread = threading.Thread(target=submit)
+        thread.start()
+        self.threads.append(thread)
+
+    def queue_up(self, batcher, *requests):
+        '''
+        Submits the requests and waits until their chunks are all queued, in that order, so that
+        the workers started afterwards find them together.
+        '''
+        for admissionIDs in requests:
+            queued = batcher.queue.qsize()
+            self.submit_later(batcher, admissionIDs)
+            while batcher.queue.qsize() == queued:
+                time.sleep(0.001)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def test_single_request(self):
+        batcher = MicroBatcher(self.scorer, window=0.001)
+        batcher.start()
+        self.assertEqual(batcher.submit([1, 2, 0], timeout=5), scores_of([1, 2]))
+
+    def test_concurrent_requests_are_coalesced(self):
+        batcher = MicroBatcher(self.scorer, window=0.05)
+        self.queue_up(batcher, [1, 2], [3], [2, 4])
+        batcher.start()
+        self.join()
+        self.assertEqual(self.scorer.calls, [[1, 2, 3, 4]])
+        self.assertEqual(self.results, {1: scores_of([1, 2]), 3: scores_of([3]), 2: scores_of([2, 4])})
+
+    def test_oversize_request_is_split(self):
+        batcher = MicroBatcher(self.scorer, window=0.001, maxBatchSize=2)
+        batcher.start()
+        self.assertEqual(batcher.submit([1, 2, 3, 4, 5], timeout=5), scores_of([1, 2, 3, 4, 5]))
+        self.assertEqual(self.scorer.calls, [[1, 2], [3, 4], [5]])
+
+    def test_request_that_does_not_fit_is_carried_over(self):
+        batcher = MicroBatcher(self.scorer, window=0.05, maxBatchSize=3)
+        self.queue_up(batcher, [1, 2], [3, 4], [5])
+        batcher.start()
+        self.join()
+        # [3, 4] does not fit next to [1, 2], it starts the next batch, which [5] joins
+        self.assertEqual(self.scorer.calls, [[1, 2], [3, 4, 5]])
+        self.assertEqual(self.results, {1: scores_of([1, 2]), 3: scores_of([3, 4]), 5: scores_of([5])})
+
+    def test_full(self):
+        batcher = MicroBatcher(self.scorer, maxBatchSize=1, maxPending=2)
+        self.assertRaises(BatcherFull, batcher.submit, [1, 2, 3], 5)
+        # The two chunks that were queued are dropped rather than scored
+        self.assertEqual(batcher.queue.qsize(), 2)
+        self.assertRaises(Queue.Empty, batcher._next, 0.01)
+        self.assertEqual(self.scorer.calls, [])
+
+    def test_timeout_drops_the_request(self):
+        batcher = MicroBatcher(self.scorer, window=0.001)
+        # No worker is running yet, nothing scores the request
+        self.assertRaises(BatcherTimeout, batcher.submit, [1], 0.05)
+        batcher.start()
+        self.assertEqual(batcher.submit([2], timeout=5), scores_of([2]))
+        self.assertEqual(self.scorer.calls, [[2]])
+
+    def test_request_that_expires_in_the_queue_is_dropped(self):
+        batcher = MicroBatcher(self.scorer, window=0.001)
+        batcher.start()
+        # The worker is held up by the first request while the second one waits
+        self.scorer.blocked.clear()
+        self.submit_later(batcher, [1])
+        self.assertTrue(self.scorer.waiting.wait(5))
+        self.submit_later(batcher, [2], timeout=0.05)
+        self.threads[-1].join(5)
+        self.scorer.blocked.set()
+        self.join()
+        self.assertIsInstance(self.errors[2], BatcherTimeout)
+        self.assertEqual(self.results, {1: scores_of([1])})
+        self.assertEqual(batcher.submit([3], timeout=5), scores_of([3]))
+        self.assertEqual(self.scorer.calls, [[1], [3]])
+
+    def test_errors_reach_every_caller_of_the_batch(self):
+        def failing(admissionIDs):
+            raise RuntimeError("Scoring failed")
+        batcher = MicroBatcher(failing, window=0.05)
+        self.queue_up(batcher, [1], [2])
+        batcher.start()
+        self.join()
+        self.assertEqual(self.results, {})
+        self.assertEqual(sorted(self.errors), [1, 2])
+        self.assertTrue(all(isinstance(e, RuntimeError) for e in self.errors.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
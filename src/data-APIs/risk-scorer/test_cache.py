@@ -0,0 +1,98 @@
+'''
+Tests of the score cache, with a fake clock in place of time:
+
+    python -m unittest test_cache
+'''
+import unittest
+import numpy as np
+import cache
+from cache import ScoreCache
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class ScoreCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = cache.time
+        cache.time = self.clock
+
+    def tearDown(self):
+        cache.time = self.time
+
+    def filled(self, admissionIDs, maxSize=100, ttl=60, modelVersion='v1'):
+        scoreCache = ScoreCache(maxSize, ttl)
+        scoreCache.set_model_version(modelVersion)
+        keys = [self.key(scoreCache, admissionID, modelVersion) for admissionID in admissionIDs]
+        scoreCache.put_many(keys, [admissionID / 1000.0 for admissionID in admissionIDs])
+        return scoreCache, keys
+
+    def key(self, scoreCache, admissionID, modelVersion='v1', features=None):
+        features = features if features is not None else np.array([admissionID, 1.0])
+        return scoreCache.key(admissionID, modelVersion, features)
+
+    def test_hits_and_misses(self):
+        scoreCache, keys = self.filled([1, 2])
+        missing = self.key(scoreCache, 3)
+        self.assertEqual(scoreCache.get_many(keys + [missing]), {keys[0]: 0.001, keys[1]: 0.002})
+        stats = scoreCache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['size']), (2, 1, 0, 2))
+
+    def test_features_are_part_of_the_key(self):
+        scoreCache, keys = self.filled([1])
+        changed = self.key(scoreCache, 1, features=np.array([1.0, 2.0]))
+        self.assertNotEqual(changed, keys[0])
+        self.assertEqual(scoreCache.get_many([changed]), {})
+
+    def test_least_recently_used_is_evicted(self):
+        scoreCache, keys = self.filled([1, 2, 3], maxSize=3)
+        # 1 becomes the most recently used, 2 the least
+        scoreCache.get_many([keys[0]])
+        newKey = self.key(scoreCache, 4)
+        scoreCache.put_many([newKey], [0.004])
+        self.assertEqual(sorted(scoreCache.get_many(keys + [newKey]).values()), [0.001, 0.003, 0.004])
+        stats = scoreCache.stats()
+        self.assertEqual((stats['size'], stats['evictions'], stats['misses']), (3, 1, 1))
+
+    def test_entries_expire_after_ttl(self):
+        scoreCache, keys = self.filled([1], ttl=60)
+        self.clock.now += 30
+        scoreCache.put_many([self.key(scoreCache, 2)], [0.002])
+        self.clock.now += 30
+        self.assertEqual(len(scoreCache.get_many(keys)), 1)
+        self.clock.now += 0.001
+        # 1 expired, 2 was stored 30 seconds later
+        self.assertEqual(scoreCache.get_many(keys + [self.key(scoreCache, 2)]), {self.key(scoreCache, 2): 0.002})
+        self.assertEqual(scoreCache.stats()['misses'], 1)
+
+    def test_new_model_version_drops_the_entries(self):
+        scoreCache, keys = self.filled([1, 2])
+        scoreCache.set_model_version('v1')
+        self.assertEqual(scoreCache.stats()['size'], 2)
+        scoreCache.set_model_version('v2')
+        self.assertEqual(scoreCache.stats()['size'], 0)
+        self.assertEqual(scoreCache.stats()['modelVersion'], 'v2')
+        self.assertEqual(scoreCache.get_many(keys), {})
+        # Scores of the old model that arrive late are not stored
+        scoreCache.put_many(keys, [0.001, 0.002])
+        self.assertEqual(scoreCache.stats()['size'], 0)
+        newKey = self.key(scoreCache, 1, 'v2')
+        scoreCache.put_many([newKey], [0.01])
+        self.assertEqual(scoreCache.get_many([newKey]), {newKey: 0.01})
+
+    def test_disabled(self):
+        scoreCache, keys = self.filled([1, 2], maxSize=0)
+        self.assertEqual(scoreCache.get_many(keys), {})
+        self.assertEqual(scoreCache.stats()['size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
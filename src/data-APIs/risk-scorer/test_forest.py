@@ -0,0 +1,93 @@
+'''
+Tests of the compiled forest. The parity test trains a small RandomForestModel with Spark and is
+skipped when pyspark is not installed:
+
+    python -m unittest test_forest
+'''
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from forest import CompiledForest, random_features
+
+try:
+    import pyspark
+except ImportError:
+    pyspark = None
+
+
+def small_forest():
+    '''
+    Output: a CompiledForest of two trees over the features of random_features. The first tree
+    splits on ADMISSION_TYPE in {0, 2}, then on AGE <= 65; the second one on AGE <= 40.
+    '''
+    ageIx = 8
+    feature = [0, ageIx, -1, -1, -1, ageIx, -1, -1]
+    threshold = [0.0, 65.0, 0.0, 0.0, 0.0, 40.0, 0.0, 0.0]
+    categories = [0b101, 0, 0, 0, 0, 0, 0, 0]
+    left = [1, 2, -1, -1, -1, 6, -1, -1]
+    right = [4, 3, -1, -1, -1, 7, -1, -1]
+    value = [0.0, 0.0, 0.0, 1.0, 1.0, 0.0, 0.0, 1.0]
+    return CompiledForest(feature, threshold, categories, left, right, value, [0, 5], maxDepth=2)
+
+
+def expected_proba(X):
+    ageIx = 8
+    inCategories = np.in1d(X[:, 0], [0, 2])
+    first = np.where(inCategories, (X[:, ageIx] > 65).astype(float), 1.0)
+    second = (X[:, ageIx] > 40).astype(float)
+    return (first + second) / 2
+
+
+class CompiledForestTest(unittest.TestCase):
+
+    def test_predict_proba(self):
+        X = random_features(500)
+        np.testing.assert_array_equal(small_forest().predict_proba(X), expected_proba(X))
+
+    def test_save_load(self):
+        forest = small_forest()
+        path = tempfile.mkdtemp()
+        try:
+            forest.save(path + '/forest')
+            loaded = CompiledForest.load(path + '/forest')
+            self.assertEqual(loaded.version, forest.version)
+            X = random_features(100)
+            np.testing.assert_array_equal(loaded.predict_proba(X), forest.predict_proba(X))
+        finally:
+            shutil.rmtree(path)
+
+
+@unittest.skipIf(pyspark is None, "pyspark is not installed")
+class SparkParityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from pyspark import SparkContext
+        cls.sc = SparkContext('local[2]', 'test_forest')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sc.stop()
+
+    def test_parity(self):
+        from pyspark.mllib.regression import LabeledPoint
+        from pyspark.mllib.tree import RandomForest
+        from forest import export_forest, check_parity
+        from encoder import readmissionEncoder
+
+        X = random_features(2000, seed=7)
+        # A label that depends on the categorical and the continuous features
+        y = ((X[:, 0] == 1) | (X[:, 8] > 70) | (X[:, 6] > 2)).astype(float)
+        points = self.sc.parallelize([LabeledPoint(label, row) for label, row in zip(y, X)])
+        model = RandomForest.trainClassifier(points, numClasses=2,
+                                             categoricalFeaturesInfo=readmissionEncoder.arities(),
+                                             numTrees=5, maxDepth=6, seed=42)
+        forest = export_forest(model)
+        self.assertEqual(forest.numTrees(), 5)
+        difference = check_parity(self.sc, model, forest, random_features(500, seed=8))
+        self.assertLess(difference, 1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
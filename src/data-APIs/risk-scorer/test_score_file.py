@@ -0,0 +1,48 @@
+'''
+Tests of the score file and of its watcher:
+
+    python -m unittest test_score_file
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from score_file import ScoreFile, ScoreFileWatcher
+
+
+class ScoreFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'census-scores')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        ScoreFile(np.array([30, 10, 20]), np.array([0.3, 0.1, 0.2]), 'v1', [1000, 2000, 3000]).save(self.path)
+        scoreFile = ScoreFile.load(self.path)
+        self.assertEqual((scoreFile.modelVersion, scoreFile.featureModificationTimes), ('v1', [1000, 2000, 3000]))
+        self.assertEqual(scoreFile.lookup([20, 40, 10]), ([20, 10], [0.2, 0.1]))
+
+    def test_unreadable_file_keeps_the_loaded_one(self):
+        loaded = []
+        watcher = ScoreFileWatcher(self.path, loaded.append)
+        # No score file yet
+        watcher.poll()
+        ScoreFile(np.array([1]), np.array([0.5]), 'v1').save(self.path)
+        watcher.poll()
+        self.assertEqual(len(loaded), 1)
+        # Half written: a new meta.json, no columns
+        shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            f.write('{"modelVersion": "v2"')
+        watcher.poll()
+        self.assertEqual(len(loaded), 1)
+        self.assertRaises(Exception, watcher.check)
+
+
+if __name__ == '__main__':
+    unittest.main()
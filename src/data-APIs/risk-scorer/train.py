@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+'''
+Trains the readmission model of data-science-on-TAP.md and publishes it as a model snapshot that
+the risk-scorer serves (see snapshots.py):
+
+    python train.py --snapshots snapshots --trees 15,20,25 --depths 6,8,12 --workers 8
+
+The features and 30 day readmission labels of every adult admission are built once, with Spark and
+the same CategoricalEncoder that serves the model, and saved to --features; later runs reuse them
+unless --refresh-features is given. They are split into a holdout set and --folds folds, and the
+training part of every fold is balanced once, by oversampling the readmitted admissions, and saved
+under --cache. Every fit of the grid search reads those matrices instead of featurizing and
+balancing again.
+
+The numTrees x maxDepth grid is evaluated fold by fold, --workers fits at a time on a SparkContext
+with as many cores. After --min-folds folds, a setting whose mean area under the ROC curve is more
+than --abandon-margin below the best one is dropped and not fitted on the remaining folds. The
+best setting is trained on all the balanced training data, scored on the holdout set and published
+with its encoder and a metrics.json of its ROC curve and of the search. It only becomes the CURRENT
+version, and is picked up by running services, with --promote; otherwise it is promoted after its
+metrics were reviewed with /v1/admin/reload-model?version=.
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from encoder import readmissionEncoder
+from snapshots import publish_snapshot
+
+# The settings tried by the notebook's grid search
+defaultTrees = [15, 20, 25]
+defaultDepths = [6, 8, 12]
+
+# Admissions readmitted within this many days of their discharge are labeled 1
+readmissionDays = 30
+
+
+def days_to_readmission(subjectIDs, admitTimes, dischargeTimes):
+    '''
+    Input: the SUBJECT_ID, ADMITTIME and DISCHTIME of every admission
+    Output: an int64 array of the days between each discharge and the next admission of the same
+    patient, 0 for a patient's last admission, like DAYS_TO_READMISSION in the notebook
+    '''
+    subjectIDs = np.asarray(subjectIDs, dtype=np.int64)
+    admitDays = np.asarray(admitTimes, dtype='datetime64[D]')
+    dischargeDays = np.asarray(dischargeTimes, dtype='datetime64[D]')
+    order = np.lexsort((admitDays, subjectIDs))
+    days = np.zeros(len(order), dtype=np.int64)
+    hasNext = subjectIDs[order][1:] == subjectIDs[order][:-1]
+    gaps = (admitDays[order][1:] - dischargeDays[order][:-1]).astype(np.int64)
+    days[order[:-1]] = np.where(hasNext, gaps, 0)
+    return days
+
+
+def save_training_set(table, labels, path):
+    '''
+    Input: a FeatureTable, an array with the label of each of its rows and a directory
+    Description: writes the HADM_IDs, encoded features and labels of the adult admissions sorted
+    by HADM_ID. Newborns are left out, as in the notebook.
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    allRows = np.arange(len(table))
+    adults = allRows[table.column('ADMISSION_TYPE', allRows) != 'NEWBORN']
+    order = adults[np.argsort(table.columns['HADM_ID'][adults], kind='mergesort')]
+    np.save(os.path.join(path, 'HADM_ID.npy'), table.columns['HADM_ID'][order])
+    np.save(os.path.join(path, 'features.npy'), table.features[order])
+    np.save(os.path.join(path, 'label.npy'), labels[order])
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'numAdmissions': len(order),
+                   'numReadmitted': int(labels[order].sum()),
+                   'modificationTimes': table.modificationTimes}, f)
+
+
+def build_training_set(sc, path, encoder=readmissionEncoder):
+    from pyspark.sql import SQLContext
+    from helpers import sourcePaths, load_source_tables
+    from feature_store import build_feature_table
+    sqlContext = SQLContext(sc)
+    table = build_feature_table(sqlContext, sourcePaths, encoder)
+    df_admissions = load_source_tables(sqlContext, sourcePaths)[0]
+    rows = df_admissions.select('SUBJECT_ID', 'HADM_ID', 'ADMITTIME', 'DISCHTIME').collect()
+    days = days_to_readmission([row[0] for row in rows], [row[2] for row in rows], [row[3] for row in rows])
+    readmitted = {row[1]: 0 < d <= readmissionDays for row, d in zip(rows, days)}
+    labels = np.array([readmitted.get(admissionID, False) for admissionID in table.columns['HADM_ID'].tolist()],
+                      dtype=np.float64)
+    save_training_set(table, labels, path)
+
+
+def nearest_neighbours(X, k, chunkSize=1000):
+    '''
+    Input: a 2D array of points and the number of neighbours to find
+    Output: a 2D array with the row numbers of the k nearest other points of every point
+    '''
+    squares = (X ** 2).sum(axis=1)
+    neighbours = np.empty((len(X), k), dtype=np.int64)
+    for start in xrange(0, len(X), chunkSize):
+        stop = min(start + chunkSize, len(X))
+        distances = squares[start:stop, np.newaxis] - 2 * X[start:stop].dot(X.T) + squares[np.newaxis, :]
+        distances[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        neighbours[start:stop] = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return neighbours
+
+
+def balance(X, y, categoricalIx, k=5, seed=42):
+    '''
+    Input: features, 0/1 labels, the columns of the categorical features, the number of neighbours
+    and a random seed
+    Output: the features and labels with synthetic readmitted admissions added until both labels
+    have as many rows
+    Description: the SMOTE oversampling of the notebook's balance_data, without imbalanced-learn.
+    Each new point lies between a readmitted admission and one of its k nearest readmitted
+    neighbours. Its categorical features are copied from the nearer of the two, so no new category
+    codes are made up.
+    '''
+    rng = np.random.RandomState(seed)
+    minority = X[y == 1]
+    numNew = int((y == 0).sum()) - len(minority)
+    if numNew <= 0 or len(minority) < 2:
+        return X, y
+    neighbours = nearest_neighbours(minority, min(k, len(minority) - 1))
+    base = rng.randint(0, len(minority), numNew)
+    other = neighbours[base, rng.randint(0, neighbours.shape[1], numNew)]
+    gap = rng.uniform(size=(numNew, 1))
+    synthetic = minority[base] + gap * (minority[other] - minority[base])
+    nearer = np.where(gap < 0.5, minority[base], minority[other])
+    synthetic[:, categoricalIx] = nearer[:, categoricalIx]
+    return np.vstack([X, synthetic]), np.concatenate([y, np.ones(numNew)])
+
+
+def split_folds(y, numFolds, holdoutFraction, seed=42):
+    '''
+    Input: the labels, the number of folds, the fraction of rows to hold out and a random seed
+    Output: the holdout rows and the test rows of each fold
+    Description: the rows of each label are shuffled and dealt out separately, so the holdout set
+    and every fold have about the same share of readmitted admissions.
+    '''
+    rng = np.random.RandomState(seed)
+    holdout, folds = [], [[] for _ in xrange(numFolds)]
+    for label in [0, 1]:
+        rows = rng.permutation(np.flatnonzero(y == label))
+        numHoldout = int(round(len(rows) * holdoutFraction))
+        holdout.append(rows[:numHoldout])
+        for foldIx in xrange(numFolds):
+            folds[foldIx].append(rows[numHoldout + foldIx::numFolds])
+    return np.sort(np.concatenate(holdout)), [np.sort(np.concatenate(fold)) for fold in folds]
+
+
+def cache_key(featuresPath, numFolds, holdoutFraction, seed):
+    digest = hashlib.sha1()
+    with open(os.path.join(featuresPath, 'meta.json')) as f:
+        digest.update(f.read())
+    digest.update(json.dumps([numFolds, holdoutFraction, seed, readmissionEncoder.to_dict()], sort_keys=True))
+    return digest.hexdigest()[:16]
+
+
+def save_matrix(path, **arrays):
+    # Written under a temporary name and renamed, so a cached matrix is never half written
+    tmpPath = path + '.tmp-{0}.npz'.format(os.getpid())
+    np.savez(tmpPath, **arrays)
+    os.rename(tmpPath, path)
+
+
+def prepare_folds(featuresPath, cacheRoot, numFolds=5, holdoutFraction=0.1, seed=42, encoder=readmissionEncoder):
+    '''
+    Input: the saved training set, the cache directory, the number of folds, the fraction of rows to
+    hold out and a random seed
+    Output: the directory with fold-<n>.npz (balanced training and untouched test rows of each
+    fold), all.npz (all balanced training rows) and holdout.npz
+    Description: the split and the balancing only run when the directory for these arguments and
+    features does not exist yet.
+    '''
+    cacheDir = os.path.join(cacheRoot, cache_key(featuresPath, numFolds, holdoutFraction, seed))
+    if os.path.exists(os.path.join(cacheDir, 'holdout.npz')):
+        return cacheDir
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    X = np.load(os.path.join(featuresPath, 'features.npy'))
+    y = np.load(os.path.join(featuresPath, 'label.npy'))
+    categoricalIx = sorted(encoder.arities())
+    holdout, folds = split_folds(y, numFolds, holdoutFraction, seed)
+    training = np.setdiff1d(np.arange(len(y)), holdout)
+    for foldIx, testRows in enumerate(folds):
+        trainRows = np.setdiff1d(training, testRows)
+        trainX, trainY = balance(X[trainRows], y[trainRows], categoricalIx, seed=seed + foldIx)
+        save_matrix(fold_path(cacheDir, foldIx), trainX=trainX, trainY=trainY, testX=X[testRows], testY=y[testRows])
+    trainX, trainY = balance(X[training], y[training], categoricalIx, seed=seed)
+    save_matrix(os.path.join(cacheDir, 'all.npz'), trainX=trainX, trainY=trainY)
+    save_matrix(os.path.join(cacheDir, 'holdout.npz'), testX=X[holdout], testY=y[holdout])
+    return cacheDir
+
+
+def fold_path(cacheDir, foldIx):
+    return os.path.join(cacheDir, 'fold-{0}.npz'.format(foldIx))
+
+
+def roc_curve(scores, labels):
+    '''
+    Input: predicted probabilities and 0/1 labels
+    Output: the false and true positive rates of every distinct threshold, from the highest, and the
+    thresholds
+    '''
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.float64)
+    order = np.argsort(-scores, kind='mergesort')
+    scores, labels = scores[order], labels[order]
+    # The last row of every run of equal scores
+    last = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+    truePositives = np.cumsum(labels)[last]
+    falsePositives = (last + 1) - truePositives
+    fpr = np.r_[0, falsePositives / max(falsePositives[-1], 1)]
+    tpr = np.r_[0, truePositives / max(truePositives[-1], 1)]
+    return fpr, tpr, scores[last]
+
+
+def roc_auc(scores, labels):
+    fpr, tpr, _ = roc_curve(scores, labels)
+    return float(np.trapz(tpr, fpr))
+
+
+def grid_search(settings, numFolds, evaluate, workers, minFolds=2, margin=0.02):
+    '''
+    Input: a list of (numTrees, maxDepth) settings, the number of folds, a function of a setting
+    and a fold number that returns the area under the ROC curve, the number of fits to run at once,
+    the folds every setting gets and how far below the best mean a setting is dropped
+    Output: a dict of setting to the list of its scores, the settings that were dropped, and the best
+    setting
+    Description: every round fits the remaining settings on the next fold concurrently. From
+    minFolds folds on, the settings whose mean is more than margin below the best mean are
+    dropped, so losing settings do not take up the remaining rounds.
+    '''
+    scores = {setting: [] for setting in settings}
+    remaining = list(settings)
+    abandoned = []
+    pool = ThreadPool(workers)
+    try:
+        for foldIx in xrange(numFolds):
+            start = time.time()
+            results = pool.map(lambda setting: evaluate(setting, foldIx), remaining)
+            for setting, score in zip(remaining, results):
+                scores[setting].append(score)
+            means = {setting: np.mean(scores[setting]) for setting in remaining}
+            best = max(means.values())
+            print "Fold {0}: {1} fits in {2:.1f}s, best mean AUC {3:.4f}".format(
+                foldIx, len(remaining), time.time() - start, best)
+            if foldIx + 1 >= minFolds and foldIx + 1 < numFolds:
+                losing = [setting for setting in remaining if means[setting] < best - margin]
+                for setting in losing:
+                    print "Dropped numTrees={0} maxDepth={1}: mean AUC {2:.4f}".format(
+                        setting[0], setting[1], means[setting])
+                abandoned.extend(losing)
+                remaining = [setting for setting in remaining if setting not in losing]
+    finally:
+        pool.close()
+        pool.join()
+    best = max(remaining, key=lambda setting: np.mean(scores[setting]))
+    return scores, abandoned, best
+
+
+class SparkTrainer(object):
+    '''
+    Fits MLlib RandomForest classifiers on the cached matrices of prepare_folds. The training points
+    of each fold are parallelized once, as a single partition, and shared by every setting fitted
+    on that fold, so each fit runs as one task at a time and the fits of different threads run on
+    different cores.
+    '''
+
+    def __init__(self, sc, cacheDir, encoder=readmissionEncoder, seed=42):
+        self.sc = sc
+        self.cacheDir = cacheDir
+        self.arities = encoder.arities()
+        self.seed = seed
+        self._points = {}
+        self._tests = {}
+        self._lock = threading.Lock()
+
+    def fit(self, points, numTrees, maxDepth):
+        from pyspark.mllib.tree import RandomForest
+        return RandomForest.trainClassifier(points, numClasses=2, categoricalFeaturesInfo=self.arities,
+                                            numTrees=numTrees, maxDepth=maxDepth, impurity='gini',
+                                            seed=self.seed)
+
+    def points(self, X, y, numSlices=None):
+        from pyspark.mllib.regression import LabeledPoint
+        return self.sc.parallelize([LabeledPoint(label, row) for label, row in zip(y, X)], numSlices).cache()
+
+    def fold(self, foldIx):
+        with self._lock:
+            if foldIx not in self._points:
+                with np.load(fold_path(self.cacheDir, foldIx)) as fold:
+                    self._points[foldIx] = self.points(fold['trainX'], fold['trainY'], 1)
+                    self._tests[foldIx] = fold['testX'], fold['testY']
+                # Only the folds of the current round are kept
+                for ix in [ix for ix in self._points if ix < foldIx]:
+                    self._points.pop(ix).unpersist()
+                    del self._tests[ix]
+            return self._points[foldIx], self._tests[foldIx]
+
+    def evaluate(self, setting, foldIx):
+        from forest import export_forest
+        points, (testX, testY) = self.fold(foldIx)
+        forest = export_forest(self.fit(points, *setting))
+        return roc_auc(forest.predict_proba(testX), testY)
+
+
+def train(sc, featuresPath, cacheRoot, snapshotDir, settings, numFolds=5, holdoutFraction=0.1, workers=None,
+          minFolds=2, margin=0.02, modelURI=None, seed=42, encoder=readmissionEncoder, promote=False):
+    '''
+    Output: the path of the published snapshot
+    Description: the snapshot is only made the CURRENT version with promote
+    '''
+    from forest import export_forest
+    start = time.time()
+    cacheDir = prepare_folds(featuresPath, cacheRoot, numFolds, holdoutFraction, seed, encoder)
+    print "Prepared {0} folds in {1} in {2:.1f}s".format(numFolds, cacheDir, time.time() - start)
+
+    trainer = SparkTrainer(sc, cacheDir, encoder, seed)
+    searchStart = time.time()
+    scores, abandoned, best = grid_search(settings, numFolds, trainer.evaluate, workers or multiprocessing.cpu_count(),
+                                          minFolds, margin)
+    searchSeconds = time.time() - searchStart
+    print "Best setting numTrees={0} maxDepth={1}: mean AUC {2:.4f}, searched in {3:.1f}s".format(
+        best[0], best[1], np.mean(scores[best]), searchSeconds)
+
+    with np.load(os.path.join(cacheDir, 'all.npz')) as allRows:
+        model = trainer.fit(trainer.points(allRows['trainX'], allRows['trainY']), *best)
+    forest = export_forest(model)
+    with np.load(os.path.join(cacheDir, 'holdout.npz')) as holdout:
+        probabilities = forest.predict_proba(holdout['testX'])
+        fpr, tpr, thresholds = roc_curve(probabilities, holdout['testY'])
+        numHoldout = len(holdout['testY'])
+    with open(os.path.join(featuresPath, 'meta.json')) as f:
+        featuresMeta = json.load(f)
+
+    metrics = {'numTrees': best[0],
+               'maxDepth': best[1],
+               'holdout': {'numAdmissions': numHoldout,
+                           'areaUnderROC': float(np.trapz(tpr, fpr)),
+                           'roc': {'fpr': fpr.tolist(), 'tpr': tpr.tolist(), 'thresholds': thresholds.tolist()}},
+               'search': [{'numTrees': setting[0],
+                           'maxDepth': setting[1],
+                           'foldAUCs': scores[setting],
+                           'meanAUC': float(np.mean(scores[setting])),
+                           'abandoned': setting in abandoned} for setting in settings],
+               'searchSeconds': searchSeconds,
+               'folds': numFolds,
+               'features': featuresMeta,
+               'trainedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    path = publish_snapshot(forest, snapshotDir, encoder, metrics, promote=promote)
+    print "Published model {0} to {1}: holdout AUC {2:.4f}".format(forest.version, path,
+                                                                   metrics['holdout']['areaUnderROC'])
+    if not promote:
+        print "Not promoted, serve it with: POST /v1/admin/reload-model?version={0}".format(forest.version)
+    if modelURI:
+        model.save(sc, modelURI)
+    return path
+
+
+def parse_ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the readmission model and publish it.')
+    parser.add_argument('--snapshots', default=os.getenv('MODEL_SNAPSHOT_DIR', 'snapshots'))
+    parser.add_argument('--features', default='training-features', help='where the training set is saved')
+    parser.add_argument('--refresh-features', action='store_true', help='rebuild the training set with Spark')
+    parser.add_argument('--cache', default='training-cache', help='where the balanced folds are saved')
+    parser.add_argument('--trees', type=parse_ints, default=defaultTrees, help='comma separated numTrees')
+    parser.add_argument('--depths', type=parse_ints, default=defaultDepths, help='comma separated maxDepths')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--holdout', type=float, default=0.1, help='fraction of admissions held out')
+    parser.add_argument('--min-folds', type=int, default=2, help='folds every setting is fitted on')
+    parser.add_argument('--abandon-margin', type=float, default=0.02,
+                        help='drop settings whose mean AUC is this far below the best')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='fits run at once')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--model-uri', help='also save the Spark model there, for the spark engine')
+    parser.add_argument('--promote', action='store_true', help='make the new model the one that is served')
+    args = parser.parse_args()
+
+    from helpers import setup_spark
+    sc = setup_spark("local[{0}]".format(args.workers))
+    try:
+        if args.refresh_features or not os.path.exists(os.path.join(args.features, 'meta.json')):
+            build_training_set(sc, args.features)
+        settings = [(trees, depth) for trees in args.trees for depth in args.depths]
+        if not settings:
+            sys.exit("No settings to search")
+        train(sc, args.features, args.cache, args.snapshots, settings, numFolds=args.folds,
+              holdoutFraction=args.holdout, workers=args.workers, minFolds=args.min_folds,
+              margin=args.abandon_margin, modelURI=args.model_uri, seed=args.seed, promote=args.promote)
+    finally:
+        sc.stop()
@@ -0,0 +1,119 @@
+'''
+Tests of the columnar cache of the delimited text files:
+
+    python -m unittest test_columnar_cache
+'''
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+import columnar_cache
+from columnar_cache import cache_path, convert, load_columns, load_frame, parse_dates, read_meta
+
+
+admissionsPSV = '''HADM_ID|SUBJECT_ID|ADMISSION_TYPE|ADMITTIME|DRG_SEVERITY
+100001|1|EMERGENCY|04/09/2196 12:26:00 PM|2
+100002|2|ELECTIVE|2101-10-20 19:08:00|null
+100003|3|EMERGENCY|null|4
+'''
+
+options = {'delimiter': '|', 'dateCols': ['ADMITTIME'], 'idCols': ['HADM_ID', 'SUBJECT_ID']}
+
+
+class ColumnarCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'admissions.psv')
+        self.write_source(admissionsPSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_source(self, text, mtime=None):
+        with open(self.source, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(self.source, (mtime, mtime))
+
+    def test_parse_dates(self):
+        import pandas as pd
+        parsed = parse_dates(pd.Series(['04/09/2196 12:26:00 PM', '2101-10-20 19:08:00', None]))
+        self.assertEqual(parsed.dtype, np.dtype('datetime64[s]'))
+        self.assertEqual(parsed[0], np.datetime64('2196-04-09T12:26:00'))
+        # Not in the PSV format, parsed by pandas' inference
+        self.assertEqual(parsed[1], np.datetime64('2101-10-20T19:08:00'))
+        self.assertTrue(np.isnat(parsed[2]))
+
+    def test_columns(self):
+        columns = dict(load_columns(self.source, **options))
+        self.assertEqual(columns['HADM_ID'].dtype, np.int32)
+        self.assertEqual(columns['HADM_ID'].tolist(), [100001, 100002, 100003])
+        self.assertEqual(list(columns['ADMISSION_TYPE']), ['EMERGENCY', 'ELECTIVE', 'EMERGENCY'])
+        self.assertEqual(columns['ADMITTIME'][1], np.datetime64('2101-10-20T19:08:00'))
+        self.assertTrue(np.isnat(columns['ADMITTIME'][2]))
+        self.assertTrue(np.isnan(columns['DRG_SEVERITY'][1]))
+
+    def test_fresh_cache_is_not_rewritten(self):
+        convert(self.source, **options)
+        meta = read_meta(self.source)
+        stamp = os.stat(os.path.join(cache_path(self.source), 'meta.json')).st_ino
+        convert(self.source, **options)
+        load_frame(self.source, **options)
+        self.assertEqual(read_meta(self.source), meta)
+        self.assertEqual(os.stat(os.path.join(cache_path(self.source), 'meta.json')).st_ino, stamp)
+
+    def test_stale_cache_is_rebuilt(self):
+        self.assertEqual(len(load_frame(self.source, **options)), 3)
+        self.write_source(admissionsPSV + '100004|4|URGENT|01/01/2150 01:00:00 AM|1\n', mtime=time.time() + 10)
+        df = load_frame(self.source, **options)
+        self.assertEqual(df['HADM_ID'].tolist(), [100001, 100002, 100003, 100004])
+        self.assertEqual(df['ADMITTIME'].values[3], np.datetime64('2150-01-01T01:00:00'))
+
+    def test_other_options_rebuild_the_cache(self):
+        load_columns(self.source, **options)
+        columns = dict(load_columns(self.source, delimiter='|'))
+        self.assertEqual(columns['ADMITTIME'].dtype.kind, 'O')
+
+    def test_concurrent_rebuild(self):
+        load_columns(self.source, **options)
+        self.write_source(admissionsPSV + '100004|4|URGENT|null|1\n', mtime=time.time() + 10)
+
+        # Slows the conversion down, so that every reader finds the cache stale
+        conversions = []
+        write_cache = columnar_cache.write_cache
+
+        def slow_write_cache(*args):
+            conversions.append(threading.current_thread().name)
+            time.sleep(0.2)
+            return write_cache(*args)
+
+        results = []
+        errors = []
+
+        def read():
+            try:
+                results.append(dict(load_columns(self.source, **options))['HADM_ID'].tolist())
+            except Exception as e:
+                errors.append(e)
+
+        columnar_cache.write_cache = slow_write_cache
+        try:
+            threads = [threading.Thread(target=read) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            columnar_cache.write_cache = write_cache
+        self.assertEqual(errors, [])
+        self.assertEqual(len(conversions), 1)
+        self.assertEqual(results, [[100001, 100002, 100003, 100004]] * 8)
+        self.assertEqual([name for name in os.listdir(self.directory) if '.tmp-' in name or '.old-' in name], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+'''
+Tests of the pre-forked serving settings:
+
+    python -m unittest test_gunicorn_conf
+'''
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+
+
+class RemoveDeadMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        # Loading the settings cleans PROMETHEUS_MULTIPROC_DIR, it is pointed at an empty directory
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = os.path.join(self.directory, 'empty')
+        os.environ['PROFILER_DIR'] = os.path.join(self.directory, 'profiles')
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+        self.conf = imp.load_source('gunicorn_conf', path)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def test_only_the_files_of_dead_processes_are_removed(self):
+        metricsDir = os.path.join(self.directory, 'metrics')
+        os.makedirs(metricsDir)
+        # A pid that is above the default pid_max of Linux, so no process has it
+        deadPid = 4194304 + 1
+        names = ['counter_{0}.db'.format(os.getpid()),
+                 'gauge_liveall_{0}.db'.format(os.getpid()),
+                 'counter_{0}.db'.format(deadPid),
+                 'histogram_{0}.db'.format(deadPid),
+                 'gauge_livesum_{0}.db'.format(deadPid),
+                 'README',
+                 'counter.db',
+                 'notes_abc.db']
+        for name in names:
+            open(os.path.join(metricsDir, name), 'w').close()
+        self.conf.remove_dead_metrics(metricsDir)
+        self.assertEqual(sorted(os.listdir(metricsDir)),
+                         sorted(['counter_{0}.db'.format(os.getpid()), 'gauge_liveall_{0}.db'.format(os.getpid()),
+                                 'README', 'counter.db', 'notes_abc.db']))
+
+
+if __name__ == '__main__':
+    unittest.main()
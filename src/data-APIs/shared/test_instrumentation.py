@@ -0,0 +1,76 @@
+'''
+Tests of the profiler routes:
+
+    python -m unittest test_instrumentation
+'''
+import shutil
+import tempfile
+import unittest
+from flask import Flask, json
+import instrumentation
+from instrumentation import Profiler
+
+
+app = Flask(__name__)
+instrumentation.instrument(app, 'test')
+
+
+class ProfilerRoutesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.profilerDir = instrumentation.profilerDir
+        instrumentation.profilerDir = None
+        instrumentation.profiler = Profiler()
+
+    def tearDown(self):
+        instrumentation.profiler.stop()
+        instrumentation.profilerDir = self.profilerDir
+        instrumentation.profiler = Profiler(self.profilerDir)
+
+    def test_bad_arguments(self):
+        for query in ['seconds=abc', 'seconds=nan', 'seconds=inf', 'seconds=0', 'seconds=100000',
+                      'interval=0', 'interval=-1', 'interval=nan', 'interval=5', 'interval=']:
+            response = self.client.post('/v1/admin/profiler?' + query)
+            self.assertEqual(response.status_code, 400, query)
+        self.assertFalse(instrumentation.profiler.running())
+
+    def test_start_and_stop(self):
+        response = self.client.post('/v1/admin/profiler?seconds=60&interval=0.01')
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(instrumentation.profiler.running())
+        self.assertEqual(self.client.post('/v1/admin/profiler').status_code, 409)
+        response = self.client.delete('/v1/admin/profiler')
+        self.assertTrue(json.loads(response.data)['stopped'])
+        instrumentation.profiler._thread.join(1)
+        self.assertFalse(instrumentation.profiler.running())
+        # Nothing left to stop
+        self.assertFalse(json.loads(self.client.delete('/v1/admin/profiler').data)['stopped'])
+
+    def test_stop_reaches_the_other_workers(self):
+        directory = tempfile.mkdtemp()
+        try:
+            instrumentation.profilerDir = directory
+            instrumentation.profiler = Profiler(directory)
+            self.assertEqual(self.client.post('/v1/admin/profiler?seconds=60').status_code, 202)
+            started = instrumentation.profiler
+            # Stopped through another worker that joined the profile
+            other = Profiler(directory)
+            other.start(60, 0.01, started.profileID)
+            instrumentation.profiler = other
+            self.assertTrue(json.loads(self.client.delete('/v1/admin/profiler').data)['stopped'])
+            other._thread.join(1)
+            self.assertFalse(other.running())
+            # The first worker stops on its next check
+            instrumentation.profiler = started
+            instrumentation.lastProfileCheck[0] = 0.0
+            instrumentation.join_requested_profile()
+            started._thread.join(1)
+            self.assertFalse(started.running())
+            self.assertEqual(self.client.get('/v1/admin/profiler').headers['X-Profile-Running'], 'false')
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Copies the modules in shared/ into the services that use them. Every service is pushed to Cloud
+Foundry from its own directory, so each one needs its own copy; the copies are never edited by
+hand.
+
+    python sync_shared.py           # copy shared/ into the services
+    python sync_shared.py --check   # exit with 1 when a copy differs from shared/
+'''
+import os
+import sys
+import shutil
+import filecmp
+import argparse
+
+
+apisDir = os.path.dirname(os.path.abspath(__file__))
+sharedDir = os.path.join(apisDir, 'shared')
+
+# The services that get a copy of each shared module
+sharedFiles = {
+    'columnar_cache.py': ['discharge-planner', 'record-getter', 'reference-data'],
+    'gunicorn.conf.py': ['discharge-planner', 'record-getter', 'reference-data', 'risk-scorer'],
+    'instrumentation.py': ['discharge-planner', 'record-getter', 'reference-data', 'risk-scorer'],
+}
+
+
+def copies():
+    '''
+    Output: (shared path, copy path) for every copy of a shared module
+    '''
+    for name, services in sorted(sharedFiles.items()):
+        for service in services:
+            yield os.path.join(sharedDir, name), os.path.join(apisDir, service, name)
+
+
+def stale_copies():
+    return [copyPath for sharedPath, copyPath in copies()
+            if not os.path.exists(copyPath) or not filecmp.cmp(sharedPath, copyPath, shallow=False)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy the shared modules into the services.')
+    parser.add_argument('--check', action='store_true', help='only check that the copies are up to date')
+    args = parser.parse_args()
+    stale = stale_copies()
+    if args.check:
+        for copyPath in stale:
+            print "{0} differs from shared/{1}".format(os.path.relpath(copyPath, apisDir), os.path.basename(copyPath))
+        sys.exit(1 if stale else 0)
+    for sharedPath, copyPath in copies():
+        if copyPath in stale:
+            shutil.copyfile(sharedPath, copyPath)
+            print "Copied {0}".format(os.path.relpath(copyPath, apisDir))